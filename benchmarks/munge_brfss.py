@@ -0,0 +1,133 @@
+"""
+Times munging one BRFSS year with munge_df against the per cell
+pipeline it replaced, checking both give the same frame.
+
+    python benchmarks/munge_brfss.py DATA_DIR --year 2015
+
+DATA_DIR holds the year's files as named in the dataset config, say
+LLCP2015XPT.zip, format15.sas and formas15.sas, as synced from the
+config's s3_url_prefix.
+"""
+import os
+import us
+import click
+import asteval
+import numpy as np
+import pandas as pd
+import pandas.util.testing as pt
+from timeit import default_timer as timer
+from cytoolz.curried import map, curry
+
+from survey_stats import pdutil
+from survey_stats.types import DatasetConfig
+from survey_stats.etl import survey_df as sdf
+from survey_stats.etl.sas import load_variable_labels, load_sas_xport_df
+
+
+def old_sitecode(x):
+    return (us.states.lookup('%.2d' % x).abbr if
+            int(x) in sdf.US_STATES_FIPS_INTS else 'NA')
+
+
+OLD_SITECODE_TRANSLATORS = {'fips': old_sitecode,
+                            'codes': lambda x: x}
+
+
+def old_eager_convert_categorical(s, lbls, fmts, lgr=sdf.logger):
+    fmt = None
+    if s.name in lbls.keys():
+        fmt = lbls[s.name]
+    elif s.name in fmts:
+        fmt = fmts[s.name]
+    if not fmt:
+        return s
+    return sdf.eager_convert(s, fmt, lgr)
+
+
+def old_find_na_synonyms(na_syns, df):
+    return df.applymap(
+        lambda x: np.nan if
+        (x.lower() in na_syns if type(x) == str else False)
+        else x)
+
+
+def old_munge_df(df, r, lbls, facets, qids, na_syns, col_fn, fmts, fpc=False, lgr=sdf.logger):
+    # munge_df as it was before labelling on category codes
+    year = r['year']
+    facets = {r[k]: k for k in facets}
+    if not qids:
+        qids = list(set(lbls.keys()).difference(
+                    [r['sitecode'], r['year'], r['weight'], r['psu'], r['strata']] +
+                    [k for k in facets]))
+    ncols = {k: k.lower() for k in list(df.columns)}
+    ndf = (df.rename(index=str, columns=ncols)
+           .pipe(lambda xdf: sdf.filter_columns(xdf, facets, qids))
+           .reset_index(drop=True)
+           .apply(lambda x: old_eager_convert_categorical(x, lbls, fmts, lgr))
+           .rename(index=str, columns=facets)
+           .pipe(curry(old_find_na_synonyms)(na_syns))
+           .reset_index(drop=True)
+           .assign(year=int(year) if type(year) == int else df[year].astype(int),
+                   sitecode=df[r['sitecode']].apply(
+                       OLD_SITECODE_TRANSLATORS[r['sitecode_type']]).astype('category'),
+                   weight=df[r['weight']].astype(float),
+                   strata=df[r['strata']].astype(int),
+                   psu=df[r['psu']].astype(int))
+           .reset_index(drop=True))
+    if fpc:
+        ndf = (ndf.assign(fpc=df[r['fpc']].astype(float),
+                          sample_ct=df[r['sample_ct']].astype(int))
+                  .reset_index(drop=True))
+    ndf.columns = list(map(pdutil.undash, list(ndf.columns)))
+    return ndf
+
+
+def best_of(n, fn, *args, **kwargs):
+    times = []
+    for _ in range(n):
+        start = timer()
+        res = fn(*args, **kwargs)
+        times.append(timer() - start)
+    return min(times), res
+
+
+@click.command()
+@click.argument('data_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('-c', '--config', type=click.Path(exists=True, dir_okay=False),
+              default=os.path.join('config', 'data', 'brfss.yaml'),
+              help='dataset config naming the year\'s files, default: config/data/brfss.yaml')
+@click.option('-y', '--year', type=click.INT, default=2015,
+              help='survey year to munge, default: 2015')
+@click.option('-n', '--repeat', type=click.IntRange(min=1), default=3,
+              help='runs of each pipeline, the best is reported, default: 3')
+def main(data_dir, config, year, repeat):
+    cfg = DatasetConfig.from_yaml(config)
+    g = cfg.surveys
+    rows = g.meta[g.meta.year == year]
+    if rows.empty:
+        raise click.BadParameter('no year %d in %s' % (year, config), param_hint='--year')
+    r = rows.iloc[0]
+    path = curry(os.path.join)(data_dir)
+    evalr = asteval.Interpreter()
+    evalr.symtable['pd.util'] = pd.util
+    start = timer()
+    lbls = load_variable_labels(path(r.format), path(r.formas), repl=g.replace_labels)
+    df = load_sas_xport_df(path(r.xpt_zip if os.path.isfile(path(r.xpt_zip)) else r.xpt))
+    click.echo('read %s year %d, %d rows x %d columns in %.2fs' %
+               (cfg.id, year, df.shape[0], df.shape[1], timer() - start))
+    args = dict(r=r, lbls=lbls, facets=cfg.facets, qids=g.qids,
+                na_syns=g.na_synonyms, col_fn=evalr(g.rename_cols),
+                fmts=g.patch_format, fpc=g.fpc)
+    (told, old) = best_of(repeat, old_munge_df, df, **args)
+    (tnew, new) = best_of(repeat, sdf.munge_df, df, **args)
+    (tfo, fo) = best_of(repeat, df[r['sitecode']].apply, OLD_SITECODE_TRANSLATORS[r.sitecode_type])
+    (tfn, fn) = best_of(repeat, sdf.SITECODE_TRANSLATORS[r.sitecode_type], df[r['sitecode']])
+    # labelled columns come back as plain values now, like the old applymap
+    pt.assert_frame_equal(old, new, check_dtype=False, check_categorical=False)
+    pt.assert_series_equal(fo, fn, check_dtype=False)
+    click.echo('munge_df:  %.2fs -> %.2fs, %.1fx' % (told, tnew, told / tnew))
+    click.echo('sitecodes: %.2fs -> %.2fs, %.1fx' % (tfo, tfn, tfo / tfn))
+
+
+if __name__ == '__main__':
+    main()
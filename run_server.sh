@@ -1 +1 @@
-survey_stats serve --threads 1 -F --max-requests 11 --port 7778
+survey_stats serve --threads 1 -F --max-requests 11 --port 7778 -W unix:/tmp/statsworker.sock
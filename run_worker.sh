@@ -1 +1 @@
-survey_stats work --threads 1 --max-requests 7 -F -s unix:/tmp/statsworker.sock
+survey_stats work --threads 1 --max-requests 7 -F -b unix:/tmp/statsworker.sock
@@ -1,30 +1,45 @@
 import pandas as pd
-import sqlalchemy as sa
-import blaze as bz
-import requests as rq
-from cytoolz.itertoolz import concatv
-from cytoolz.dicttoolz import assoc, valmap
+from cytoolz.itertoolz import concatv, concat, partition_all
+from cytoolz.dicttoolz import assoc, valmap, merge
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import json, stream, raw
 from sanic.config import Config
 from sanic.exceptions import (
     SanicException, ServerError, NotFound, InvalidUsage, RequestTimeout
 )
 from survey_stats import log
 from survey_stats import state as st
+from survey_stats import pdutil as u
+from survey_stats.cube import stats_cube
+from survey_stats.balancer import WorkerBalancer, slice_cost
+from survey_stats.monitor import StatusMonitor
+from survey_stats.transport import WorkerTransport
+from survey_stats.encoding import negotiate, encode_frame
+from survey_stats.socindex import slice_levels
+from survey_stats.jobs import JobQueue
+from survey_stats.localpool import LocalStatsPool
+from survey_stats.singleflight import SingleFlight
+from survey_stats.slicecache import slice_key, norm_filter
 from survey_stats.const import MAX_CONCURRENT_REQ, DEFAULT_SANIC_RESPONSE_TIMEOUT, DEFAULT_HTTP_RESPONSE_TIMEOUT
+from survey_stats.const import DEFAULT_BATCH_SIZE
+from survey_stats.const import NDJSON_MIMETYPE, SSE_MIMETYPE, DEFAULT_WORKER_KEEPALIVE
+from survey_stats.const import HTTP_CACHE_CONTROL, SOCRATA_INLINE_ROWS
 import ujson as uj
 import json as j
 import asyncio
 import aiohttp
 import ujson
 import traceback
+import hashlib
+from timeit import default_timer as timer
 
 
 app = Sanic(__name__)
 logger = log.getLogger()
 sem = None
 headers = {'content-type': 'application/json'}
+query_flights = SingleFlight('queries')
+slice_flights = SingleFlight('slices')
 app.static('/favicon.ico', './static/favicon.ico')
 
 
@@ -39,37 +54,125 @@ class SurveyError(InvalidUsage):
 @app.listener('before_server_start')
 def init(sanic, loop):
     global sem
-    sem = asyncio.Semaphore(MAX_CONCURRENT_REQ, loop=loop)
+    sem = asyncio.Semaphore(app.config.worker_conns, loop=loop)
+    if app.config.local_workers > 0:
+        # one pool per server process, pools do not survive a fork
+        app.config.pool = LocalStatsPool(app.config.local_workers, app.config.dbc,
+                                         app.config.cache, app.config.use_feather,
+                                         app.config.dsets, app.config.budget_mb)
+        app.config.pool.warm()
+    # worker connections are kept and reused for the life of the server
+    app.config.transport = WorkerTransport(app.config.worker_conns,
+                                           keepalive_timeout=app.config.worker_keepalive)
+    app.config.monitor = StatusMonitor(app.config.dbc, app.config.get('balancer'))
+    app.config.monitor_task = loop.create_task(app.config.monitor.run(app.config.transport))
+
+
+@app.listener('after_server_stop')
+async def stop_pool(sanic, loop):
+    if app.config.get('pool') is not None:
+        app.config.pool.shutdown()
+    if app.config.get('monitor_task') is not None:
+        app.config.monitor_task.cancel()
+    if app.config.get('transport') is not None:
+        await app.config.transport.close()
+
+
+async def bound_fetch(batch):
+    # send a batch to the worker with the least outstanding work, moving
+    # it to another worker when the request itself fails
+    balancer = app.config.balancer
+    cost = sum(map(slice_cost, batch))
+    err = None
+    async with sem:
+        for attempt in range(len(balancer.workers)):
+            w = balancer.acquire(cost)
+            start = timer()
+            try:
+                results = await post_batch(w.url, batch)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                balancer.release(w, cost, ok=False)
+                err = e
+                continue
+            except Exception:
+                balancer.release(w, cost)
+                raise
+            balancer.release(w, cost, timer() - start)
+            return results
+    raise ServerError('No stats worker could compute the batch: %s' % err)
+
+
+async def post_batch(url, batch):
+    # post a batch of slices and read each slice's result as it streams back
+    results = [None] * len(batch)
+    async with app.config.transport.post(url, '/stats/batch', json=batch, headers=headers,
+                                         timeout=DEFAULT_HTTP_RESPONSE_TIMEOUT) as response:
+        logger.info('submitting async batch request', url=response.url, n=len(batch))
+        buf = b''
+        # split lines ourselves, results can exceed readline's limit
+        async for chunk in response.content.iter_any():
+            lines = (buf + chunk).split(b'\n')
+            buf = lines.pop()
+            for line in filter(None, lines):
+                res = ujson.loads(line)
+                if 'error' in res:
+                    raise ServerError(res['error'])
+                results[res['i']] = res['result']
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        # the worker died or was killed mid-batch, so try another one
+        raise aiohttp.ClientPayloadError(
+            'Batch response from %s ended without %d of %d results' %
+            (url, len(missing), len(batch)))
+    return results
+
+
+async def fetch_all(slices, batch_size=DEFAULT_BATCH_SIZE):
+    tasks = []
+    for batch in partition_all(batch_size, slices):
+        logger.info(n=len(batch))
+        task = asyncio.ensure_future(bound_fetch(list(batch)))
+        tasks.append(task)
 
+    responses = await asyncio.gather(*tasks)
+    return list(concat(responses))
 
-async def bound_fetch(url, data, session):
-    async with sem, session.post(url, json=data, headers=headers, timeout=DEFAULT_HTTP_RESPONSE_TIMEOUT) as response:
-        logger.info('submitting async post request', url=response.url, data=data)
-        return await response.json()
 
+async def local_batch(batch):
+    dfs = await asyncio.wrap_future(app.config.pool.submit(batch))
+    return [u.fill_none(df).to_dict(orient='records') for df in dfs]
 
-async def fetch_all(slices, worker_url):
-    conn = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQ)
-    rqurl = worker_url + '/stats'
-    tasks = []
-    # Create client session that will ensure we dont open new connection
-    # per each request.
-    async with aiohttp.ClientSession(connector=conn, json_serialize=ujson.dumps) as session:
-        for s in slices:
-            logger.info(sl=s, url=rqurl)
-            # pass Semaphore and session to every GET request
-            task = asyncio.ensure_future(bound_fetch(rqurl, s, session))
-            tasks.append(task)
 
-        responses = await asyncio.gather(*tasks)
-        return [r for r in responses]
+async def fetch_local(slices, batch_size=DEFAULT_BATCH_SIZE):
+    tasks = [local_batch(list(batch)) for batch in partition_all(batch_size, slices)]
+    responses = await asyncio.gather(*tasks)
+    return list(concat(responses))
 
 
-async def fetch_socrata(qn, resp, vars, filt, meta):
-    precomp = meta.fetch_dash(qn, resp, vars, filt)
-    precomp = pd.DataFrame(precomp).fillna(None)
-    precomp['method'] = 'socrata'
-    return precomp.to_dict(orient='record')
+async def iter_slices(slices, batch_size=DEFAULT_BATCH_SIZE):
+    # results of each slice, batch by batch in the order batches complete
+    fetch = local_batch if app.config.local_workers > 0 else bound_fetch
+    tasks = [asyncio.ensure_future(fetch(list(batch)))
+             for batch in partition_all(batch_size, slices)]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            for res in await fut:
+                yield res
+    finally:
+        # the client went away or a batch failed
+        for t in tasks:
+            t.cancel()
+
+
+async def fetch_socrata(d, qn, vars, filt):
+    # index lookups are quick, only big scans leave the event loop
+    if d.socindex.span(qn, vars, filt) <= SOCRATA_INLINE_ROWS:
+        res = d.fetch_socrata(qn, vars, filt)
+    else:
+        loop = asyncio.get_event_loop()
+        res = await loop.run_in_executor(None, d.fetch_socrata, qn, vars, filt)
+    res['method'] = 'socrata'
+    return res
 
 
 @app.exception(NotFound, ServerError, InvalidUsage, RequestTimeout, Exception)
@@ -82,26 +185,66 @@ def json_404s(request, exception):
 
 @app.route("/")
 async def check_status(req):
-    # verify that the upstream services are functional
-    engine = sa.create_engine(app.config.dbc.uri)
-    db = bz.data(engine)
-    dbinfo = {'host': db.data.engine.url.host,
-              'engine': db.data.engine.name,
-              'tables': db.fields,
-              'config': app.config.dbc}
-    r = None
-    wrkinfo = None
-    try:
-        r = rq.get(app.config.stats_svc)
-        wrkinfo = r.json()
-        r = {'error': None, 'data': None}
-    except Exception as e:
-        raise ServerError(str(e))
+    # upstream status as of the monitor's last check
+    status = app.config.monitor.info()
+    if status['worker_status'] and all('error' in v for v in status['worker_status'].values()):
+        raise ServerError('No stats worker is reachable: %s' % status['worker_status'])
     return json({'data':
-                 {'db': dbinfo,
-                  'worker_url': app.config.stats_svc,
-                  'worker_status': wrkinfo
-                  }})
+                 merge(status,
+                       {'worker_url': app.config.stats_svc,
+                        'transport': app.config.transport.info(),
+                        'coalescing': {'queries': query_flights.info(),
+                                       'slices': slice_flights.info()}})
+                 })
+
+
+@app.route("/ready")
+async def check_ready(req):
+    dsets = list(st.dset.keys()) if app.config.dsets is None else app.config.dsets
+    reasons = app.config.monitor.readiness(dsets, st.dset.warmed)
+    return json({'ready': not reasons, 'reasons': reasons},
+                status=503 if reasons else 200)
+
+
+def response_etag(req, d):
+    """
+    strong ETag of a response: the same dataset content, query, routing
+    of breakdowns to socrata and representation always give the same bytes
+    """
+    mimetype, coding = negotiate(req.headers.get('accept'),
+                                 req.headers.get('accept-encoding'))
+    key = (d.content_version, app.config.get('socrata_first'), req.path,
+           sorted(req.args.items()), mimetype, coding)
+    return '"%s"' % hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:24]
+
+
+def not_modified(req, etag):
+    # 304 for a matching If-None-Match, answered without touching the data
+    inm = req.headers.get('if-none-match')
+    if inm is None:
+        return None
+    tags = [t.strip() for t in inm.split(',')]
+    if '*' not in tags and etag not in tags and 'W/' + etag not in tags:
+        return None
+    return raw(b'', status=304, headers=cache_headers(etag))
+
+
+def cache_headers(etag):
+    return {'ETag': etag, 'Cache-Control': HTTP_CACHE_CONTROL,
+            'Vary': 'Accept, Accept-Encoding'}
+
+
+def binary_response(req, frame, meta):
+    # Arrow or msgpack of frame() for clients that ask for them, None for JSON
+    mimetype, coding = negotiate(req.headers.get('accept'),
+                                 req.headers.get('accept-encoding'))
+    if mimetype is None:
+        return None
+    headers = {}
+    if coding is not None:
+        headers['Content-Encoding'] = coding
+    return raw(encode_frame(frame(), mimetype, coding, meta),
+               content_type=mimetype, headers=headers)
 
 
 @app.route("/questions")
@@ -109,8 +252,17 @@ async def fetch_questions(req):
     dset = req.args.get('d')
     try:
         d = st.dset[dset]
-        return json({'facets': d.meta.facet_map,
-                     'questions': d.meta.questions})
+        etag = response_etag(req, d)
+        res = not_modified(req, etag)
+        if res is not None:
+            return res
+        res = binary_response(req, lambda: d.meta.questions_frame,
+                              {'facets': d.meta.facet_map})
+        if res is None:
+            res = json({'facets': d.meta.facet_map,
+                        'questions': d.meta.questions})
+        res.headers.update(cache_headers(etag))
+        return res
     except Exception as e:
         raise ServerError(str(e))
 
@@ -124,84 +276,328 @@ def parse_filter(f):
                     f.split('|')))
 
 
+def cube_lookup(d, qn, vars, filt):
+    # answer from the precomputed cube when it holds the query
+    cube = stats_cube(d.dsid, app.config.cache, d.stats_version, tuple(d.meta.vars))
+    cached = cube.lookup(qn, vars, filt)
+    if cached is not None:
+        logger.info('answering from stats cube', d=d.dsid, q=qn, vs=vars, f=filt)
+    return cached
+
+
+def with_method(rows, method):
+    return [assoc(r, 'method', method) for r in rows]
+
+
+def plan_slices(d, qn, vars, filt):
+    """
+    the slices of a query, split into results for the breakdowns the
+    socrata table publishes and the slices left for the workers
+    """
+    slices = d.generate_slices(qn, vars, dict(filt))
+    if not (app.config.socrata_first and d.meta.has_socrata):
+        return [], slices
+    idx = d.socindex
+    if idx.responses(qn) != set(d.plan.responses.get(qn, [])):
+        # the table must answer with the same response levels as workers
+        return [], slices
+    levels, rest = [], []
+    for s in slices:
+        if idx.covers(qn, s['vs'], filt, s.get('rollup', False)):
+            for lv in slice_levels(s['vs'], s.get('rollup', False)):
+                if lv not in levels:
+                    levels.append(lv)
+        else:
+            rest.append(s)
+    logger.info('routing slices', d=d.dsid, q=qn, socrata=levels, workers=len(rest))
+    return ([with_method(idx.level_stats(qn, lv, filt).to_dict(orient='records'), 'socrata')
+             for lv in levels], rest)
+
+
 async def fetch_stats(dset, qn, vars, filt):
     d = st.dset[dset]
-    slices = d.generate_slices(qn, vars, filt)
-    return await fetch_all(slices, app.config.stats_svc)
+    cached = cube_lookup(d, qn, vars, filt)
+    if cached is not None:
+        return [with_method(cached, 'surveys')]
+    soc, slices = plan_slices(d, qn, vars, filt)
+    if not slices:
+        return soc
+    if app.config.coalesce_slices:
+        res = await fetch_slices_coalesced(d, slices)
+    else:
+        res = await dispatch_slices(slices)
+    return soc + [with_method(r, 'surveys') for r in res]
+
+
+async def dispatch_slices(slices):
+    if app.config.local_workers > 0:
+        return await fetch_local(slices, app.config.batch_size)
+    return await fetch_all(slices, app.config.batch_size)
+
+
+async def fetch_slices_coalesced(d, slices):
+    # send only the slices no other request has in flight, and wait
+    # for the rest to be answered for the request computing them
+    keys = [slice_key(s['d'], d.stats_version, s['q'], s['r'], s['vs'], s['f'],
+                      s.get('rollup', False)) for s in slices]
+    joined, owned = slice_flights.claim(keys)
+    todo = dict((k, s) for k, s in zip(keys, slices) if k in owned)
+    try:
+        res = await dispatch_slices(list(todo.values()))
+    except BaseException as e:
+        # a cancelled request too, or its joiners would wait forever
+        slice_flights.resolve(owned, error=e)
+        raise
+    slice_flights.resolve(owned, dict(zip(todo.keys(), res)))
+    futs = merge(joined, owned)
+    return [await asyncio.shield(futs[k]) for k in keys]
 
 
-@app.route('/stats')
-async def fetch_survey_stats(req):
+async def iter_stats(dset, qn, vars, filt):
+    d = st.dset[dset]
+    cached = cube_lookup(d, qn, vars, filt)
+    if cached is not None:
+        yield with_method(cached, 'surveys')
+        return
+    soc, slices = plan_slices(d, qn, vars, filt)
+    for res in soc:
+        yield res
+    async for res in iter_slices(slices, app.config.batch_size):
+        yield with_method(res, 'surveys')
+
+
+def query_flight_key(dset, qn, vars, filt):
+    return (dset, qn, tuple(vars), repr(norm_filter(filt)))
+
+
+def fill_totals(row, vars):
+    # rows aggregated over a var report it as Total
+    for v in vars:
+        if row.get(v) is None:
+            row = assoc(row, v, 'Total')
+    return row
+
+
+def stream_format(req):
+    # ?stream=ndjson|sse, or the matching Accept header
+    fmt = req.args.get('stream')
+    if fmt is not None:
+        if fmt not in ['ndjson', 'sse']:
+            raise SurveyError('Unknown stream format: %s' % fmt,
+                              info={'stream': ['ndjson', 'sse']})
+        return fmt
+    accept = req.headers.get('accept', '')
+    if NDJSON_MIMETYPE in accept:
+        return 'ndjson'
+    if SSE_MIMETYPE in accept:
+        return 'sse'
+    return None
+
+
+def encode_event(fmt, event, data):
+    if fmt == 'sse':
+        return 'event: %s\ndata: %s\n\n' % (event, ujson.dumps(data))
+    return ujson.dumps(data if event == 'rows' else {event: data}) + '\n'
+
+
+async def aiter_one(x):
+    yield x
+
+
+def stream_stats(fmt, d, qn, vars, filt, use_socrata):
+    """
+    a response that sends the query first, then the rows of each slice
+    as soon as its batch completes (one row per line for ndjson, one
+    event per slice for sse), and ends with an error or end record
+    """
+    async def write_stats(response):
+        response.write(encode_event(fmt, 'query', {'q': qn, 'filter': filt,
+                                                   'question': qn, 'vars': vars}))
+        try:
+            if use_socrata:
+                results = aiter_one((await fetch_socrata(d, qn, vars, filt))
+                                    .to_dict(orient='records'))
+            else:
+                results = iter_stats(d.dsid, qn, vars, filt)
+            async for rows in results:
+                if not use_socrata:
+                    rows = [fill_totals(r, vars) for r in rows]
+                if fmt == 'sse':
+                    response.write(encode_event(fmt, 'rows', rows))
+                else:
+                    response.write(''.join(encode_event(fmt, 'rows', r) for r in rows))
+        except Exception as e:
+            logger.info('error while streaming stats', d=d.dsid, q=qn, error=str(e))
+            response.write(encode_event(fmt, 'error', str(e)))
+            return
+        response.write(encode_event(fmt, 'end', None))
+    return stream(write_stats, content_type=(SSE_MIMETYPE if fmt == 'sse'
+                                             else NDJSON_MIMETYPE))
+
+
+def parse_query(args):
+    # the dataset, question, vars and filter of a stats query, checked
+    # against the dataset's plan
     try:
-        dset = req.args.get('d')
+        dset = args.get('d')
     except KeyError as e:
         raise SurveyError(str(e),
                            info={'datasets': list(dset.keys())})
     d = st.dset[dset]
-    qs = d.meta.qns
     fs = d.meta.facet_map
-    qn = req.args.get('q')
-    if qs.qid.eq(qn).sum() == 0:
+    plan = d.plan
+    qn = args.get('q')
+    if not plan.has_qid(qn):
         raise SurveyError("Cannot find qid: %s in dataset: %s" % (qn, dset),
-                           info={'questions': set(qs.qid)})
-    vars = [] if 'v' not in req.args else req.args.get('v').split(',')
+                           info={'questions': sorted(plan.qids)})
+    vars = [] if 'v' not in args else args.get('v').split(',')
     for v in vars:
         if not v in d.meta.vars:
             raise SurveyError("Cannot find var facet v: %s in dataset: %s" % (v, dset),
                                info={'facets': fs})
-    filt = {} if 'f' not in req.args else parse_filter(req.args.get('f'))
+    filt = {} if 'f' not in args else parse_filter(args.get('f'))
     for k, vals in filt.items():
         if not k in fs:
             raise SurveyError("Cannot find filter facet: %s in dataset: %s" % (k, dset),
                                info={'facets': fs})
         for v in vals:
-            typ = type(fs[k][0])
-            if not typ(v) in fs[k]:
+            if not plan.has_level(k, v):
                 raise SurveyError("Cannot find value: %s for filter facet: %s in dataset: %s" % (v, k, dset),
                                    info={'facets': fs})
+    return dset, d, qn, vars, filt
 
+
+@app.route('/stats')
+async def fetch_survey_stats(req):
+    dset, d, qn, vars, filt = parse_query(req.args)
+    fs = d.meta.facet_map
     use_socrata = False if 's' not in req.args else not 0 ** int(req.args.get('s'), 2)
     if use_socrata and not d.meta.has_socrata:
         raise SurveyError("Socrata pre-computed data not available for dataset: %s" % dset, info={'facets': fs})
     if not use_socrata and not d.meta.has_surveys:
         raise SurveyError("Surveys data not available for dataset: %s" % dset, info={'facets': fs})
 
+    fmt = stream_format(req)
+    if fmt is not None:
+        # streamed queries are not coalesced, each gets its own slices
+        return stream_stats(fmt, d, qn, vars, filt, use_socrata)
+    etag = response_etag(req, d)
+    res = not_modified(req, etag)
+    if res is not None:
+        return res
+
     question = qn  # meta.qnmeta[qn]
     results = None  # fetch_socrata(qn, resp, vars, filt, national, meta)
     error = None
     try:
         if not use_socrata:
-            results = await fetch_stats(dset, qn, vars, filt)
-            results = concatv(*results)
-            for v in vars:
-                results = map(lambda d: d if v in d else assoc(d, v, 'Total'), results)
+            if app.config.coalesce:
+                # identical concurrent queries share one computation
+                results = await query_flights.do(
+                    query_flight_key(dset, qn, vars, filt),
+                    lambda: fetch_stats(dset, qn, vars, dict(filt)))
+            else:
+                results = await fetch_stats(dset, qn, vars, filt)
+            results = [fill_totals(r, vars) for r in concatv(*results)]
         else:
-            results = d.fetch_socrata(qn, vars, filt)
-            results = results.to_dict(orient='records')
+            results = await fetch_socrata(d, qn, vars, filt)
     except Exception as e:
         raise ServerError(e)
-    # logger.info('dumping result', res=results)
-    return json({
+    meta = {
         'error': error,
         'q': qn,
         'filter': filt,
         'question': question,
-        'vars': vars,
-        'results': results
-    })
-
-
-def setup_app(dbc, cache_dir, stats_svc, sanic_timeout, use_feather):
+        'vars': vars
+    }
+    res = binary_response(req, lambda: (results if isinstance(results, pd.DataFrame)
+                                        else pd.DataFrame(results)), meta)
+    if res is None:
+        if isinstance(results, pd.DataFrame):
+            results = results.to_dict(orient='records')
+        # logger.info('dumping result', res=results)
+        res = json(merge(meta, {'results': results}))
+    res.headers.update(cache_headers(etag))
+    return res
+
+
+@app.route('/jobs', methods=['POST'])
+async def submit_job(req):
+    """
+    queue the slices of a /stats query, given as a JSON body with the
+    same d, q, v and f parameters and a priority queue, for the queue
+    workers; breakdowns the socrata table or the cube hold are ready at once
+    """
+    jobs = app.config.get('jobs')
+    if jobs is None:
+        raise NotFound('No job queue configured')
+    args = req.json or {}
+    dset, d, qn, vars, filt = parse_query(args)
+    if not d.meta.has_surveys:
+        raise SurveyError("Surveys data not available for dataset: %s" % dset,
+                          info={'facets': d.meta.facet_map})
+    cached = cube_lookup(d, qn, vars, filt)
+    if cached is not None:
+        ready, slices = [with_method(cached, 'surveys')], []
+    else:
+        ready, slices = plan_slices(d, qn, vars, filt)
+    query = {'d': dset, 'q': qn, 'vars': vars, 'filter': filt}
+    loop = asyncio.get_event_loop()
+    try:
+        job_id = await loop.run_in_executor(None, jobs.enqueue, query, slices,
+                                            args.get('priority'), ready)
+    except ValueError as e:
+        raise SurveyError(str(e), info={'priorities': jobs.queues})
+    return json({'id': job_id, 'status': '/jobs/%s' % job_id}, status=202)
+
+
+@app.route('/jobs/<job_id>')
+async def job_status(req, job_id):
+    # progress, and the results of the slices computed so far
+    jobs = app.config.get('jobs')
+    if jobs is None:
+        raise NotFound('No job queue configured')
+    loop = asyncio.get_event_loop()
+    res = await loop.run_in_executor(None, jobs.status, job_id)
+    if res is None:
+        raise NotFound('Cannot find job: %s' % job_id)
+    vars = res['query']['vars']
+    res['results'] = [fill_totals(merge({'method': 'surveys'}, r), vars)
+                      for r in concatv(*res['results'])]
+    return json(res)
+
+
+def setup_app(dbc, cache_dir, stats_svc, sanic_timeout, use_feather,
+              dsets=None, budget_mb=0, batch_size=DEFAULT_BATCH_SIZE,
+              local_workers=0, coalesce=True, coalesce_slices=False,
+              worker_conns=MAX_CONCURRENT_REQ, worker_keepalive=DEFAULT_WORKER_KEEPALIVE,
+              keep_alive=False, socrata_first=False, jobs_url=None):
     app.config.dbc = dbc
+    app.config.jobs = JobQueue(jobs_url) if jobs_url else None
+    app.config.socrata_first = socrata_first
+    app.config.worker_conns = worker_conns
+    app.config.worker_keepalive = worker_keepalive
+    app.config.coalesce = coalesce
+    app.config.coalesce_slices = coalesce_slices
+    app.config.batch_size = batch_size
+    app.config.local_workers = local_workers
+    app.config.dsets = dsets
+    app.config.budget_mb = budget_mb
     app.config.cache = cache_dir
     app.config.stats_svc = stats_svc
+    if local_workers == 0:
+        app.config.balancer = WorkerBalancer(stats_svc)
+        if not app.config.balancer.workers:
+            raise ValueError('No stats workers in %r, give worker urls or a ' % stats_svc +
+                             'file listing them, or use local workers')
     app.config.sanic_timeout = sanic_timeout
     app.config.use_feather = use_feather
     Config.RESPONSE_TIMEOUT = DEFAULT_SANIC_RESPONSE_TIMEOUT
     Config.REQUEST_TIMEOUT = sanic_timeout
-    Config.KEEP_ALIVE = False
+    Config.KEEP_ALIVE = keep_alive
     logger.info('initializing state', dbc=dbc, cdir=cache_dir, f=use_feather)
-    st.initialize(dbc, cache_dir, init_des=False, use_feather=use_feather, init_svy=True, init_soc=True)
+    st.initialize(dbc, cache_dir, init_des=False, use_feather=use_feather, init_svy=False, init_soc=True,
+                  init_plan=True, preload=dsets, budget_mb=budget_mb)
     return app
 
 
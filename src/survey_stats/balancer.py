@@ -0,0 +1,149 @@
+import os
+import asyncio
+from timeit import default_timer as timer
+from survey_stats import log
+from survey_stats.const import FILTER_VALUE_COST, WORKER_EJECT_SECS, MAX_WORKER_EJECT_SECS
+from survey_stats.const import WORKER_LATENCY_FACTOR, LATENCY_EWMA_ALPHA, HEALTH_CHECK_TIMEOUT
+
+logger = log.getLogger(__name__)
+
+
+def slice_cost(s):
+    """
+    rough relative cost of computing a slice: each breakout var adds a
+    dimension to every table, rollups compute a table per subset of the
+    vars, and each filter value adds a pass over the facet index
+    """
+    nv = len(s['vs'])
+    tables = 2 ** nv if s.get('rollup') else 1
+    return tables * (1 + nv) + FILTER_VALUE_COST * sum(len(v) for v in s['f'].values())
+
+
+def parse_workers(spec):
+    """
+    worker urls from a comma separated list, or from a discovery file
+    with one url per line when spec names an existing file
+    """
+    if os.path.isfile(spec):
+        with open(spec) as fh:
+            urls = [l.strip() for l in fh if l.strip() and not l.startswith('#')]
+    else:
+        urls = [u.strip() for u in spec.split(',') if u.strip()]
+    return [u.rstrip('/') for u in urls]
+
+
+class Worker(object):
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0.0
+        self.latency = None  # ewma of seconds per unit of cost
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def available(self, now):
+        return self.ejected_until <= now
+
+    def info(self, now):
+        return {'url': self.url, 'outstanding': self.outstanding,
+                'latency': self.latency, 'failures': self.failures,
+                'ejected_for': max(self.ejected_until - now, 0.0)}
+
+
+class WorkerBalancer(object):
+    """
+    Schedules slice batches onto the stats worker with the least
+    outstanding estimated cost. A worker is ejected for a while after a
+    failed request or health check, or when its latency per unit of cost
+    is far above the others, and rejoins once its ejection expires.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.mtime = None
+        self.workers = {}
+        self.refresh()
+
+    def refresh(self):
+        # pick up workers added to or removed from a discovery file
+        if os.path.isfile(self.spec):
+            mtime = os.path.getmtime(self.spec)
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+        elif self.workers:
+            return
+        urls = parse_workers(self.spec)
+        if not urls:
+            logger.warn('no stats workers found, keeping current', spec=self.spec)
+            return
+        self.workers = {u: self.workers.get(u) or Worker(u) for u in urls}
+        logger.info('configured stats workers', workers=urls)
+
+    def acquire(self, cost):
+        now = timer()
+        live = [w for w in self.workers.values() if w.available(now)]
+        # with every worker ejected, still try the one due back first
+        w = min(live or sorted(self.workers.values(), key=lambda w: w.ejected_until)[:1],
+                key=lambda w: w.outstanding)
+        w.outstanding += cost
+        return w
+
+    def release(self, w, cost, elapsed=None, ok=True):
+        w.outstanding = max(w.outstanding - cost, 0.0)
+        if not ok:
+            self.eject(w, 'request failed')
+            return
+        w.failures = 0
+        if elapsed is not None and cost > 0:
+            rate = elapsed / cost
+            w.latency = rate if w.latency is None else \
+                LATENCY_EWMA_ALPHA * rate + (1 - LATENCY_EWMA_ALPHA) * w.latency
+            self.check_latency(w)
+
+    def check_latency(self, w):
+        others = [o.latency for o in self.workers.values()
+                  if o is not w and o.latency is not None and o.available(timer())]
+        if not others:
+            return
+        others = sorted(others)
+        median = others[len(others) // 2]
+        if w.latency > WORKER_LATENCY_FACTOR * median:
+            self.eject(w, 'latency', latency=w.latency, median=median)
+            # start over when it rejoins
+            w.latency = None
+
+    def eject(self, w, reason, **kwargs):
+        w.failures += 1
+        secs = min(WORKER_EJECT_SECS * 2 ** (w.failures - 1), MAX_WORKER_EJECT_SECS)
+        w.ejected_until = timer() + secs
+        logger.warn('ejecting stats worker', url=w.url, reason=reason,
+                    failures=w.failures, secs=secs, **kwargs)
+
+    async def check_health(self, transport):
+        """
+        poll the status route of every worker, returning each worker's
+        status, or the error that got it ejected
+        """
+        async def check(w):
+            start = timer()
+            try:
+                async with transport.get(w.url, '/', timeout=HEALTH_CHECK_TIMEOUT) as r:
+                    r.raise_for_status()
+                    status = await r.json()
+            except Exception as e:
+                logger.info('stats worker health check failed', url=w.url, err=str(e))
+                # an ejected worker that passes still waits out its ejection
+                self.eject(w, 'health check')
+                return {'error': str(e)}
+            # healthy again, so the next ejection starts short
+            w.failures = 0
+            return {'status': status, 'latency': timer() - start}
+        self.refresh()
+        workers = list(self.workers.values())
+        res = await asyncio.gather(*[check(w) for w in workers])
+        return {w.url: r for w, r in zip(workers, res)}
+
+    def info(self):
+        now = timer()
+        return [w.info(now) for w in self.workers.values()]
@@ -0,0 +1,67 @@
+import attr
+import numpy as np
+import pandas as pd
+from typing import Mapping
+from survey_stats import log
+
+logger = log.getLogger(__name__)
+
+
+def level_key(v):
+    # filter values arrive as strings, so key levels like R's %in%,
+    # which compares both sides as character
+    return str(v)
+
+
+@attr.s(slots=True, frozen=True)
+class FacetIndex(object):
+    """
+    Packed boolean row masks for every level of the indexed facets, so a
+    filter like {'sitecode': ['CA', 'NY'], 'year': ['2015']} is evaluated
+    by OR-ing level bitmaps within a facet and AND-ing across facets.
+    """
+    nrow: int = attr.ib()
+    bitmaps: Mapping[str, Mapping[str, np.ndarray]] = attr.ib()
+
+    @classmethod
+    def from_frame(cls, df, cols):
+        bitmaps = {}
+        for c in cols:
+            if c not in df.columns or c in bitmaps:
+                continue
+            col = df[c]
+            if col.dtype.name == 'category':
+                codes = col.cat.codes.values
+                lvls = list(col.cat.categories)
+            else:
+                codes, lvls = pd.factorize(col, sort=True)
+            bitmaps[c] = {level_key(l): np.packbits(codes == i)
+                          for i, l in enumerate(lvls)}
+        logger.info('built facet bitmaps', rows=df.shape[0],
+                    facets={k: len(v) for k, v in bitmaps.items()},
+                    nbytes=sum(b.nbytes for v in bitmaps.values()
+                               for b in v.values()))
+        return cls(nrow=df.shape[0], bitmaps=bitmaps)
+
+    def covers(self, filt):
+        return all(k in self.bitmaps for k in filt.keys())
+
+    def mask(self, filt):
+        """
+        boolean row mask for the filter, or None when it uses a column
+        that has not been indexed
+        """
+        if not self.covers(filt):
+            return None
+        nbytes = (self.nrow + 7) // 8
+        packed = np.full(nbytes, 0xFF, dtype=np.uint8)
+        for k, vals in filt.items():
+            lvls = self.bitmaps[k]
+            vals = vals if type(vals) in (list, set, tuple) else [vals]
+            anyof = np.zeros(nbytes, dtype=np.uint8)
+            for v in vals:
+                b = lvls.get(level_key(v))
+                if b is not None:
+                    anyof |= b
+            packed &= anyof
+        return np.unpackbits(packed)[:self.nrow].astype(bool)
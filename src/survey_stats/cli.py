@@ -2,6 +2,7 @@ import click
 import survey_stats
 from survey_stats.dbi import DatabaseConfig, DatabaseType
 import survey_stats.const as c
+from survey_stats import settings
 from survey_stats import log
 
 logger = log.getLogger('cli')
@@ -80,6 +81,21 @@ gunicorn_params = [
 ]
 
 
+registry_params = [
+    click.option('--datasets', type=click.STRING, envvar='SVY_DATASETS',
+                 help='comma separated datasets to load at startup, others ' +
+                      'load on first use, default: all'),
+    click.option('--dataset-budget-mb', type=click.IntRange(min=0),
+                 default=c.DEFAULT_DATASET_BUDGET_MB, envvar='SVY_DATASET_BUDGET_MB',
+                 help='evict least recently used datasets above this ' +
+                      'estimated memory, 0 for no limit, default: 0')
+]
+
+
+def parse_datasets(datasets):
+    return None if datasets is None else [d for d in datasets.split(',') if d]
+
+
 def add_options(options):
     def _add_options(func):
         for option in reversed(options):
@@ -93,7 +109,7 @@ def cli():
     click.echo('survey_stats %s' % survey_stats.__version__)
 
 
-@add_options(database_params+gunicorn_params)
+@add_options(database_params+gunicorn_params+registry_params)
 @click.option('-h', '--host', envvar='SVY_SERVER_HOST',
               default=c.DEFAULT_SVY_API_HOST,
               help='interface to bind API service, default: 0.0.0.0')
@@ -105,11 +121,47 @@ def cli():
 @click.option('--sanic-timeout', type=int,
               default=300, envvar='SANIC_REQUEST_TIMEOUT',
               help='sanic request timeout in seconds, default')
+@click.option('-B', '--batch-size', type=click.IntRange(min=1),
+              default=c.DEFAULT_BATCH_SIZE, envvar='SVY_BATCH_SIZE',
+              help='slices per worker batch request; a sync worker must ' +
+                   'compute the whole batch within its --timeout (default: ' +
+                   '%ds) or it is killed, so lower this for slow datasets, ' % c.DEFAULT_REQ_TIMEOUT +
+                   'default: %d' % c.DEFAULT_BATCH_SIZE)
+@click.option('--local-workers', type=click.IntRange(min=0, max=c.MAX_NUM_WORKERS),
+              default=0, envvar='SVY_LOCAL_WORKERS',
+              help='compute slices in a pool of this many local processes ' +
+                   'instead of the stats worker, default: 0 (use worker)')
+@click.option('--coalesce/--no-coalesce', default=True,
+              help='share one computation between identical concurrent ' +
+                   'stats queries, default: True')
+@click.option('--coalesce-slices/--no-coalesce-slices', default=False,
+              help='also share slices between partly overlapping ' +
+                   'concurrent queries, default: False')
+@click.option('--jobs-url', type=click.STRING, envvar='SVY_JOBS_URL',
+              help='redis url of the job queue behind /jobs, e.g. ' +
+                   '%s, served by survey_stats consume; ' % settings.REDIS_URL +
+                   'default: no job queue')
+@click.option('--socrata-first/--no-socrata-first', default=False,
+              help='answer survey slices the socrata table publishes from it, ' +
+                   'sending only the rest to workers, default: False')
+@click.option('--worker-conns', type=click.IntRange(min=1),
+              default=max(c.MAX_CONCURRENT_REQ, 1), envvar='SVY_WORKER_CONNS',
+              help='max concurrent connections to stats workers, ' +
+                   'default: %d' % max(c.MAX_CONCURRENT_REQ, 1))
+@click.option('--worker-keepalive', type=click.IntRange(min=0),
+              default=c.DEFAULT_WORKER_KEEPALIVE, envvar='SVY_WORKER_KEEPALIVE',
+              help='seconds to keep idle stats worker connections open, ' +
+                   '0 closes them after each request, default: %d' % c.DEFAULT_WORKER_KEEPALIVE)
+@click.option('--keep-alive/--no-keep-alive', default=False,
+              help='keep client connections to the API open, default: False')
 @click.option('-W', '--stats-worker', type=str,
-              default='http://localhost:7788',
-              help='stats worker uri, default: http://localhost:7788')
+              default='http://localhost:7788', envvar='SVY_STATS_WORKERS',
+              help='stats worker uris, comma separated, or a file listing ' +
+                   'one per line that is re-read as it changes; ' +
+                   'unix:/path/to.sock reaches a worker bound to a socket, ' +
+                   'default: http://localhost:7788')
 @cli.command()
-def serve(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password, db_name, feather, workers, threads, timeout, max_requests, max_requests_jitter, worker_connections, debug, stats_worker, sanic_timeout, data_url, port, host):
+def serve(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password, db_name, feather, workers, threads, timeout, max_requests, max_requests_jitter, worker_connections, debug, datasets, dataset_budget_mb, batch_size, local_workers, coalesce, coalesce_slices, jobs_url, socrata_first, worker_conns, worker_keepalive, keep_alive, stats_worker, sanic_timeout, data_url, port, host):
     from survey_stats.server import APIServer
     from survey_stats.api import setup_app
 
@@ -130,31 +182,60 @@ def serve(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password,
         stats_svc=stats_worker,
         cache_dir=cache_dir,
         sanic_timeout=sanic_timeout,
-        use_feather=feather)
+        use_feather=feather,
+        dsets=parse_datasets(datasets),
+        budget_mb=dataset_budget_mb,
+        batch_size=batch_size,
+        local_workers=local_workers,
+        coalesce=coalesce,
+        coalesce_slices=coalesce_slices,
+        worker_conns=worker_conns,
+        worker_keepalive=worker_keepalive,
+        keep_alive=keep_alive,
+        socrata_first=socrata_first,
+        jobs_url=jobs_url)
     return APIServer(app, options).run()
 
 
-@add_options(database_params+gunicorn_params)
+@add_options(database_params+gunicorn_params+registry_params)
 @click.option('-h', '--host', envvar='SVY_WORKER_HOST',
               default=c.DEFAULT_SVY_WORKER_HOST,
               help='interface to bind work service, default: 0.0.0.0')
 @click.option('-p', '--port', type=int, envvar='SVY_WORKER_PORT',
               default=c.DEFAULT_SVY_WORKER_PORT,
               help='port for worker service, default: 7788')
+@click.option('-b', '--bind', type=click.STRING, envvar='SVY_WORKER_BIND',
+              help='gunicorn address to bind instead of host and port, ' +
+                   'such as unix:/tmp/statsworker.sock')
+@click.option('--slice-cache-mb', type=click.IntRange(min=0),
+              default=c.DEFAULT_SLICE_CACHE_MB, envvar='SVY_SLICE_CACHE_MB',
+              help='in-memory slice result cache budget per worker, 0 disables, ' +
+                   'default: %d' % c.DEFAULT_SLICE_CACHE_MB)
+@click.option('--preload/--no-preload', default=False, envvar='SVY_WORKER_PRELOAD',
+              help='designs are always built in the master before workers ' +
+                   'fork; this also stops the forced python and R garbage ' +
+                   'collections so their pages stay shared copy-on-write, ' +
+                   'default: False')
+@click.option('--keepalive', type=click.IntRange(min=0), default=0,
+              help='seconds to hold idle API connections open, which needs ' +
+                   'threaded workers so stats run off the main thread; ' +
+                   'default: 0 (sync workers, close after each request)')
 @cli.command()
-def work(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password, db_name, feather, workers, threads, timeout, max_requests, max_requests_jitter, worker_connections, debug, port, host):
+def work(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password, db_name, feather, workers, threads, timeout, max_requests, max_requests_jitter, worker_connections, debug, datasets, dataset_budget_mb, slice_cache_mb, preload, keepalive, port, host, bind):
     from survey_stats.server import APIServer
-    from survey_stats.microservice import setup_app
+    from survey_stats.microservice import setup_app, log_worker_memory
 
     options = {
-        'bind': '%s:%s' % (host, str(port)),
+        'bind': bind or '%s:%s' % (host, str(port)),
         'umask': int('007', 8),
-        'worker_class': 'sync',
+        'worker_class': 'gthread' if keepalive > 0 else 'sync',
+        'keepalive': keepalive,
         'workers': workers,
         'max_requests': max_requests,
         'max_requests_jitter': max_requests_jitter,
         'worker_connections': worker_connections,
         'timeout': timeout,
+        'post_worker_init': log_worker_memory,
     }
     logger.info('setting up app', options=options, f=feather)
     app = setup_app(
@@ -163,16 +244,64 @@ def work(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password,
             db_user, db_password, db_name,
             db_config),
         cdir=cache_dir,
-        use_feather=feather)
+        use_feather=feather,
+        cache_mb=slice_cache_mb,
+        preload=preload,
+        dsets=parse_datasets(datasets),
+        budget_mb=dataset_budget_mb)
     APIServer(app, options).run()
 
 
+@add_options(database_params+registry_params)
+@click.option('-w', '--workers', type=c.CLICK_NUM_WORKERS, default=1,
+              help='queue worker processes, default: 1')
+@click.option('--jobs-url', type=click.STRING, envvar='SVY_JOBS_URL',
+              default=settings.REDIS_URL,
+              help='redis url of the job queue, default: %s' % settings.REDIS_URL)
+@click.option('--queues', type=click.STRING, default=','.join(settings.QUEUES),
+              help='comma separated queues, highest priority first, ' +
+                   'default: %s' % ','.join(settings.QUEUES))
+@click.option('--slice-cache-mb', type=click.IntRange(min=0),
+              default=c.DEFAULT_SLICE_CACHE_MB, envvar='SVY_SLICE_CACHE_MB',
+              help='in-memory slice result cache budget per worker, 0 disables, ' +
+                   'default: %d' % c.DEFAULT_SLICE_CACHE_MB)
+@cli.command()
+def consume(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password, db_name, feather, datasets, dataset_budget_mb, workers, jobs_url, queues, slice_cache_mb):
+    import multiprocessing as mp
+    from survey_stats.microservice import setup_app, consume_jobs
+
+    queues = [q for q in queues.split(',') if q]
+    setup_app(
+        dbc=resolve_db_args(
+            db_host, db_port, db_type,
+            db_user, db_password, db_name,
+            db_config),
+        cdir=cache_dir,
+        use_feather=feather,
+        cache_mb=slice_cache_mb,
+        preload=workers > 1,
+        dsets=parse_datasets(datasets),
+        budget_mb=dataset_budget_mb)
+    logger.info('starting queue workers', n=workers, url=jobs_url, queues=queues)
+    procs = [mp.Process(target=consume_jobs, args=(jobs_url, queues))
+             for _ in range(workers - 1)]
+    for p in procs:
+        p.start()
+    consume_jobs(jobs_url, queues)
+
+
 @add_options(database_params)
 @click.option('--parse-all/--no-parse-all', is_flag=True,
               help='parse all datasets')
+@click.option('-j', '--jobs', type=c.CLICK_NUM_WORKERS, default=1,
+              help='processes parsing survey years and datasets, default: 1')
+@click.option('--memory-limit', type=click.IntRange(min=0),
+              default=c.DEFAULT_ETL_MEMORY_MB, envvar='SVY_ETL_MEMORY_MB',
+              help='MB the parsing processes may use together, fewer run ' +
+                   'at once to stay under it, 0 for no limit, default: 0')
 @click.argument('datasets', type=click.STRING, nargs=-1)
 @cli.command()
-def parse(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password, db_name, feather, parse_all, datasets):
+def parse(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password, db_name, feather, parse_all, jobs, memory_limit, datasets):
     import survey_stats.etl.load as l
     l.load_datasets(
         cache_dir=cache_dir,
@@ -181,9 +310,38 @@ def parse(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password,
             db_user, db_password, db_name,
             db_config),
         dsets=datasets,
-        parse_all=parse_all)
+        parse_all=parse_all,
+        jobs=jobs,
+        memory_limit_mb=memory_limit)
 
 
+@add_options(database_params)
+@click.option('-j', '--jobs', type=c.CLICK_NUM_WORKERS,
+              default=c.DEFAULT_NUM_WORKERS,
+              help='processes computing slices, ' +
+                   'default: %d' % c.DEFAULT_NUM_WORKERS)
+@click.option('--max-vars', type=click.IntRange(min=0, max=3),
+              default=c.DEFAULT_CUBE_MAX_VARS,
+              help='max breakout facets per query, ' +
+                   'default: %d' % c.DEFAULT_CUBE_MAX_VARS)
+@click.option('--by-site/--no-by-site', default=True,
+              help='also precompute per-site filters, default: True')
+@click.option('--resume/--no-resume', default=True,
+              help='continue from the last checkpoint, default: True')
+@click.argument('datasets', type=click.STRING, nargs=-1)
+@cli.command()
+def precompute(cache_dir, db_config, db_host, db_port, db_type, db_user, db_password, db_name, feather, jobs, max_vars, by_site, resume, datasets):
+    import os
+    import survey_stats.cube as cube
+    dbc = resolve_db_args(db_host, db_port, db_type,
+                          db_user, db_password, db_name,
+                          db_config)
+    for d in datasets:
+        manifest = cube.precompute(os.path.join(c.DEFAULT_DATASET_CONFIG_DIR, d + '.yaml'),
+                                   cache_dir, jobs, dbc=dbc, use_feather=feather,
+                                   max_vars=max_vars, by_site=by_site, resume=resume)
+        logger.info('precomputed stats cube', d=d, questions=len(manifest['done']))
+
 
 def main(args=None):
     cli()
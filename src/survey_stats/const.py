@@ -19,6 +19,7 @@ STATS_COLUMNS = ['mean', 'ci_u', 'ci_l', 'se', 'count', 'sample_size']
 
 DBURI_FMT = '{dbtype}://{user}:{password}@{host}:{port}/{dbname}'
 DBTBL_FMT = '{dsid}_{part}'
+USE_DB_DESIGNS = False  # survey designs are built from feather, not db tables
 DSFILE_FMT = '{dsid}_{part}.{type}'
 
 DEFAULT_CACHE_DIR = 'cache'
@@ -47,5 +48,44 @@ CLICK_NUM_WORKERS = click.IntRange(min=1, max=MAX_NUM_WORKERS, clamp=True)
 CLICK_NUM_THREADS = click.IntRange(min=1, max=MAX_NUM_THREADS, clamp=True)
 CLICK_TIMEOUT = click.IntRange(min=1, max=60*10, clamp=True)
 
+DEFAULT_DATASET_CONFIG_DIR = 'config/data'
+DEFAULT_DATASET_BUDGET_MB = 0  # no limit
+
+DEFAULT_BATCH_SIZE = 32  # computed in one request, within the worker's timeout
+NDJSON_MIMETYPE = 'application/x-ndjson'
+SSE_MIMETYPE = 'text/event-stream'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+# responses carry an ETag, so caches may revalidate after this
+HTTP_CACHE_CONTROL = 'public, max-age=300'
+SOCRATA_INLINE_ROWS = 20000  # bigger socrata scans run in a thread
+
+FILTER_VALUE_COST = 0.25  # relative to a slice without vars or filters
+DEFAULT_WORKER_KEEPALIVE = 30  # seconds an idle worker connection is kept
+STATUS_CHECK_INTERVAL = 10  # also the worker health check interval
+HEALTH_CHECK_TIMEOUT = 5
+WORKER_EJECT_SECS = 15  # doubled for each consecutive failure
+MAX_WORKER_EJECT_SECS = 300
+WORKER_LATENCY_FACTOR = 4.0  # eject above this multiple of the median
+LATENCY_EWMA_ALPHA = 0.2
+
+DEFAULT_SLICE_CACHE_MB = 256
+DEFAULT_SLICE_DISK_MB = 2048
+SLICE_DISK_PRUNE_TO = 0.8  # of the cap, so pruning is not run on every put
+SLICE_CACHE_DB = 'slice_cache.sqlite'
+
+CUBE_DIR_FMT = '{dsid}_cube'
+CUBE_MANIFEST = 'manifest.json'
+DEFAULT_CUBE_MAX_VARS = 1
+CUBE_MANIFEST_RECHECK = 60  # seconds before a missing question is looked for again
+
 DEFAULT_SANIC_RESPONSE_TIMEOUT = 600 #Default max Sanic response timeout
 DEFAULT_HTTP_RESPONSE_TIMEOUT = 600 #Default max Sanic response timeout
+
+JOB_TTL = 60 * 60 * 24  # seconds a job and its results are kept
+JOB_POLL_TIMEOUT = 5  # seconds a queue worker blocks waiting for slices
+JOB_VISIBILITY_TIMEOUT = 60 * 30  # seconds a popped slice has before it is requeued
+
+SPILL_DIR_FMT = '{dsid}_years'  # munged years waiting to be merged
+SPILL_FILE_FMT = '{i}_{digest}.pkl'  # a year, by the config it was munged with
+DEFAULT_ETL_MEMORY_MB = 0  # no limit
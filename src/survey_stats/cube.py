@@ -0,0 +1,197 @@
+import os
+import json
+import shutil
+import itertools
+import feather
+import pandas as pd
+from multiprocessing import Pool
+from functools import lru_cache
+from timeit import default_timer as timer
+from survey_stats import log
+from survey_stats import pdutil as u
+from survey_stats.datasets import SurveyDataset
+from survey_stats.slicecache import norm_filter
+from survey_stats.const import CUBE_DIR_FMT, CUBE_MANIFEST, CUBE_MANIFEST_RECHECK
+
+logger = log.getLogger(__name__)
+
+# dataset shared with the forked pool processes
+_dset = None
+
+
+def cube_dir(dsid, cdir):
+    return os.path.join(cdir, CUBE_DIR_FMT.format(dsid=dsid))
+
+
+def partition_path(dsid, cdir, qn):
+    return os.path.join(cube_dir(dsid, cdir), '%s.feather' % qn)
+
+
+def query_key(vars, filt):
+    # vars keep request order, the filter is normalized
+    return (','.join(vars or []),
+            json.dumps(norm_filter(filt), separators=(',', ':')))
+
+
+def enumerate_queries(meta, max_vars=1, by_site=True):
+    """
+    (vars, filter) pairs to materialize for each question: national
+    estimates, plus one filter per site, for every ordering of up to
+    max_vars breakout facets
+    """
+    vlvls = [list(vs) for k in range(max_vars + 1)
+             for vs in itertools.permutations(meta.vars, k)]
+    filts = [{}]
+    if by_site:
+        filts += [{'sitecode': [str(s)]}
+                  for s in meta.facet_map.get('sitecode', [])]
+    return [(vs, f) for f in filts for vs in vlvls]
+
+
+def compute_query(d, qn, vars, filt):
+    # the same slices the API would request from a worker
+    slices = d.generate_slices(qn, list(vars), dict(filt))
+    res = pd.concat([d.fetch_stats_for_slice(s['q'], s['r'], s['vs'], s['f'],
+                                             s.get('rollup', False))
+                     for s in slices], ignore_index=True)
+    (vkey, fkey) = query_key(vars, filt)
+    return res.assign(vars=vkey, filter=fkey)
+
+
+def compute_partition(args):
+    (qn, queries, fp) = args
+    start = timer()
+    parts = []
+    for (vs, f) in queries:
+        try:
+            parts.append(compute_query(_dset, qn, vs, f))
+        except Exception as e:
+            # leave the slice to the workers
+            logger.error('failed to precompute slice', q=qn, vs=vs, f=f, err=str(e))
+    if len(parts) == 0:
+        return (qn, 0)
+    df = pd.concat(parts, ignore_index=True)
+    for c in df.columns:
+        # feather needs homogeneous object columns, others keep their dtype
+        if df[c].dtype == object and df[c].dropna().map(type).nunique() > 1:
+            df[c] = df[c].where(df[c].isnull(), df[c].astype(str))
+    tmp = fp + '.tmp'
+    feather.write_dataframe(df.reset_index(drop=True), tmp)
+    os.replace(tmp, fp)
+    logger.info('wrote cube partition', q=qn, rows=df.shape[0],
+                elapsed=timer()-start)
+    return (qn, df.shape[0])
+
+
+def read_manifest(cdir_cube):
+    mf = os.path.join(cdir_cube, CUBE_MANIFEST)
+    if not os.path.isfile(mf):
+        return None
+    with open(mf) as fh:
+        return json.load(fh)
+
+
+def write_manifest(cdir_cube, manifest):
+    mf = os.path.join(cdir_cube, CUBE_MANIFEST)
+    with open(mf + '.tmp', 'w') as fh:
+        json.dump(manifest, fh)
+    os.replace(mf + '.tmp', mf)
+
+
+def precompute(cfg_f, cdir, jobs, dbc=None, use_feather=True, max_vars=1,
+               by_site=True, resume=True):
+    """
+    materialize stats for the common queries of a dataset into one
+    feather partition per question, recording finished questions in the
+    manifest so an interrupted run picks up where it stopped
+    """
+    global _dset
+    _dset = SurveyDataset.load_dataset(cfg_f, dbc, cdir, init_des=True,
+                                       use_feather=use_feather, init_svy=False,
+                                       init_soc=False)
+    # loaded before forking so every process plans slices from it
+    _dset.plan
+    dsid = _dset.dsid
+    ddir = cube_dir(dsid, cdir)
+    manifest = read_manifest(ddir) if resume else None
+    params = {'max_vars': max_vars, 'by_site': by_site}
+    if (manifest is None or manifest['version'] != _dset.stats_version or
+            manifest['params'] != params):
+        logger.info('starting new stats cube', d=dsid, version=_dset.stats_version,
+                    **params)
+        shutil.rmtree(ddir, ignore_errors=True)
+        os.makedirs(ddir)
+        manifest = {'version': _dset.stats_version, 'params': params, 'done': {}}
+        write_manifest(ddir, manifest)
+    queries = enumerate_queries(_dset.meta, max_vars, by_site)
+    todo = [(q['qid'], queries, partition_path(dsid, cdir, q['qid']))
+            for q in _dset.meta.questions if q['qid'] not in manifest['done']]
+    logger.info('precomputing stats cube', d=dsid, questions=len(todo),
+                queries=len(queries), jobs=jobs)
+    start = timer()
+    # forked processes share the loaded designs
+    with Pool(jobs) as pool:
+        for (qn, nrow) in pool.imap_unordered(compute_partition, todo):
+            manifest['done'][qn] = nrow
+            write_manifest(ddir, manifest)
+            logger.info('checkpointed stats cube', d=dsid, q=qn, rows=nrow,
+                        done=len(manifest['done']), elapsed=timer()-start)
+    return manifest
+
+
+@lru_cache(maxsize=64)
+def load_partition(fp, mtime):
+    df = feather.read_dataframe(fp)
+    return {k: xf.drop(['vars', 'filter'], axis=1)
+            for k, xf in df.groupby(['vars', 'filter'])}
+
+
+class StatsCube(object):
+    """
+    Read side of a precomputed stats cube, valid only while the manifest
+    matches the stats version of the loaded dataset. The manifest is read
+    once, and again at most every CUBE_MANIFEST_RECHECK seconds while a
+    question is missing from it, as a precompute run may still add it.
+    """
+
+    def __init__(self, dsid, cdir, version, facets):
+        self.dsid = dsid
+        self.cdir = cdir
+        self.version = version
+        self.facets = set(facets)
+        self.manifest = None
+        self.read_at = None
+
+    def done(self, qn):
+        if self.manifest is not None and qn in self.manifest['done']:
+            return True
+        if self.read_at is not None and timer() - self.read_at < CUBE_MANIFEST_RECHECK:
+            return False
+        manifest = read_manifest(cube_dir(self.dsid, self.cdir))
+        self.read_at = timer()
+        self.manifest = (manifest if manifest is not None and
+                         manifest['version'] == self.version else None)
+        return self.manifest is not None and qn in self.manifest['done']
+
+    def lookup(self, qn, vars, filt):
+        """
+        worker-shaped result records for the query, or None on a miss
+        """
+        if not self.done(qn):
+            return None
+        fp = partition_path(self.dsid, self.cdir, qn)
+        try:
+            df = load_partition(fp, os.stat(fp).st_mtime_ns).get(query_key(vars, filt))
+        except OSError:
+            return None
+        if df is None:
+            return None
+        # drop breakout columns of other queries in the partition
+        cols = [c for c in df.columns if c not in self.facets or c in vars]
+        return u.fill_none(df[cols]).to_dict(orient='records')
+
+
+@lru_cache(maxsize=64)
+def stats_cube(dsid, cdir, version, facets):
+    # one reader per dataset version, so its manifest is read once
+    return StatsCube(dsid, cdir, version, facets)
@@ -1,24 +1,30 @@
+import os
 import blaze as bz
 from odo import odo
 import feather
 import pandas as pd
-import numpy as np
 import rpy2
 from rpy2.robjects import Formula
 import types
 import attr
 from pathlib import Path
+from timeit import default_timer as timer
 from typing import Union, Optional, Sequence, Mapping
 from cytoolz.curried import map, curry, filter
 from cytoolz.functoolz import identity, pipe
+from cytoolz.itertoolz import unique
 from cytoolz.dicttoolz import keymap, valmap, keyfilter, merge
 from cached_property import threaded_cached_property
 from survey_stats import log
 from survey_stats import pdutil as u
 from survey_stats.types import DatasetConfig, ColumnFilter
+from survey_stats.bitmaps import FacetIndex
+from survey_stats.socindex import SocrataIndex
 from survey_stats.dbi import DatabaseConfig, DatasetPart, get_datafile_path, DatasetFileType
-from survey_stats.const import DBTBL_FMT
-from survey_stats.const import DECIMALS, ID_COLUMN, ANNO_COLUMNS, STATS_COLUMNS
+from survey_stats.dbi import get_datafile_version, get_files_digest
+from survey_stats.planning import PlanIndex, survey_levels, read_levels, write_levels
+from survey_stats.const import DBTBL_FMT, USE_DB_DESIGNS
+from survey_stats.const import ID_COLUMN
 
 
 logger = log.getLogger()
@@ -41,6 +47,34 @@ def map_with_dict(d, val):
         return keymap(repl_f, val)
 
 
+def survey_engine(name):
+    # import lazily so processes that never compute stats need not load rpy2
+    if name == 'numpy':
+        from survey_stats import npsvy as eng
+    elif name == 'r':
+        from survey_stats import survey as eng
+    else:
+        raise NotImplementedError('Config surveys engine must be r or numpy!')
+    return eng
+
+
+def check_design_source(cfg, use_db):
+    # the numpy engine builds its arrays in memory, from feather only
+    if cfg.surveys and use_db and cfg.surveys.engine == 'numpy':
+        raise NotImplementedError('Config surveys engine numpy reads designs from feather, ' +
+                                  'not from database tables!')
+
+
+def replicate_args(cfg, dsid, cdir):
+    # replicate weight designs are only estimated by the numpy engine
+    if not cfg.surveys.replicates:
+        return {}
+    if cfg.surveys.engine != 'numpy':
+        raise NotImplementedError('Config surveys replicates require the numpy engine!')
+    return {'replicates': cfg.surveys.replicates,
+            'rep_file': get_datafile_path(DatasetPart.REPWEIGHTS.value, dsid, cdir)}
+
+
 def hydrate_dataset_part(part, dbc, cdir, dsid, as_blaze=True):
     if dbc is not None:
         logger.info('hydrating with database table')
@@ -77,6 +111,7 @@ class SurveyMeta(object):
     parts: Sequence[DatasetPart] = attr.ib()
     qns_r: Optional[pd.Series] = attr.ib()
     flevels_r: Optional[Mapping[str,Sequence[str]]] = attr.ib()
+    engine: str = attr.ib(default='r')
 
     @classmethod
     def load_metadata(cls, cfg, cdir):
@@ -96,10 +131,11 @@ class SurveyMeta(object):
             parts.append(DatasetPart.SURVEYS)
         if cfg.socrata:
             parts.append(DatasetPart.SOCRATA)
+        engine = cfg.surveys.engine if cfg.surveys else 'r'
         return cls(dsid=dsid, strata=cfg.strata,
                    facets=cfg.facets, national=cfg.national,
                    qns=qns, flevels=flevels, parts=parts,
-                   qns_r=qns_r, flevels_r=flevels_r)
+                   qns_r=qns_r, flevels_r=flevels_r, engine=engine)
 
     @threaded_cached_property
     def has_socrata(self):
@@ -124,6 +160,10 @@ class SurveyMeta(object):
 
     @threaded_cached_property
     def questions(self):
+        return self.questions_frame.to_dict(orient='records')
+
+    @threaded_cached_property
+    def questions_frame(self):
         def get_first_aggval(xf):
             try:
                 return xf.dropna().astype(str).get_values()[0]
@@ -157,10 +197,21 @@ class SurveyMeta(object):
                .groupby(group_cols)
                .agg(aggd)
                .reset_index()
-               .pipe(lambda xf: u.fill_none(xf))
-               .to_dict(orient='records'))
+               .pipe(lambda xf: u.fill_none(xf)))
         return res
 
+    @threaded_cached_property
+    def rollup_slices(self):
+        # the numpy engine derives every interaction level in a single pass,
+        # so all levels of a response are requested as one slice
+        return self.engine == 'numpy'
+
+    @threaded_cached_property
+    def multinomial_slices(self):
+        # the numpy engine estimates every response level of a question
+        # in one pass, so a query needs no per-response slices
+        return self.engine == 'numpy'
+
     @threaded_cached_property
     def vars(self):
         return self.strata + self.facets
@@ -171,48 +222,207 @@ class SurveyMeta(object):
                 for k in self.strata + self.facets}
 
 
-@attr.s(slots=True, frozen=True)
+@attr.s(frozen=True)
 class SurveyDataset(object):
+    """
+    A dataset whose parts (socrata and surveys data, survey design and
+    its facet index) are each loaded on first access, so a process only
+    pays for what it uses; load_dataset loads the requested parts upfront.
+    """
 
     dsid: str = attr.ib()
     dbc: Optional[DatabaseConfig] = attr.ib()
     cdir: Path = attr.ib()
+    cfg: DatasetConfig = attr.ib()
     meta: SurveyMeta = attr.ib()
-    soc: Optional[bz.interactive._Data] = attr.ib()
-    svy: Optional[bz.interactive._Data] = attr.ib()
-    des: Optional[rpy2.robjects.vectors.ListVector] = attr.ib()
     mapper: Optional[Union[types.FunctionType,
                                   types.LambdaType]] = attr.ib()
+    timings: Mapping[str, float] = attr.ib(default=attr.Factory(dict))
 
     @classmethod
-    def load_dataset(cls, cfg_f, dbc, cdir, init_des=False,
-                     use_feather=True, init_soc=True, init_svy=True):
+    def from_config(cls, cfg_f, dbc, cdir):
         # given a config file and blaze data handle,
         # work some magic
-        cfg = DatasetConfig.from_yaml(cfg_f)
-        dsid = cfg.id
+        return cls.from_cfg(DatasetConfig.from_yaml(cfg_f), dbc, cdir)
+
+    @classmethod
+    def from_cfg(cls, cfg, dbc, cdir):
+        start = timer()
+        check_design_source(cfg, USE_DB_DESIGNS)
         meta = SurveyMeta.load_metadata(cfg, cdir)
-        use_db = False
-        svytbl = hydrate_dataset_part(DatasetPart.SURVEYS, None, cdir, dsid) \
-            if cfg.surveys and init_svy else None
-        soctbl = hydrate_dataset_part(DatasetPart.SOCRATA, None, cdir, dsid) \
-            if cfg.socrata and init_soc else None
         # year is a reserved keyword in monetdb so work around
         mapper = identity
-        des = None
-        if cfg.surveys and init_des:
-            from survey_stats.survey import des_from_survey_db, des_from_feather
-            des = des_from_survey_db(
-                DBTBL_FMT.format(dsid=dsid, part=DatasetPart.SURVEYS.value),
-                dbc.name, dbc.host, dbc.port, denovo=cfg.surveys.denovo_strata,
-                fpc=cfg.surveys.fpc,
-                design=cfg.surveys.design
-            ) if use_db else des_from_feather(get_datafile_path(
-                DatasetPart.SURVEYS.value, dsid, cdir),
-                                              denovo=cfg.surveys.denovo_strata,
-                                              fpc=cfg.surveys.fpc,
-                                              design=cfg.surveys.design)
-        return cls(dsid=dsid, dbc=dbc, cdir=cdir, meta=meta, svy=svytbl, soc=soctbl, des=des, mapper=mapper)
+        return cls(dsid=cfg.id, dbc=dbc, cdir=cdir, cfg=cfg, meta=meta,
+                   mapper=mapper, timings={'meta': timer() - start})
+
+    @classmethod
+    def load_dataset(cls, cfg_f, dbc, cdir, init_des=False,
+                     use_feather=True, init_soc=True, init_svy=True):
+        start = timer()
+        d = cls.from_config(cfg_f, dbc, cdir)
+        for part, init in [('svy', init_svy), ('socindex', init_soc),
+                           ('des', init_des), ('dindex', init_des)]:
+            if init:
+                getattr(d, part)
+        logger.info('loaded dataset', d=d.dsid, timings=d.timings,
+                    elapsed=timer() - start)
+        return d
+
+    def timed(self, part, load):
+        start = timer()
+        res = load()
+        self.timings[part] = timer() - start
+        logger.info('loaded dataset part', d=self.dsid, part=part,
+                    elapsed=self.timings[part])
+        return res
+
+    @threaded_cached_property
+    def svy(self):
+        if not self.cfg.surveys:
+            return None
+        return self.timed('svy', lambda: hydrate_dataset_part(
+            DatasetPart.SURVEYS, None, self.cdir, self.dsid))
+
+    @threaded_cached_property
+    def soc(self):
+        if not self.cfg.socrata:
+            return None
+        return self.timed('soc', lambda: hydrate_dataset_part(
+            DatasetPart.SOCRATA, None, self.cdir, self.dsid))
+
+    @threaded_cached_property
+    def socindex(self):
+        # the socrata part indexed for queries, read without blaze
+        if not self.cfg.socrata:
+            return None
+        return self.timed('socindex', lambda: SocrataIndex(
+            hydrate_dataset_part(DatasetPart.SOCRATA, None, self.cdir,
+                                 self.dsid, as_blaze=False),
+            self.meta.facets, self.mapper('sitecode'), self.mapper('year')))
+
+    @threaded_cached_property
+    def des(self):
+        if not self.cfg.surveys:
+            return None
+        use_db = USE_DB_DESIGNS
+        cfg = self.cfg.surveys
+        dbc = self.dbc
+        eng = survey_engine(self.meta.engine)
+        svyf = get_datafile_path(DatasetPart.SURVEYS.value, self.dsid, self.cdir)
+
+        def load():
+            if use_db:
+                return eng.des_from_survey_db(
+                    DBTBL_FMT.format(dsid=self.dsid, part=DatasetPart.SURVEYS.value),
+                    dbc.name, dbc.host, dbc.port, denovo=cfg.denovo_strata,
+                    fpc=cfg.fpc, design=cfg.design)
+            return eng.des_from_feather(svyf, denovo=cfg.denovo_strata,
+                                        fpc=cfg.fpc, design=cfg.design,
+                                        **replicate_args(self.cfg, self.dsid, self.cdir))
+        return self.timed('des', load)
+
+    @threaded_cached_property
+    def dindex(self):
+        # per-level bitmaps for the facets requests filter on
+        if self.des is None:
+            return None
+        eng = survey_engine(self.meta.engine)
+        svyf = get_datafile_path(DatasetPart.SURVEYS.value, self.dsid, self.cdir)
+        icols = list(unique(['sitecode', 'year'] + list(self.meta.vars)))
+        return self.timed('dindex', lambda: FacetIndex.from_frame(
+            eng.facet_frame(self.des, svyf, icols), icols))
+
+    @threaded_cached_property
+    def version(self):
+        parts = [DatasetPart.SCHEMA, DatasetPart.FACETS] + list(self.meta.parts)
+        if self.cfg.surveys and self.cfg.surveys.replicates:
+            parts.append(DatasetPart.REPWEIGHTS)
+        return get_datafile_version([p.value for p in parts], self.dsid, self.cdir)
+
+    @threaded_cached_property
+    def stats_version(self):
+        # slice results also depend on how the design is estimated
+        svy = self.cfg.surveys
+        return get_files_digest([], self.version, self.meta.engine,
+                                svy and (svy.design, svy.fpc, svy.denovo_strata,
+                                         svy.replicates))
+
+    @threaded_cached_property
+    def content_version(self):
+        # responses also depend on the design settings, and on the question
+        # and level overrides in the config
+        return get_files_digest([], self.stats_version, self.cfg.questions,
+                                self.cfg.facet_levels)
+
+    @threaded_cached_property
+    def plan(self):
+        # validation and slice planning without touching the surveys data
+        return self.timed('plan', lambda: PlanIndex.build(
+            self.meta.qns[ID_COLUMN], self.meta.facet_map,
+            self.plan_levels() if self.cfg.surveys else None))
+
+    @property
+    def plan_levels_path(self):
+        return get_datafile_path(DatasetPart.PLAN.value, self.dsid, self.cdir,
+                                 DatasetFileType.JSONREC)
+
+    @property
+    def plan_levels_digest(self):
+        # the sidecar is rewritten with the surveys part, so it is keyed
+        # on the settings it was scanned with, not on file times
+        nat = self.meta.national
+        return get_files_digest([], self.mapper('sitecode'),
+                                sorted(set(self.meta.qns[ID_COLUMN])),
+                                nat and (nat.incl, list(nat.vals)))
+
+    def plan_levels(self):
+        """
+        response and national site levels of the surveys data, from the
+        sidecar ETL writes along with the surveys part
+        """
+        levels = read_levels(self.plan_levels_path, self.plan_levels_digest)
+        if levels is None:
+            raise IOError('No planning levels for dataset %s in %s, ' % (self.dsid, self.cdir) +
+                          'run survey_stats parse to write them')
+        return levels
+
+    def scan_plan_levels(self):
+        # one scan of the surveys part, for ETL to save the sidecar
+        logger.info('scanning surveys data for planning levels', d=self.dsid)
+        df = hydrate_dataset_part(DatasetPart.SURVEYS, None, self.cdir,
+                                  self.dsid, as_blaze=False)
+        levels = survey_levels(df, sorted(set(self.meta.qns[ID_COLUMN])),
+                               self.mapper('sitecode'), self.meta.national,
+                               self.plan_levels_digest)
+        del df
+        write_levels(self.plan_levels_path, levels)
+        return levels
+
+    @property
+    def loaded_parts(self):
+        return [p for p in ['svy', 'soc', 'socindex', 'des', 'dindex', 'plan']
+                if p in self.__dict__]
+
+    @threaded_cached_property
+    def artifact_sizes(self):
+        # stat the artifacts once, they are rebuilt under a new dataset
+        fps = {p: get_datafile_path(p.value, self.dsid, self.cdir)
+               for p in [DatasetPart.SOCRATA, DatasetPart.SURVEYS]}
+        return {p: os.path.getsize(fp) if os.path.isfile(fp) else 0
+                for p, fp in fps.items()}
+
+    @property
+    def nbytes(self):
+        """
+        estimated memory of the loaded parts from the size of the
+        (uncompressed) feather artifacts they were read from
+        """
+        n = 0
+        if set(['soc', 'socindex']).intersection(self.__dict__) and self.cfg.socrata:
+            n += self.artifact_sizes[DatasetPart.SOCRATA]
+        if set(['svy', 'des']).intersection(self.__dict__) and self.cfg.surveys:
+            n += self.artifact_sizes[DatasetPart.SURVEYS]
+        return n
 
     def hydrate_part(self, part):
         return hydrate_dataset_part(part, self.dbc, self.cdir, self.dsid)
@@ -248,75 +458,60 @@ class SurveyDataset(object):
     def fetch_socrata(self, qn, vars, filt={}):
         vars = self.mapper(vars)
         filt = self.mapper(filt)
-        sel = None
-        df = self.soc
-        fcts = list(set(self.meta.facets)
-                    .intersection(self.soc.fields))
-        sel = df[ID_COLUMN] == qn
-        site_col = self.mapper('sitecode')
-        year_col = self.mapper('year')
-        if site_col in filt.keys():
-            sel = sel & df[site_col].isin(filt[site_col])
-        elif site_col not in vars:
-            sel = sel & (df[site_col] == 'XX')
-        if year_col in filt.keys():
-            sel = sel & df[year_col].isin(filt[year_col])
-        elif year_col not in vars:
-            sel = sel & (df[year_col] == 'Total')
-        for v in fcts:
-            if v in filt.keys():
-                sel = sel & df[v].isin(filt[v])
-            elif v not in vars:
-                sel = sel & (df[v].isin(['Total', None]))
-        cols = (set(ANNO_COLUMNS)
-                .union(vars)
-                .union(STATS_COLUMNS)
-                .intersection(self.soc.fields))
-        cols = list(cols)
-        dfz = odo(df[sel][cols], pd.DataFrame)
-        stats_sub = list(set(STATS_COLUMNS).intersection(dfz.columns))
-        dfz[stats_sub] = dfz[stats_sub].apply(
-            lambda xf: xf.astype(float).replace(-1.0, np.nan)
-        )
-        # logger.info('done filtering, replacing NaNs', dfz=dfz)
-        return u.fill_none(dfz.round(DECIMALS).reset_index(drop=True))
+        return self.socindex.query(qn, vars, filt)
+
+    def domain_for_filter(self, eng, filt, qn=None):
+        # AND cached facet bitmaps into a domain mask when every filter
+        # column is indexed, else fall back to subsetting the design
+        if len(filt.keys()) > 0 and self.dindex is not None and self.dindex.covers(filt):
+            return eng.domain_survey(self.des, self.dindex.mask(filt), qn)
+        return eng.subset_survey(self.des, filt, qn)
 
     def fetch_stats(self, qn, vars=[], filt={}):
         vars = self.mapper(vars)
         filt = self.mapper(filt)
-        lvls = self.responses_for_qn(qn)
-        res = map(lambda r: fetch_stats(self.des, qn, r, vars, filt), lvls)
-        dfz = pd.concat(res, ignore_index=True)
-        return dfz
-
-    def fetch_stats_for_slice(self, qn, r, vars=[], filt={}):
-        from survey_stats.survey import (fetch_stats_totals,
-                                         fetch_stats_by, subset_survey,
-                                         dim_design)
+        eng = survey_engine(self.meta.engine)
+        des = self.domain_for_filter(eng, filt)
+        return eng.fetch_stats_responses(des, qn, vars, rollup=True)
+
+    def slice_domain(self, qn, filt={}):
+        # the subset a slice is estimated over, shared by every slice
+        # with the same question and filter
+        eng = survey_engine(self.meta.engine)
+        filt = self.mapper(filt)
+        logger.info('subsetting des with filter', filt=filt, q=qn, engine=self.meta.engine)
+        return self.domain_for_filter(eng, filt, qn)
+
+    def fetch_stats_for_slice(self, qn, r, vars=[], filt={}, rollup=False, des=None):
+        eng = survey_engine(self.meta.engine)
         vars = self.mapper(vars)
         filt = self.mapper(filt)
-        qn_f = '~I(%s=="%s")' % (qn, r)
-        logger.info('subsetting des with filter', filt=filt, v=vars, q=qn, r=r)
-        des = subset_survey(self.des, filt, qn)
-        dsubs = dim_design(des)
+        qn_f = eng.response_formula(qn, r)
+        des = self.slice_domain(qn, filt) if des is None else des
+        dsubs = eng.dim_design(des)
         if dsubs[0] == 0:
             logger.info('subsetting yields empty df, returning empty result', dim=dsubs)
             cols = ['level'+'response'] + vars + \
                 ['mean', 'se', 'ci_l', 'ci_u', 'count', 'sample_size']
             return pd.DataFrame(columns=cols)
         ret = None
-        if len(vars) > 0:
-            logger.info('fetching stats with var levels', vs=vars, qn=qn, r=r)
-            ret = fetch_stats_by(des, qn_f, r, vars)
-            for k in filt.keys():
-                # if a facet is used in both vars and filter,
-                # eliminate the empty non-filtered rows that
-                # arise from our inclusive svyby call for factors
-                if k in vars:
-                    ret = ret[ret[k].isin(filt[k])]
+        if r is None:
+            logger.info('fetching stats for all responses', vs=vars, qn=qn, rollup=rollup)
+            ret = eng.fetch_stats_responses(des, qn, vars, rollup)
+        elif len(vars) > 0:
+            logger.info('fetching stats with var levels', vs=vars, qn=qn, r=r, rollup=rollup)
+            ret = (eng.fetch_stats_rollup(des, qn_f, r, vars) if rollup
+                   else eng.fetch_stats_by(des, qn_f, r, vars))
         else:
             logger.info('fetching top level stats', qn=qn, r=r)
-            ret = fetch_stats_totals(des, qn_f, r)
+            ret = eng.fetch_stats_totals(des, qn_f, r)
+        for k in filt.keys():
+            # if a facet is used in both vars and filter,
+            # eliminate the empty non-filtered rows that
+            # arise from our inclusive svyby call for factors,
+            # keeping rollup rows at levels not grouped by it
+            if k in vars:
+                ret = ret[ret[k].isin(filt[k]) | ret[k].isnull()]
         return ret
 
     def generate_slices(self, qn, vars=[], filt={}):
@@ -327,11 +522,16 @@ class SurveyDataset(object):
             # no sitecode in filter
             # -- national
             nat = self.meta.national
-            filt[site_col] = nat.vals if nat.incl else self.values_for_col(site_col, exclude=nat.vals)
-        resps = self.values_for_col(qn)
+            filt[site_col] = list(self.plan.national_sites)
+        d = self.dsid
+        if self.meta.multinomial_slices:
+            # the worker returns every response level and, with rollup,
+            # every interaction level of the query in a single slice
+            return [{'d': d, 'q': qn, 'r': None, 'f': filt, 'vs': vars,
+                     'rollup': self.meta.rollup_slices}]
+        resps = self.plan.responses.get(qn, [])
         vlvls = [vars[:k+1] for k in range(len(vars))]
         res = []
-        d = self.dsid
         logger.info('mapping slices over resps', r=resps)
         for r in resps:
             top = [{'d': d, 'q': qn, 'r': r, 'f': filt, 'vs': []}]
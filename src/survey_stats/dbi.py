@@ -1,4 +1,7 @@
 import os
+import glob
+import shutil
+import hashlib
 import sqlalchemy as sa
 import blaze as bz
 import attr
@@ -16,6 +19,8 @@ class DatasetPart(Enum):
     FACETS = 'facets'
     SURVEYS = 'surveys'
     SOCRATA = 'socrata'
+    REPWEIGHTS = 'repweights'
+    PLAN = 'plan'
 
 
 @unique
@@ -72,3 +77,37 @@ def get_datafile_path(part, dsid, cdir, ftyp=DatasetFileType.FEATHER):
                         ))
     logger.info('getting filepath', fp=fp)
     return fp
+
+
+def get_files_digest(fps, *params):
+    """
+    short digest of the name, size and mtime of each file, plus any
+    extra parameters, which changes whenever the files are rebuilt
+    """
+    h = hashlib.sha1()
+    for fp in fps:
+        if os.path.isfile(fp):
+            st = os.stat(fp)
+            h.update(('%s:%d:%d;' % (os.path.basename(fp), st.st_size,
+                                     st.st_mtime_ns)).encode('utf-8'))
+    h.update(repr(params).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def get_datafile_version(parts, dsid, cdir, ftyp=DatasetFileType.FEATHER):
+    return get_files_digest([get_datafile_path(part, dsid, cdir, ftyp)
+                             for part in parts])
+
+
+def get_snapshot_path(fp, ext, *params):
+    """
+    path of a snapshot derived from the data file fp and params, next to
+    the file, after removing snapshots made from older versions of it
+    """
+    base = os.path.splitext(fp)[0]
+    snap = '%s.%s.%s' % (base, get_files_digest([fp], *params), ext)
+    for old in glob.glob('%s.*.%s' % (glob.escape(base), ext)):
+        if old != snap:
+            logger.info('removing stale snapshot', f=old)
+            shutil.rmtree(old) if os.path.isdir(old) else os.remove(old)
+    return snap
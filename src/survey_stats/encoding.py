@@ -0,0 +1,150 @@
+import gzip
+import json
+import pandas as pd
+from survey_stats import log
+from survey_stats.const import ARROW_MIMETYPE, MSGPACK_MIMETYPE
+
+logger = log.getLogger(__name__)
+
+ENCODINGS = ['zstd', 'gzip']
+
+
+def parse_accept(header):
+    # media types (or codings) in order of preference
+    prefs = []
+    for i, part in enumerate((header or '').split(',')):
+        fields = [f.strip() for f in part.split(';')]
+        if not fields[0]:
+            continue
+        q = 1.0
+        for f in fields[1:]:
+            if f.startswith('q='):
+                try:
+                    q = float(f[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            prefs.append((-q, i, fields[0].lower()))
+    return [t for _, _, t in sorted(prefs)]
+
+
+def has_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+
+def has_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        return False
+    return True
+
+
+def negotiate(accept, accept_encoding=None):
+    """
+    binary media type and content coding for a request's Accept and
+    Accept-Encoding headers, None for either when the client takes
+    plain JSON or no compression
+    """
+    mimetype = next((t for t in parse_accept(accept)
+                     if t in [ARROW_MIMETYPE, 'application/json'] or
+                     (t == MSGPACK_MIMETYPE and has_msgpack())), None)
+    if mimetype not in [ARROW_MIMETYPE, MSGPACK_MIMETYPE]:
+        return None, None
+    codings = [c for c in parse_accept(accept_encoding)
+               if c in ENCODINGS and (c != 'zstd' or has_zstd())]
+    return mimetype, (codings[0] if codings else None)
+
+
+def columnar_value(x):
+    # sets and numpy scalars from the aggregated question metadata
+    if isinstance(x, (set, frozenset, list, tuple)):
+        return sorted(str(v) for v in x)
+    return x.item() if hasattr(x, 'item') else x
+
+
+def as_str(x):
+    if isinstance(x, list) or x is None or x != x:
+        return x
+    return str(x)
+
+
+def to_arrow(df, meta=None):
+    import pyarrow as pa
+    df = df.apply(lambda c: c.map(columnar_value) if c.dtype == object else c)
+    try:
+        tbl = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        # columns mixing types, e.g. levels with 'Total', go as strings
+        df = df.apply(lambda c: c.map(as_str) if c.dtype == object else c)
+        tbl = pa.Table.from_pandas(df, preserve_index=False)
+    if meta is not None:
+        md = dict(tbl.schema.metadata or {})
+        md[b'survey_stats'] = json.dumps(meta, default=str).encode('utf-8')
+        tbl = tbl.replace_schema_metadata(md)
+    sink = pa.BufferOutputStream()
+    writer = pa.RecordBatchStreamWriter(sink, tbl.schema)
+    writer.write_table(tbl)
+    writer.close()
+    buf = sink.getvalue() if hasattr(sink, 'getvalue') else sink.get_result()
+    return buf.to_pybytes()
+
+
+def to_msgpack(df, meta=None):
+    import msgpack
+    body = {'columns': list(df.columns),
+            'data': {c: [columnar_value(x) for x in df[c].tolist()] for c in df.columns}}
+    return msgpack.packb(dict(meta or {}, results=body), use_bin_type=True,
+                         default=str)
+
+
+def compress(body, coding):
+    if coding == 'gzip':
+        return gzip.compress(body)
+    if coding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(body)
+    return body
+
+
+def encode_frame(df, mimetype, coding=None, meta=None):
+    """
+    a result frame as an Arrow IPC stream, with meta in the schema
+    metadata, or as columnar msgpack, with meta alongside the columns
+    """
+    if mimetype == ARROW_MIMETYPE:
+        body = to_arrow(df, meta)
+    elif mimetype == MSGPACK_MIMETYPE:
+        body = to_msgpack(df, meta)
+    else:
+        raise NotImplementedError('Unsupported response type: %s' % mimetype)
+    return compress(body, coding)
+
+
+def decode_frame(body, mimetype, coding=None):
+    if coding == 'gzip':
+        body = gzip.decompress(body)
+    elif coding == 'zstd':
+        import zstandard
+        body = zstandard.ZstdDecompressor().decompress(body)
+    if mimetype == ARROW_MIMETYPE:
+        import pyarrow as pa
+        reader = pa.RecordBatchStreamReader(pa.BufferReader(body))
+        tbl = reader.read_all()
+        md = tbl.schema.metadata or {}
+        meta = json.loads(md[b'survey_stats'].decode('utf-8')) if b'survey_stats' in md else {}
+        return tbl.to_pandas(), meta
+    if mimetype == MSGPACK_MIMETYPE:
+        import msgpack
+        try:
+            res = msgpack.unpackb(body, raw=False)
+        except TypeError:
+            # msgpack before 0.5.2
+            res = msgpack.unpackb(body, encoding='utf-8')
+        cols = res.pop('results')
+        return pd.DataFrame(cols['data'], columns=cols['columns']), res
+    raise NotImplementedError('Unsupported response type: %s' % mimetype)
@@ -1,21 +1,23 @@
 import re
 import os
 import yaml
+import shutil
 import pandas as pd
 import sqlalchemy as sa
-import dask
-import dask.multiprocessing
-import dask.cache
 from cytoolz.curried import map
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from timeit import default_timer as timer
 
 from survey_stats import log
 from survey_stats import serdes
 from survey_stats.types import DatasetConfig
-from survey_stats.dbi import DatabaseConfig, DatasetPart, get_datafile_path
-from survey_stats.etl.sas import process_sas_survey
-from survey_stats.etl.spss import process_fwf_w_spss_loader
+from survey_stats.dbi import DatabaseConfig, DatasetPart, get_datafile_path, get_files_digest
+from survey_stats.memstat import peak_memory_mb
+from survey_stats.planning import read_levels
+from survey_stats.const import SPILL_DIR_FMT, SPILL_FILE_FMT, DEFAULT_ETL_MEMORY_MB
+from survey_stats.etl import survey_df as sdf
+from survey_stats.etl.sas import munge_sas_year
+from survey_stats.etl.spss import munge_spss_year
 from survey_stats.etl.socrata import load_socrata_data, get_metadata_socrata
 
 logger = log.getLogger(__name__)
@@ -25,37 +27,51 @@ def undash(col):
     return 'x' + col if col[0] == '_' else col
 
 
-def load_survey_data(cfg, client=None):
-    logger.info('loading survey dfs')
-    svydf = None
+def spill_dir(dsid, cache_dir):
+    return os.path.join(cache_dir, SPILL_DIR_FMT.format(dsid=dsid))
+
+
+def spill_path(cfg, i, cache_dir):
+    # keyed on everything munging the year reads from the config, so
+    # resuming never merges a year munged under an older one
+    g = cfg.surveys
+    digest = get_files_digest([], cfg.facets, g.meta.iloc[i].to_dict(), g.parse_mode,
+                              g.s3_url_prefix, g.qids, g.patch_format, g.na_synonyms,
+                              g.replace_labels, g.rename_cols, g.fpc)
+    return os.path.join(spill_dir(cfg.id, cache_dir),
+                        SPILL_FILE_FMT.format(i=i, digest=digest))
+
+
+def parse_year(args):
+    """
+    munge one year of a survey in a worker process and spill it to disk
+    for the merge, keeping a year already spilled when resuming
+    """
+    (cfg_f, i, fp, resume) = args
+    if os.path.isfile(fp) and resume:
+        logger.warn('found spilled year, moving on', f=fp)
+        return fp
+    cfg = DatasetConfig.from_yaml(cfg_f)
+    r = cfg.surveys.meta.iloc[i]
+    start = timer()
     if cfg.surveys.parse_mode == 'sas':
-        svydf = process_sas_survey(cfg.surveys,
-                                   facets=cfg.facets,
-                                   client=client, lgr=logger)
+        df = munge_sas_year(cfg.surveys, cfg.facets, r, lgr=logger)
     elif cfg.surveys.parse_mode == 'spss':
-        svydf = process_fwf_w_spss_loader(cfg.surveys,
-                                          facets=cfg.facets,
-                                          client=client, lgr=logger)
+        df = munge_spss_year(cfg.surveys, cfg.facets, r, lgr=logger)
     else:
         raise NotImplementedError('Config parse_mode must be spss or sas!')
+    df.to_pickle(fp + '.tmp')
+    os.replace(fp + '.tmp', fp)
+    logger.info('spilled survey year', dataset=cfg.id, year=r['year'], shp=df.shape,
+                f=fp, elapsed=timer()-start)
+    return fp
+
 
-    logger.info('loaded survey dfs', shape=svydf.shape)
-    svydf = svydf.compute()
-    svydf = svydf.reset_index(drop=True)
+def load_survey_data(cfg, fps):
+    logger.info('merging survey years', dataset=cfg.id, years=len(fps))
+    svydf = sdf.merge_years(fps, fpc=cfg.surveys.fpc, lgr=logger)
     mx = (svydf.apply(lambda xf: xf.value_counts().to_dict())
                .to_dict())
-    #                   )[svydf.apply(lambda yf: yf.dropna().apply(lambda q: type(q) != str))
-    #                          .dropna().any(0)])
-    # mx = (svydf.select_dtypes(include=['object', 'category'])
-    #            .apply(lambda xf: xf.value_counts().to_dict()
-    #                   )[svydf.apply(lambda yf: yf.dropna().apply(lambda q: type(q) != str))
-    #                          .dropna().any(0)])
-    # mx2 = (svydf.applymap(lambda yf: type(yf).__name__)[list(mx.keys())]).apply(lambda xf: xf.value_counts())
-    # mx = mx.to_dict()
-    # if len(mx) > 0:
-    #     logger.error('Found category columns with non-str labels!', mx=mx, mx2=mx2)
-    #     # TODO: check formats list in advance to see if expected fmts missing
-    #     raise LookupError('Found categoricals with non-string labels!', mx.keys())
     return (svydf, mx)
 
 
@@ -132,42 +148,97 @@ def setup_tables(cfg, dburl):
         bulk_load_df(ksoc, engine)
 
 
-def process_dataset(cfg, dbc, cache_dir, resume=True):
-    logger.bind(dataset=cfg.id)
-    logger.info('checking for socrata, processing', s=cfg.socrata)
-    if cfg.socrata:
-        ksoc = get_datafile_path(DatasetPart.SOCRATA.value, cfg.id, cache_dir)
-        if os.path.isfile(ksoc) and resume:
-            logger.warn('found socrata artifact, moving on', resume=resume)
-        else:
-            logger.info('generating socrata data', resume=resume, overwriting=os.path.isfile(ksoc))
-            dsoc = load_socrata_data(cfg.socrata, cfg.facets)
-            logger.info('saving socrata data to feather', f=ksoc)
-            dsoc.to_feather(ksoc)
-            logger.info('saved socrata data to feather', f=ksoc)
-            # short process, can be run regardless
-            (qns, facs) = get_metadata_socrata(cfg.socrata, dsoc, cfg.facets)
-            logger.info('created schema for socrata')
-            qns.to_feather(get_datafile_path(DatasetPart.SCHEMA.value, cfg.id, cache_dir))
-            facs.to_feather(get_datafile_path(DatasetPart.FACETS.value, cfg.id, cache_dir))
-    logger.info('checking for surveys, processing', s=cfg.surveys)
-    if cfg.surveys:
-        svyf = get_datafile_path(DatasetPart.SURVEYS.value, cfg.id, cache_dir)
-        svy_descf = svyf+'.yaml' 
-        if os.path.isfile(svyf) and resume:
-            logger.warn('found surveys artifact, moving on', resume=resume)
+def process_socrata(args):
+    (cfg_f, cache_dir, resume) = args
+    cfg = DatasetConfig.from_yaml(cfg_f)
+    ksoc = get_datafile_path(DatasetPart.SOCRATA.value, cfg.id, cache_dir)
+    if os.path.isfile(ksoc) and resume:
+        logger.warn('found socrata artifact, moving on', dataset=cfg.id, resume=resume)
+        return ksoc
+    logger.info('generating socrata data', dataset=cfg.id, resume=resume,
+                overwriting=os.path.isfile(ksoc))
+    dsoc = load_socrata_data(cfg.socrata, cfg.facets)
+    logger.info('saving socrata data to feather', f=ksoc)
+    dsoc.to_feather(ksoc)
+    logger.info('saved socrata data to feather', f=ksoc)
+    # short process, can be run regardless
+    (qns, facs) = get_metadata_socrata(cfg.socrata, dsoc, cfg.facets)
+    logger.info('created schema for socrata')
+    qns.to_feather(get_datafile_path(DatasetPart.SCHEMA.value, cfg.id, cache_dir))
+    facs.to_feather(get_datafile_path(DatasetPart.FACETS.value, cfg.id, cache_dir))
+    return ksoc
+
+
+def process_surveys(args):
+    """
+    merge the spilled years of a dataset, when there are any, then
+    build its replicate weights and planning levels
+    """
+    (cfg_f, cache_dir, resume, fps) = args
+    cfg = DatasetConfig.from_yaml(cfg_f)
+    svyf = get_datafile_path(DatasetPart.SURVEYS.value, cfg.id, cache_dir)
+    svy_descf = svyf+'.yaml'
+    if fps:
+        (svydf, svymeta) = load_survey_data(cfg, fps)
+        logger.info('saving survey data to feather', f=svyf)
+        svydf.to_feather(svyf)
+        del svydf
+        logger.info('saving survey desc data to feather', f=svy_descf)
+        with open(svy_descf, 'w') as fh:
+            yaml.dump(svymeta, fh)
+        logger.info('saved survey data to feather', name=svy_descf)
+        shutil.rmtree(spill_dir(cfg.id, cache_dir), ignore_errors=True)
+    if cfg.surveys.replicates:
+        from survey_stats import npsvy
+        repf = get_datafile_path(DatasetPart.REPWEIGHTS.value, cfg.id, cache_dir)
+        rep = cfg.surveys.replicates
+        (saved, _) = npsvy.saved_replicate_params(repf)
+        if (resume and saved == npsvy.replicate_params(rep.method, rep.replicates, rep.seed)
+                and os.path.getmtime(repf) >= os.path.getmtime(svyf)):
+            logger.warn('found replicate weights artifact, moving on', resume=resume)
         else:
-            logger.info('generating surveys data', resume=resume, overwriting=os.path.isfile(svyf))
-            (svydf, svymeta) = load_survey_data(cfg)
-            logger.info('saving survey data to feather', svyf)
-            svydf.to_feather(svyf)
-            logger.info('saving survey desc data to feather', svy_descf)
-            with open(svy_descf, 'w') as fh:
-                yaml.dump(svymeta, fh)
-            logger.info('saved survey data to feather', name=svy_descf)
-    #if dbc is not None:
-    #    setup_tables(cfg, dbc.uri)
-    logger.unbind('dataset')
+            des = npsvy.des_from_feather(svyf, denovo=cfg.surveys.denovo_strata,
+                                         fpc=cfg.surveys.fpc, design=cfg.surveys.design)
+            npsvy.save_replicates(des, repf, rep.method, rep.replicates, rep.seed)
+    # response levels and national sites for planning slices, so
+    # the API never scans the surveys data
+    from survey_stats.datasets import SurveyDataset
+    d = SurveyDataset.from_cfg(cfg, None, cache_dir)
+    if fps or read_levels(d.plan_levels_path, d.plan_levels_digest) is None:
+        d.scan_plan_levels()
+    return svyf
+
+
+def measured(fn, args):
+    return (fn(args), peak_memory_mb())
+
+
+def run_bounded(tasks, jobs, memory_limit_mb=DEFAULT_ETL_MEMORY_MB):
+    """
+    run (fn, args) tasks in up to jobs processes; with a memory limit,
+    only as many at once as fit at the highest peak memory of a worker
+    so far, starting with one task to measure it
+    """
+    pending = list(tasks)
+    results = []
+    peak = 0.0
+    with ProcessPoolExecutor(jobs) as ex:
+        running = {}
+        while pending or running:
+            while pending and len(running) < jobs and (
+                    not running or not memory_limit_mb or
+                    (peak > 0 and (len(running) + 1) * peak <= memory_limit_mb)):
+                (fn, args) = pending.pop(0)
+                running[ex.submit(measured, fn, args)] = fn.__name__
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                name = running.pop(f)
+                (res, mb) = f.result()
+                peak = max(peak, mb)
+                results.append(res)
+                logger.info('finished etl task', task=name, peak_mb=mb,
+                            running=len(running), pending=len(pending))
+    return results
 
 
 def restore_data(sql_conn):
@@ -181,19 +252,47 @@ def restore_data(sql_conn):
         logger.unbind('dataset')
 
 
-def load_datasets(cache_dir, dbc, dsets, parse_all=False, resume=True):
+def load_datasets(cache_dir, dbc, dsets, parse_all=False, resume=True,
+                  jobs=1, memory_limit_mb=DEFAULT_ETL_MEMORY_MB):
+    """
+    parse the socrata tables and every survey year of the datasets in
+    up to jobs processes, spilling munged years to disk, then merge each
+    dataset's years in the same bounded pool
+    """
     import cytoolz.dicttoolz as dz
-    cache = dask.cache.Cache(8e9)
-    cache.register()
-    dask.set_options(get=dask.threaded.get, pool=ThreadPool())
     configs = list(
-        map(lambda x: os.path.join('config/data', x), 
+        map(lambda x: os.path.join('config/data', x),
             os.listdir('config/data')))
     cmap = {k: DatasetConfig.from_yaml(k) for k in configs}
     dsids = dz.valmap(lambda ds: ds.id, cmap)
+    cfgfs = {v: k for k, v in dsids.items()}
     cmap = dz.merge(cmap, {d.id: d for d in cmap.values()})
     if parse_all:
         dsets = dsids
-    for d in dsets:
-        process_dataset(cmap[d], dbc, cache_dir)
-
+    cfgs = [cmap[d] for d in dsets]
+    start = timer()
+    parse_tasks, spills = [], {}
+    for cfg in cfgs:
+        cfg_f = cfgfs[cfg.id]
+        if cfg.socrata:
+            parse_tasks.append((process_socrata, (cfg_f, cache_dir, resume)))
+        if not cfg.surveys:
+            continue
+        svyf = get_datafile_path(DatasetPart.SURVEYS.value, cfg.id, cache_dir)
+        if os.path.isfile(svyf) and resume:
+            logger.warn('found surveys artifact, moving on', dataset=cfg.id, resume=resume)
+            continue
+        sdir = spill_dir(cfg.id, cache_dir)
+        os.makedirs(sdir, exist_ok=True)
+        spills[cfg.id] = [spill_path(cfg, i, cache_dir)
+                          for i in range(len(cfg.surveys.meta))]
+        parse_tasks.extend((parse_year, (cfg_f, i, fp, resume))
+                           for i, fp in enumerate(spills[cfg.id]))
+    logger.info('parsing datasets', dsets=[c.id for c in cfgs], tasks=len(parse_tasks),
+                jobs=jobs, memory_limit_mb=memory_limit_mb)
+    run_bounded(parse_tasks, jobs, memory_limit_mb)
+    # merges need more memory than single years, so they start over
+    # measuring it
+    run_bounded([(process_surveys, (cfgfs[cfg.id], cache_dir, resume, spills.get(cfg.id)))
+                 for cfg in cfgs if cfg.surveys], jobs, memory_limit_mb)
+    logger.info('parsed datasets', dsets=[c.id for c in cfgs], elapsed=timer()-start)
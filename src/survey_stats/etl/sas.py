@@ -5,7 +5,6 @@ import pandas as pd
 import asteval
 from cytoolz.curried import map, filter, curry, mapcat
 from cytoolz.functoolz import pipe, thread_last, identity
-from dask import delayed
 from survey_stats import log
 from survey_stats.etl import survey_df as sdf
 from survey_stats.etl import download as dl
@@ -138,50 +137,17 @@ def load_sas_xport_df(url, lgr=logger):
     return df
 
 
-def process_sas_survey(svy_cfg, facets, client=None, lgr=logger):
+def munge_sas_year(svy_cfg, facets, r, lgr=logger):
+    # one year of a survey: its labels, its data file and the munging
     g = svy_cfg
     prefix = g.s3_url_prefix
-    lgr.bind(p=prefix)
     evalr = asteval.Interpreter()
     evalr.symtable['pd.util'] = pd.util
-    fn = g.rename_cols
-    map_fn = evalr(fn)
-    df_munger = curry(sdf.munge_df)(facets=facets, qids=g.qids,
-                                    na_syns=g.na_synonyms, col_fn=map_fn,
-                                    fmts=g.patch_format, fpc=g.fpc, lgr=lgr)
-    lbl_loader = curry(load_variable_labels)(repl=g.replace_labels)
-    xpt_loader = curry(load_sas_xport_df)(lgr=lgr)
-    dfs = map(
-        lambda r: pipe(prefix+r.xpt,
-                       delayed(xpt_loader),
-                       delayed(df_munger(r=r,
-                                         lbls=lbl_loader(prefix+r.format,
-                                                         prefix+r.formas)))),
-        [r for idx, r in g.meta.iterrows()])
-    lgr.info('merging SAS dfs')
-    dfs = delayed(pd.concat)(dfs, ignore_index=True)
-    scols = delayed(
-        lambda xf: list(xf.columns
-                          .intersection(set(g.qids)
-                                        .union(facets))))(dfs)
-    lgr.info('re-filtering question and facet columns to cast to category dtype', cols=scols)
-    dfz = (dfs
-           .apply(lambda x: x.astype('category'))
-           .reset_index(drop=True)
-           .assign(year=dfs['year'].astype(int),
-                   sitecode=dfs['sitecode'].astype('category'),
-                   weight=dfs['weight'].astype(float),
-                   strata=dfs['strata'].astype(int, errors='ignore'),
-                   psu=dfs['psu'].astype(int, errors='ignore'))
-           .reset_index(drop=True))
-    if g.fpc:
-        dfz = (dfz.assign(fpc=dfs['fpc'].astype(int, errors='ignore'),
-                         sample_ct=dfs['sample_ct'].astype(int, errors='ignore'))
-                  .reset_index(drop=True))
-    dfz.visualize()
-    lgr.info('merged SAS dfs')
-    lgr.unbind('p')
-    return dfz
+    lbls = load_variable_labels(prefix+r.format, prefix+r.formas, repl=g.replace_labels)
+    df = load_sas_xport_df(prefix+r.xpt, lgr=lgr)
+    return sdf.munge_df(df, r=r, lbls=lbls, facets=facets, qids=g.qids,
+                        na_syns=g.na_synonyms, col_fn=evalr(g.rename_cols),
+                        fmts=g.patch_format, fpc=g.fpc, lgr=lgr)
 
 
 '''
@@ -1,10 +1,7 @@
 import pandas as pd
 import asteval
 from collections import OrderedDict
-from cytoolz.curried import map, curry
-from cytoolz.functoolz import pipe
 from cytoolz.dicttoolz import valmap
-from dask import delayed
 from survey_stats import log
 from survey_stats import pdutil
 from survey_stats.etl import survey_df as sdf
@@ -184,40 +181,14 @@ def load_survey_data(dat_f, svy_cols, lgr=logger):
     return df
 
 
-def process_fwf_w_spss_loader(svy_cfg, facets, client=None, lgr=logger):
+def munge_spss_year(svy_cfg, facets, r, lgr=logger):
+    # one year of a survey: its fixed width data, its labels and the munging
     g = svy_cfg
     prefix = g.s3_url_prefix
-    lgr.bind(p=prefix)
     evalr = asteval.Interpreter()
     evalr.symtable['pdutil'] = pdutil
-    fn = g.rename_cols
-    map_fn = evalr(fn)
-    df_munger = curry(sdf.munge_df)(facets=facets, qids=g.qids,
-                                    na_syns=g.na_synonyms, col_fn=map_fn,
-                                    fmts=g.patch_format, lgr=lgr)
-    fwf_loader = curry(load_survey_data)(lgr=lgr)
-    dfs = map(
-        lambda r: pipe(prefix+r.fwf,
-                       fwf_loader(svy_cols=parse_fwfcols_spss(prefix+r.spss, lgr=lgr)),
-                       delayed(df_munger)(r=r, lbls=parse_surveyvars_spss(prefix+r.spss))),
-        [r for idx, r in g.meta.iterrows()])
-    lgr.info('merging SAS dfs')
-    dfs = delayed(pd.concat)(dfs, ignore_index=True)
-    scols = delayed(
-        lambda xf: list(xf.columns
-                          .intersection(set(g.qids)
-                                        .union(facets))))(dfs)
-    lgr.info('re-filtering question and facet columns to cast to category dtype', cols=scols)
-    dfz = (dfs
-           .apply(lambda x: x.astype('category'))
-           .reset_index(drop=True)
-           .assign(year=dfs['year'].astype(int),
-                   sitecode=dfs['sitecode'].astype('category'),
-                   weight=dfs['weight'].astype(float),
-                   strata=dfs['strata'].astype(int, errors='ignore'),
-                   psu=dfs['psu'].astype(int, errors='ignore'))
-           .reset_index(drop=True))
-    dfz.visualize()
-    lgr.info('merged SAS dfs')
-    lgr.unbind('p')
-    return dfz
+    df = load_survey_data(prefix+r.fwf, parse_fwfcols_spss(prefix+r.spss, lgr=lgr), lgr=lgr)
+    lbls = parse_surveyvars_spss(prefix+r.spss)
+    return sdf.munge_df(df, r=r, lbls=lbls, facets=facets, qids=g.qids,
+                        na_syns=g.na_synonyms, col_fn=evalr(g.rename_cols),
+                        fmts=g.patch_format, lgr=lgr)
@@ -1,9 +1,10 @@
 import us
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_string_dtype, union_categoricals
 from cytoolz.itertoolz import unique
 from cytoolz.functoolz import thread_last, identity
-from cytoolz.curried import map, filter, curry
+from cytoolz.curried import map, filter
 from survey_stats import pdutil
 # import sys
 # import traceback as tb
@@ -24,9 +25,21 @@ US_STATES_FIPS_INTS = thread_last(
 )
 
 
-SITECODE_TRANSLATORS = {'fips':
-                        lambda x: (us.states.lookup('%.2d' % x).abbr if
-                                   int(x) in US_STATES_FIPS_INTS else 'NA'),
+# state abbreviation by fips code, 'NA' for codes of no state
+FIPS_ABBRS = np.array(['NA'] * (max(US_STATES_FIPS_INTS) + 1), dtype=object)
+for x in US_STATES_FIPS_INTS:
+    FIPS_ABBRS[x] = us.states.lookup('%.2d' % x).abbr
+
+
+def fips_to_abbr(s):
+    # truncating like int(), through the lookup array instead of per row
+    x = pd.to_numeric(s).values.astype(int)
+    ok = (x >= 0) & (x < len(FIPS_ABBRS))
+    return pd.Series(np.where(ok, FIPS_ABBRS[np.where(ok, x, 0)], 'NA'),
+                     index=s.index, name=s.name)
+
+
+SITECODE_TRANSLATORS = {'fips': fips_to_abbr,
                         'codes': identity}
 
 SVYDESIGN_COLS = ['sitecode', 'strata', 'psu', 'weight']
@@ -71,19 +84,35 @@ def eager_convert(s, fmt, lgr=logger):
     return c
 
 
-def eager_convert_categorical(s, lbls, fmts, lgr=logger):
-    fmt = None
-    if s.name in lbls.keys():
-        fmt = lbls[s.name]
-        lgr.debug('formatted with lbls', v=s.name)
-    elif s.name in fmts:
-        fmt = fmts[s.name]
-        lgr.info('found missing format to patch', v=s.name, fmt=fmt,
-                 levels=s.value_counts().to_dict())
+def label_codes(s, fmt):
+    """
+    s labelled through fmt, as eager_convert does, mapping the codes of
+    its distinct values to the format's levels instead of each value;
+    None when a value has no label
+    """
+    cats = pd.Categorical(pd.to_numeric(s, downcast='integer'))
+    if not all(v in fmt for v in cats.categories):
+        return None
+    lvls = list(unique([fmt[k] for k in sorted(fmt.keys())]))
+    pos = {l: i for i, l in enumerate(lvls)}
+    # code -1, missing, stays missing
+    lookup = np.array([pos[fmt[v]] for v in cats.categories] + [-1])
+    return pd.Series(pd.Categorical.from_codes(lookup[cats.codes], lvls),
+                     index=s.index, name=s.name)
+
+
+def label_column(s, lbls, fmts, lgr=logger):
+    fmt = lbls[s.name] if s.name in lbls else fmts.get(s.name)
     if not fmt:
         lgr.debug('could not find fmt for var, skipping', v=s.name)
         return s
-    return eager_convert(s, fmt, lgr)
+    c = label_codes(s, fmt)
+    if c is None:
+        lgr.info('value without label, check var labels! Passing...',
+                 col=s.name, fmt=fmt)
+        return s
+    lgr.debug('converted series with fmt', v=s.name, n_levels=len(c.cat.categories))
+    return c
 
 
 def filter_columns(df, facets, qids, lgr=logger):
@@ -101,13 +130,25 @@ def filter_columns(df, facets, qids, lgr=logger):
     return ndf
 
 
-def find_na_synonyms(na_syns, df):
-    df = df.applymap(
-        lambda x: np.nan if
-        (x.lower() in na_syns if type(x) == str else False)
-        else x)
-    logger.info("replaced NA synonyms", shp=df.shape)
-    return df
+def drop_na_synonyms(s, na_syns):
+    # labelled columns drop the categories, others mask matching strings
+    if s.dtype.name == 'category':
+        na = [c for c in s.cat.categories
+              if isinstance(c, str) and c.lower() in na_syns]
+        return s.cat.remove_categories(na) if na else s
+    if not is_string_dtype(s):
+        return s
+    try:
+        na = s.str.lower().isin(na_syns)
+    except AttributeError:
+        # no strings to match
+        return s
+    return s.where(~na) if na.any() else s
+
+
+def as_values(s):
+    # labels as plain values, as the merged frame is cast to categories
+    return s.astype(object) if s.dtype.name == 'category' else s
 
 
 def munge_df(df, r, lbls, facets, qids, na_syns, col_fn, fmts, fpc=False, lgr=logger):
@@ -121,16 +162,19 @@ def munge_df(df, r, lbls, facets, qids, na_syns, col_fn, fmts, fpc=False, lgr=lo
                     [r['sitecode'], r['year'], r['weight'], r['psu'], r['strata']] +
                     [k for k in facets]))
     ncols = {k: k.lower() for k in list(df.columns)}
-    ndf = (df.rename(index=str, columns=ncols)
+    na_syns = set(na_syns or [])
+    xdf = (df.rename(columns=ncols)
            .pipe(lambda xdf: filter_columns(xdf, facets, qids))
-           .reset_index(drop=True)
-           .apply(lambda x: eager_convert_categorical(x, lbls, fmts, lgr))
-           .rename(index=str, columns=facets)
-           .pipe(curry(find_na_synonyms)(na_syns))
+           .reset_index(drop=True))
+    # labels, then NA synonyms, on the codes of each column
+    cols = {c: as_values(drop_na_synonyms(label_column(xdf[c], lbls, fmts, lgr), na_syns))
+            for c in xdf.columns}
+    ndf = (pd.DataFrame(cols, columns=list(xdf.columns))
+           .rename(columns=facets)
            .reset_index(drop=True)
            .assign(year=int(year) if type(year) == int else df[year].astype(int),
-                   sitecode=df[r['sitecode']].apply(
-                       SITECODE_TRANSLATORS[r['sitecode_type']]).astype('category'),
+                   sitecode=SITECODE_TRANSLATORS[r['sitecode_type']](
+                       df[r['sitecode']]).astype('category'),
                    weight=df[r['weight']].astype(float),
                    strata=df[r['strata']].astype(int),
                    psu=df[r['psu']].astype(int))
@@ -143,3 +187,54 @@ def munge_df(df, r, lbls, facets, qids, na_syns, col_fn, fmts, fpc=False, lgr=lo
     lgr.info('completed SAS df munging')
     lgr.unbind('year')
     return ndf
+
+
+def concat_categories(parts):
+    # as astype('category') of the parts concatenated, without building that
+    try:
+        return union_categoricals(parts,
+                                  sort_categories=True)
+    except TypeError:
+        # categories of different types
+        return pd.Categorical(np.concatenate([np.asarray(p, dtype=object) for p in parts]))
+
+
+def merge_years(fps, fpc=False, lgr=logger):
+    """
+    the munged years spilled to fps as one frame, the same as
+    concatenating them and casting the columns to categories; every
+    year is held until the merge, its design columns as they are and
+    the rest as category codes, with only the year being read held
+    entirely in plain values
+    """
+    # sitecode is a category like the question columns
+    design = ['year', 'weight', 'strata', 'psu'] + \
+             (['fpc', 'sample_ct'] if fpc else [])
+    heads, parts, lens = [], [], []
+    for fp in fps:
+        df = pd.read_pickle(fp)
+        heads.append(df.iloc[:0])
+        lens.append(len(df))
+        parts.append({c: (df[c] if c in design else pd.Categorical(df[c]))
+                      for c in df.columns})
+        lgr.info('read spilled year', f=fp, shp=df.shape)
+        del df
+    cols = list(pd.concat(heads).columns)
+    merged = {}
+    for c in cols:
+        vals = [p[c] if c in p else pd.Categorical([np.nan] * n)
+                for p, n in zip(parts, lens)]
+        merged[c] = (pd.concat(vals, ignore_index=True) if c in design
+                     else concat_categories(vals))
+        for p in parts:
+            p.pop(c, None)
+    df = (pd.DataFrame(merged, columns=cols)
+          .assign(year=lambda xf: xf['year'].astype(int),
+                  weight=lambda xf: xf['weight'].astype(float),
+                  strata=lambda xf: xf['strata'].astype(int, errors='ignore'),
+                  psu=lambda xf: xf['psu'].astype(int, errors='ignore')))
+    if fpc:
+        df = df.assign(fpc=lambda xf: xf['fpc'].astype(int, errors='ignore'),
+                       sample_ct=lambda xf: xf['sample_ct'].astype(int, errors='ignore'))
+    lgr.info('merged survey years', years=len(fps), shp=df.shape)
+    return df.reset_index(drop=True)
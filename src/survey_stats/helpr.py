@@ -31,6 +31,32 @@ function(des, k){
 }
 ''')
 
+response_levels = robjects.r('''
+function(des, k){
+    v <- des$variables[[k]]
+    sort(unique(as.character(v[!is.na(v)])))
+}
+''')
+
+domain_survey_var = robjects.r('''
+function(des, mask, k){
+    if (!is.null(k)) mask <- mask & !is.na(des$variables[[k]])
+    des$prob[!mask] <- Inf
+    # lonely psus are averaged over the strata present, so strata with
+    # no rows in the domain are dropped as a physical subset would
+    strata <- des$strata[, 1]
+    keep <- strata %in% unique(strata[mask])
+    if (!all(keep) && any(des$fpc$sampsize[, 1] < 2)) des <- des[keep, ]
+    des
+}
+''')
+
+design_dim = robjects.r('''
+function(des){
+    c(sum(is.finite(des$prob)), ncol(des$variables))
+}
+''')
+
 tobool = robjects.r('''
 function(col) {
     as.logical( 2 - col)
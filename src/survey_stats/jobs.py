@@ -0,0 +1,348 @@
+import json
+import time
+import uuid
+import threading
+from collections import defaultdict, deque
+from survey_stats import log
+from survey_stats import settings
+from survey_stats.const import JOB_TTL, JOB_POLL_TIMEOUT, JOB_VISIBILITY_TIMEOUT
+from survey_stats.slicecache import to_json
+
+logger = log.getLogger(__name__)
+
+KEY_PREFIX = 'svy'
+MEMORY_URL = 'memory://'
+
+
+class MemoryRedis(object):
+    """
+    In-process stand-in for the few redis commands the job queue uses,
+    for tests and for running without a redis server
+    """
+
+    def __init__(self):
+        self.hashes = defaultdict(dict)
+        self.lists = defaultdict(deque)
+        self.cond = threading.Condition(threading.RLock())
+
+    def hmset(self, key, mapping):
+        with self.cond:
+            self.hashes[key].update({k: str(v) for k, v in mapping.items()})
+
+    def hsetnx(self, key, field, value):
+        with self.cond:
+            if field in self.hashes[key]:
+                return 0
+            self.hashes[key][field] = str(value)
+            return 1
+
+    def hincrby(self, key, field, amount=1):
+        with self.cond:
+            n = int(self.hashes[key].get(field, 0)) + amount
+            self.hashes[key][field] = str(n)
+            return n
+
+    def hget(self, key, field):
+        with self.cond:
+            return self.hashes.get(key, {}).get(field)
+
+    def hdel(self, key, *fields):
+        with self.cond:
+            h = self.hashes.get(key, {})
+            return sum(h.pop(f, None) is not None for f in fields)
+
+    def hgetall(self, key):
+        with self.cond:
+            return dict(self.hashes.get(key, {}))
+
+    def rpush(self, key, *values):
+        with self.cond:
+            self.lists[key].extend(values)
+            self.cond.notify_all()
+            return len(self.lists[key])
+
+    def lpush(self, key, *values):
+        with self.cond:
+            self.lists[key].extendleft(values)
+            self.cond.notify_all()
+            return len(self.lists[key])
+
+    def lrem(self, key, count, value):
+        # only the count > 0 form, removing from the head
+        with self.cond:
+            vals, n = self.lists.get(key, deque()), 0
+            while n < count and value in vals:
+                vals.remove(value)
+                n += 1
+            return n
+
+    def rpoplpush(self, src, dst):
+        with self.cond:
+            if not self.lists.get(src):
+                return None
+            val = self.lists[src].pop()
+            self.lists[dst].appendleft(val)
+            return val
+
+    def brpoplpush(self, src, dst, timeout=0):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                val = self.rpoplpush(src, dst)
+                if val is not None:
+                    return val
+                left = deadline - time.time()
+                if timeout and left <= 0:
+                    return None
+                self.cond.wait(left if timeout else None)
+
+    def lrange(self, key, start, end):
+        with self.cond:
+            vals = list(self.lists.get(key, []))
+        return vals[start:] if end == -1 else vals[start:end + 1]
+
+    def expire(self, key, secs):
+        # nothing outlives the process anyway
+        return True
+
+    def pipeline(self):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline(object):
+    """
+    Commands queued to run together on a MemoryRedis, as one transaction
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        cmd = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((cmd, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        # the condition is reentrant, so the commands can take it again
+        with self.redis.cond:
+            res = [cmd(*args, **kwargs) for (cmd, args, kwargs) in self.calls]
+        self.calls = []
+        return res
+
+
+def connect(url):
+    if url == MEMORY_URL:
+        return MemoryRedis()
+    import redis
+    return redis.StrictRedis.from_url(url, decode_responses=True)
+
+
+class JobQueue(object):
+    """
+    Slices of long queries queued in redis by priority, one list per
+    queue, for queue workers to compute and record one by one. A job is
+    a hash of counters, with a list of the results recorded so far and
+    a list of errors, so its progress can be read while it runs. Popped
+    slices wait in a processing list until recorded, and go back to
+    their queue when not recorded within the visibility timeout, so a
+    queue worker dying mid slice loses nothing.
+    """
+
+    def __init__(self, url=settings.REDIS_URL, queues=settings.QUEUES, ttl=JOB_TTL,
+                 visibility=JOB_VISIBILITY_TIMEOUT):
+        self.url = url
+        self.queues = list(queues)
+        self.ttl = ttl
+        self.visibility = visibility
+        self.redis = connect(url)
+
+    def key(self, *parts):
+        return ':'.join((KEY_PREFIX,) + parts)
+
+    def queue_key(self, name):
+        return self.key('queue', name)
+
+    def enqueue(self, query, slices, priority=None, results=()):
+        """
+        queue the slices of a query, with results already at hand (say
+        from the socrata table) recorded up front, returning the job id
+        """
+        priority = priority or self.queues[len(self.queues) // 2]
+        if priority not in self.queues:
+            raise ValueError('Unknown job priority: %s, expected one of %s' %
+                             (priority, self.queues))
+        job_id = uuid.uuid4().hex
+        jk = self.key('job', job_id)
+        self.redis.hmset(jk, {'priority': priority,
+                              'query': json.dumps(query, default=to_json),
+                              'total': len(slices) + len(results),
+                              'finished': len(results),
+                              'failed': 0,
+                              'created': time.time()})
+        for res in results:
+            self.redis.rpush(self.key('job', job_id, 'results'),
+                             json.dumps(res, default=to_json))
+        if slices:
+            # queues are popped from the right, so push on the left
+            self.redis.lpush(self.queue_key(priority),
+                             *[json.dumps({'job': job_id, 'slice': s}, default=to_json)
+                               for s in slices])
+        else:
+            self.redis.hmset(jk, {'done': time.time()})
+        for k in [jk, self.key('job', job_id, 'results'), self.key('job', job_id, 'errors')]:
+            self.redis.expire(k, self.ttl)
+        logger.info('queued job', job=job_id, priority=priority, slices=len(slices),
+                    ready=len(results))
+        return job_id
+
+    def claim(self, timeout):
+        # redis only blocks on one list when moving, so the others are
+        # polled in priority order between short waits on the first
+        deadline = time.time() + timeout
+        processing = self.key('processing')
+        while True:
+            for q in self.queues:
+                raw = self.redis.rpoplpush(self.queue_key(q), processing)
+                if raw is not None:
+                    return raw
+            left = deadline - time.time()
+            if left <= 0:
+                return None
+            raw = self.redis.brpoplpush(self.queue_key(self.queues[0]), processing,
+                                        max(1, int(min(left, 1))))
+            if raw is not None:
+                return raw
+
+    def pop(self, timeout=JOB_POLL_TIMEOUT):
+        # the next task, always from the highest priority queue with any
+        raw = self.claim(timeout)
+        if raw is None:
+            return None
+        self.redis.hmset(self.key('claimed'), {raw: time.time()})
+        task = json.loads(raw)
+        self.redis.hsetnx(self.key('job', task['job']), 'started', time.time())
+        task['raw'] = raw
+        return task
+
+    def recover(self):
+        """
+        requeue the slices claimed longer than the visibility timeout ago,
+        returning how many; a claim not yet timed counts from now
+        """
+        processing, claimed, n = self.key('processing'), self.key('claimed'), 0
+        for raw in self.redis.lrange(processing, 0, -1):
+            at = self.redis.hget(claimed, raw)
+            if at is None:
+                self.redis.hsetnx(claimed, raw, time.time())
+            elif time.time() - float(at) > self.visibility and \
+                    self.redis.lrem(processing, 1, raw):
+                task = json.loads(raw)
+                priority = self.redis.hget(self.key('job', task['job']), 'priority')
+                self.redis.hdel(claimed, raw)
+                if priority is not None:
+                    # next in line, it has waited long enough
+                    self.redis.rpush(self.queue_key(priority), raw)
+                    logger.warning('requeued slice', job=task['job'], sl=task['slice'])
+                    n += 1
+        return n
+
+    def record(self, task, result=None, error=None):
+        """
+        record the result or error of a popped slice, unless it was
+        recorded already, as a slice requeued while it ran is computed
+        twice, or its job has expired; returns whether it was recorded
+        """
+        job_id = task['job']
+        jk = self.key('job', job_id)
+        if not self.redis.lrem(self.key('processing'), 1, task['raw']):
+            logger.warning('slice recorded already, dropping', job=job_id, sl=task['slice'])
+            return False
+        self.redis.hdel(self.key('claimed'), task['raw'])
+        if self.redis.hget(jk, 'total') is None:
+            logger.warning('job expired, dropping slice', job=job_id, sl=task['slice'])
+            return False
+        if error is not None:
+            lk, val = self.key('job', job_id, 'errors'), error
+        else:
+            lk, val = self.key('job', job_id, 'results'), json.dumps(result, default=to_json)
+        # lists created by the first result need the job's ttl as well
+        (_, _, _, finished, _, h) = (self.redis.pipeline()
+                                     .rpush(lk, val)
+                                     .expire(lk, self.ttl)
+                                     .hincrby(jk, 'failed', int(error is not None))
+                                     .hincrby(jk, 'finished', 1)
+                                     .expire(jk, self.ttl)
+                                     .hgetall(jk)
+                                     .execute())
+        total = int(h.get('total', 0))
+        if finished >= total:
+            self.redis.hmset(jk, {'done': time.time()})
+            logger.info('finished job', job=job_id, slices=total)
+        return True
+
+    def status(self, job_id):
+        """
+        progress and the results recorded so far of a job, None when
+        it is unknown or expired
+        """
+        h = self.redis.hgetall(self.key('job', job_id))
+        if not h:
+            return None
+        total, finished, failed = [int(h[k]) for k in ['total', 'finished', 'failed']]
+        if 'done' in h:
+            state = 'failed' if failed else 'finished'
+        else:
+            state = 'running' if 'started' in h else 'queued'
+        return {'id': job_id,
+                'status': state,
+                'priority': h['priority'],
+                'query': json.loads(h['query']),
+                'total': total,
+                'finished': finished,
+                'failed': failed,
+                'progress': finished / total if total else 1.0,
+                'errors': self.redis.lrange(self.key('job', job_id, 'errors'), 0, -1),
+                'results': [json.loads(r) for r in
+                            self.redis.lrange(self.key('job', job_id, 'results'), 0, -1)]}
+
+
+def recover_every(queue, interval, stopped):
+    # from the start, then on a timer however long slices take
+    while True:
+        try:
+            queue.recover()
+        except Exception as e:
+            logger.error('requeueing slices failed', err=str(e))
+        if stopped.wait(interval):
+            return
+
+
+def consume(queue, compute, timeout=JOB_POLL_TIMEOUT, max_tasks=None):
+    """
+    compute queued slices until stopped, or until max_tasks are done;
+    compute takes a slice dict and returns its result records. Slices
+    claimed by dead queue workers are requeued in the background.
+    """
+    n = 0
+    logger.info('consuming jobs', url=queue.url, queues=queue.queues)
+    stopped = threading.Event()
+    threading.Thread(target=recover_every, args=(queue, max(queue.visibility / 2, 1), stopped),
+                     daemon=True).start()
+    try:
+        while max_tasks is None or n < max_tasks:
+            task = queue.pop(timeout)
+            if task is None:
+                continue
+            try:
+                queue.record(task, result=compute(task['slice']))
+            except Exception as e:
+                logger.error('queued slice failed', job=task['job'], sl=task['slice'], err=str(e))
+                queue.record(task, error='worker failure!' + str(e))
+            n += 1
+    finally:
+        stopped.set()
+    return n
@@ -0,0 +1,66 @@
+from concurrent.futures import ProcessPoolExecutor
+from survey_stats import log
+from survey_stats import state as st
+from survey_stats.slicecache import norm_filter
+
+logger = log.getLogger(__name__)
+
+# set once a pool process has loaded its designs
+_initialized = False
+
+
+def ensure_initialized(args):
+    global _initialized
+    if _initialized:
+        return
+    (dbc, cdir, use_feather, dsets, budget_mb) = args
+    logger.info('initializing local stats worker', dsets=dsets)
+    # same path as microservice.setup_app
+    st.initialize(dbc, cdir, init_des=True, use_feather=use_feather,
+                  init_svy=False, init_soc=False,
+                  preload=dsets, budget_mb=budget_mb)
+    _initialized = True
+
+
+def compute_batch(args, slices):
+    """
+    stats frames for a batch of slices, sharing subsets between slices
+    with the same filter; frames go back to the API pickled, which keeps
+    the column blocks binary instead of encoding every record as JSON
+    """
+    ensure_initialized(args)
+    domains = {}
+    res = []
+    for s in slices:
+        d = st.dset[s['d']]
+        dkey = (s['d'], s['q'], repr(norm_filter(s['f'])))
+        if dkey not in domains:
+            domains[dkey] = d.slice_domain(s['q'], s['f'])
+        res.append(d.fetch_stats_for_slice(s['q'], s['r'], s['vs'], s['f'],
+                                           s.get('rollup', False),
+                                           des=domains[dkey]))
+    return res
+
+
+class LocalStatsPool(object):
+    """
+    Process pool computing slices in place of a remote stats worker,
+    each process holding its own designs once its first batch arrives.
+    """
+
+    def __init__(self, nworkers, dbc, cdir, use_feather, dsets=None, budget_mb=0):
+        self.nworkers = nworkers
+        self.args = (dbc, cdir, use_feather, dsets, budget_mb)
+        self.pool = ProcessPoolExecutor(max_workers=nworkers)
+
+    def warm(self):
+        # best effort to load designs in every process before the first
+        # request, each process takes one of these while it initializes
+        return [self.pool.submit(ensure_initialized, self.args)
+                for _ in range(self.nworkers)]
+
+    def submit(self, slices):
+        return self.pool.submit(compute_batch, self.args, slices)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,71 @@
+import os
+import resource
+from survey_stats import log
+
+logger = log.getLogger(__name__)
+
+SMAPS_FIELDS = {
+    'Rss': 'rss',
+    'Pss': 'pss',
+    'Shared_Clean': 'shared',
+    'Shared_Dirty': 'shared',
+    'Private_Clean': 'private',
+    'Private_Dirty': 'private',
+    'Swap': 'swap'
+}
+
+
+def smaps_memory(pid='self'):
+    """
+    resident memory of a process in kB, split into pages shared with
+    other processes (e.g. a preloading master) and pages unique to it
+    """
+    mem = {'rss': 0, 'pss': 0, 'shared': 0, 'private': 0, 'swap': 0}
+    proc = '/proc/%s' % pid
+    fn = os.path.join(proc, 'smaps_rollup')
+    if not os.path.isfile(fn):
+        # kernels before 4.14 only have per mapping stats
+        fn = os.path.join(proc, 'smaps')
+    try:
+        with open(fn) as fh:
+            for line in fh:
+                parts = line.split()
+                if len(parts) == 3 and parts[0][:-1] in SMAPS_FIELDS:
+                    mem[SMAPS_FIELDS[parts[0][:-1]]] += int(parts[1])
+    except (IOError, OSError) as e:
+        logger.warn('unable to read process memory', pid=pid, err=str(e))
+        return None
+    return mem
+
+
+def peak_memory_mb():
+    # the most this process has held resident, kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def child_pids(ppid):
+    pids = []
+    for d in os.listdir('/proc'):
+        if not d.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % d) as fh:
+                # ppid is the second field after the parenthesized command
+                if int(fh.read().rsplit(')', 1)[1].split()[1]) == ppid:
+                    pids.append(int(d))
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return sorted(pids)
+
+
+def worker_memory(ppid=None):
+    """
+    memory of the master and each of its workers, for sizing how many
+    workers fit on a node: a worker costs its private pages, while the
+    shared ones are paid once by the master
+    """
+    ppid = ppid or os.getppid()
+    workers = {pid: smaps_memory(pid) for pid in child_pids(ppid)}
+    return {'master': smaps_memory(ppid),
+            'workers': workers,
+            'private_total': sum(m['private'] for m in workers.values() if m)}
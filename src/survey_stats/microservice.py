@@ -1,10 +1,15 @@
+import gc
+import sys
+import json
 import traceback
 import cattr
 import attr
+import pandas as pd
 import flask_transmute
-from flask import Flask, Blueprint
+from flask import Flask, Blueprint, jsonify, request, stream_with_context
+from flask import Response
 from flask_transmute import (
-    route, annotate, Response, APIException
+    route, annotate, APIException
 )
 from typing import (
     Optional, Sequence, Callable, TypeVar, Mapping, Union, Dict, List
@@ -13,11 +18,17 @@ from typing import (
 from survey_stats import log
 from survey_stats import state as st
 from survey_stats.types import T
+from survey_stats.slicecache import SliceCache, slice_key, norm_filter, to_json
+from survey_stats.memstat import smaps_memory, worker_memory
+from survey_stats.encoding import negotiate, encode_frame
+from survey_stats.jobs import JobQueue, consume
+from survey_stats.const import DEFAULT_SLICE_CACHE_MB, NDJSON_MIMETYPE
 
 logger = log.getLogger(__name__)
 
 db_cfg = None
 cache_dir = None
+slice_cache = None
 
 app = Flask(__name__)
 
@@ -26,31 +37,147 @@ app = Flask(__name__)
 class SvySlice(object):
     d: str = attr.ib()
     q: str = attr.ib()
-    r: str = attr.ib()
+    r: Optional[str] = attr.ib()
     vs: Sequence[str] = attr.ib()
     f: Mapping[str, Sequence[str]] = attr.ib()
+    rollup: bool = attr.ib(default=False)
 
 @attr.s
 class SvyStats(dict):
     pass
 
 
+def compute_slice(s, domains=None, as_frame=False):
+    """
+    stats records (or frame) for a slice, from the slice cache when
+    possible; with a domains dict, subsets are shared by slices with the
+    same filter
+    """
+    svy = st.dset[s.d]
+    key = slice_key(s.d, svy.stats_version, s.q, s.r, s.vs, s.f, s.rollup)
+    result = slice_cache.get(key)
+    if result is not None:
+        logger.info('slice cache hit', d=s.d, q=s.q, r=s.r, vs=s.vs, f=s.f)
+        return pd.DataFrame(result) if as_frame else result
+    des = None
+    if domains is not None:
+        dkey = (s.d, s.q, json.dumps(norm_filter(s.f)))
+        if dkey not in domains:
+            domains[dkey] = svy.slice_domain(s.q, s.f)
+        des = domains[dkey]
+    df = svy.fetch_stats_for_slice(s.q, s.r, s.vs, s.f, s.rollup, des=des)
+    result = df.to_dict(orient='records')
+    logger.info('got the results!', res=result)
+    slice_cache.put(key, result, s.d, svy.stats_version)
+    return df if as_frame else result
+
+
+@app.before_request
+def compute_binary():
+    """
+    answer /stats in Arrow or msgpack when the Accept header asks for it,
+    leaving JSON requests to the transmute route
+    """
+    if request.path != '/stats' or request.method != 'POST':
+        return None
+    mimetype, coding = negotiate(request.headers.get('Accept'),
+                                 request.headers.get('Accept-Encoding'))
+    if mimetype is None:
+        return None
+    try:
+        df = compute_slice(cattr.structure(request.get_json(), SvySlice), as_frame=True)
+    except Exception as ex:
+        return Response(json.dumps({'success': False,
+                                    'message': 'worker failure!' + str(ex)}),
+                        status=400, mimetype='application/json')
+    resp = Response(encode_frame(df, mimetype, coding), mimetype=mimetype)
+    if coding is not None:
+        resp.headers['Content-Encoding'] = coding
+    resp.headers['Vary'] = 'Accept, Accept-Encoding'
+    return resp
+
+
 @route(app, body_parameters="s", paths='/stats', methods=['POST'])
 def compute(s: SvySlice) -> [SvyStats]:
     try:
-        svy = st.dset[s.d]
-        result = (svy.fetch_stats_for_slice(s.q, s.r, s.vs, s.f)
-                     .to_dict(orient='records'))
-        logger.info('got the results!', res=result)
+        result = compute_slice(s)
     except Exception as ex:
         raise APIException('worker failure!' +  str(ex))
     return result
 
 
-def setup_app(dbc, cdir, use_feather):
-    app.config.update(dbc=dbc, cache_dir=cdir)
+@app.route('/stats/batch', methods=['POST'])
+def compute_batch():
+    """
+    compute a list of slices, streaming one NDJSON line per slice as it
+    finishes: {"i": <index in batch>, "result": [...]} or "error" instead
+    """
+    slices = [cattr.structure(x, SvySlice) for x in request.get_json()]
+    logger.info('computing slice batch', n=len(slices))
+
+    def generate():
+        domains = {}
+        for i, s in enumerate(slices):
+            try:
+                line = {'i': i, 'result': compute_slice(s, domains)}
+            except Exception as ex:
+                logger.error('slice failed in batch', sl=attr.asdict(s), err=str(ex))
+                line = {'i': i, 'error': 'worker failure!' + str(ex)}
+            yield json.dumps(line, default=to_json) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype=NDJSON_MIMETYPE)
+
+
+@app.route('/', methods=['GET'])
+def check_status():
+    return jsonify({'datasets': {k: {'version': d.version, 'timings': d.timings,
+                                     'parts': d.loaded_parts, 'nbytes': d.nbytes}
+                                 for k, d in st.dset.loaded().items()},
+                    'available': list(st.dset.keys()),
+                    'slice_cache': slice_cache.info(),
+                    'preload': app.config['preload'],
+                    'memory': worker_memory()})
+
+
+def log_worker_memory(worker):
+    # gunicorn post_worker_init hook
+    logger.info('worker started', pid=worker.pid, memory=smaps_memory())
+
+
+def share_designs():
+    """
+    keep the designs loaded by the master on pages shared copy-on-write
+    with the workers: stop the forced R and python collections, and move
+    everything allocated so far out of reach of python's collector
+    """
+    rsvy = sys.modules.get('survey_stats.survey')
+    if rsvy is not None:
+        rsvy.FORCE_GC = False
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    logger.info('sharing preloaded designs with workers', memory=smaps_memory())
+
+
+def consume_jobs(url, queues, max_tasks=None):
+    # a queue worker, computing queued slices the way /stats does
+    queue = JobQueue(url, queues)
+    return consume(queue, lambda s: compute_slice(cattr.structure(s, SvySlice)),
+                   max_tasks=max_tasks)
+
+
+def setup_app(dbc, cdir, use_feather, cache_mb=DEFAULT_SLICE_CACHE_MB,
+              preload=False, dsets=None, budget_mb=0):
+    global slice_cache
+    app.config.update(dbc=dbc, cache_dir=cdir, preload=preload)
+    slice_cache = SliceCache(cdir, max_mb=cache_mb, persist=cache_mb > 0)
+    # drop persisted results of older artifacts as each dataset loads
+    st.dset.on_load.append(lambda k, d: slice_cache.invalidate(k, d.stats_version))
     st.initialize(dbc, cdir, init_des=True,
                   use_feather=use_feather,
-                  init_svy=False, init_soc=False)
+                  init_svy=False, init_soc=False,
+                  preload=dsets, budget_mb=budget_mb)
+    if preload:
+        share_designs()
     return app
 
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from timeit import default_timer as timer
+from survey_stats import log
+from survey_stats.const import STATUS_CHECK_INTERVAL
+
+logger = log.getLogger(__name__)
+
+
+class StatusMonitor(object):
+    """
+    Polls the database and the stats workers in the background and keeps
+    the latest results, so status and readiness requests are answered
+    from memory without blocking the event loop.
+    """
+
+    def __init__(self, dbc=None, balancer=None, interval=STATUS_CHECK_INTERVAL):
+        self.dbc = dbc
+        self.balancer = balancer
+        self.interval = interval
+        self.engine = None
+        self.db = None
+        self.workers = {}
+        self.checked_at = None
+
+    def connect(self):
+        # one pooled engine for the life of the process
+        if self.engine is None and self.dbc is not None:
+            import sqlalchemy as sa
+            self.engine = sa.create_engine(self.dbc.uri, pool_size=1,
+                                           pool_recycle=3600)
+        return self.engine
+
+    def check_db(self):
+        engine = self.connect()
+        if engine is None:
+            return None
+        start = timer()
+        try:
+            with engine.connect() as conn:
+                conn.execute('select 1')
+            tables = engine.table_names()
+        except Exception as e:
+            logger.info('database status check failed', err=str(e))
+            return {'error': str(e)}
+        return {'host': engine.url.host,
+                'engine': engine.name,
+                'tables': tables,
+                'latency': timer() - start}
+
+    async def poll(self, transport):
+        loop = asyncio.get_event_loop()
+        db = loop.run_in_executor(None, self.check_db)
+        if self.balancer is not None:
+            self.workers = await self.balancer.check_health(transport)
+        self.db = await db
+        self.checked_at = time.time()
+
+    async def run(self, transport):
+        while True:
+            try:
+                await self.poll(transport)
+            except asyncio.CancelledError:
+                # an Exception before python 3.8, and shutdown needs it
+                raise
+            except Exception as e:
+                logger.warn('status check failed', err=str(e))
+            await asyncio.sleep(self.interval)
+
+    def readiness(self, dsets=(), loaded=()):
+        """
+        reasons the process cannot serve yet: the first check has not
+        run, the database or every worker is unreachable, or a dataset
+        to preload is not loaded. loaded are the datasets with their parts
+        warmed, which the memory budget takes back when it evicts them
+        """
+        reasons = []
+        if self.checked_at is None:
+            reasons.append('status not checked yet')
+        if self.db is not None and 'error' in self.db:
+            reasons.append('database unreachable')
+        if self.workers and all('error' in w for w in self.workers.values()):
+            reasons.append('no stats worker reachable')
+        missing = [k for k in dsets if k not in loaded]
+        if missing:
+            reasons.append('datasets not loaded: %s' % ','.join(missing))
+        return reasons
+
+    def info(self):
+        return {'db': self.db,
+                'worker_status': self.workers,
+                'workers': self.balancer.info() if self.balancer else [],
+                'checked_at': self.checked_at,
+                'age': None if self.checked_at is None else time.time() - self.checked_at}
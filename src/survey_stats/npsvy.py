@@ -0,0 +1,602 @@
+import os
+import json
+import shutil
+import attr
+import feather
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import expit
+from scipy.stats import t as tdist
+from typing import Optional
+from survey_stats import log
+from survey_stats import pdutil as u
+from survey_stats.const import DECIMALS
+from survey_stats.dbi import get_snapshot_path
+
+logger = log.getLogger()
+
+# threshold used by the R survey package to detect self-representing strata
+SELF_REP_FPC = 0.0000001
+
+# design arrays kept in a snapshot, the variables come from the feather
+SNAPSHOT_ARRAYS = ['weight', 'strata', 'psu', 'psu_strata', 'n_psu', 'fpc']
+
+
+@attr.s(slots=True, frozen=True)
+class ResponseIndicator(object):
+    qn: str = attr.ib()
+    r: str = attr.ib()
+
+
+@attr.s(slots=True, frozen=True)
+class PsuTotals(object):
+    group: np.ndarray = attr.ib()
+    psu: np.ndarray = attr.ib()
+    wy: np.ndarray = attr.ib()
+    w: np.ndarray = attr.ib()
+    ny: np.ndarray = attr.ib()
+    n: np.ndarray = attr.ib()
+
+
+@attr.s(slots=True, frozen=True)
+class ReplicateWeights(object):
+    """
+    Replicate weights of a design, held as one multiplier of the base
+    weight per (psu, replicate) since every row of a psu shares them:
+    base plus the (psu, replicate) entry of factors, which is sparse
+    for the jackknives. Variance is
+    scale * sum(rscales * (theta_r - mean(theta_r))^2), like svrVar()
+    with mse=FALSE.
+    """
+    method: str = attr.ib()
+    factors: np.ndarray = attr.ib()
+    scale: float = attr.ib()
+    rscales: np.ndarray = attr.ib()
+    degf: int = attr.ib()
+    base: float = attr.ib(default=0.0)
+
+
+@attr.s(slots=True, frozen=True)
+class SurveyDesign(object):
+    """
+    Stratified cluster design held as flat arrays, equivalent to
+        svydesign(id=~psu, weight=~weight, strata=~strata, nest=TRUE, fpc=~fpc)
+    where strata and psus are integer indices (psus nested in strata)
+    and `domain` marks the rows selected by the current subset.
+    """
+    variables: pd.DataFrame = attr.ib()
+    weight: np.ndarray = attr.ib()
+    strata: np.ndarray = attr.ib()
+    psu: np.ndarray = attr.ib()
+    psu_strata: np.ndarray = attr.ib()
+    n_psu: np.ndarray = attr.ib()
+    fpc: np.ndarray = attr.ib()
+    lonely_psu: str = attr.ib()
+    domain: Optional[np.ndarray] = attr.ib(default=None)
+    replicates: Optional[ReplicateWeights] = attr.ib(default=None)
+
+    @property
+    def nrow(self):
+        return len(self.weight)
+
+    def rows(self, valid=None):
+        mask = np.ones(self.nrow, dtype=bool) if valid is None else valid
+        if self.domain is not None:
+            mask = mask & self.domain
+        return np.flatnonzero(mask)
+
+
+def response_formula(qn, r):
+    return ResponseIndicator(qn=qn, r=r)
+
+
+def ngroup(df, cols):
+    return df.groupby(cols, sort=True).ngroup().values.astype(np.int64)
+
+
+def des_from_frame(df, denovo=False, fpc=False, design='cluster'):
+    strata_cols = ['year', 'strata'] if denovo else ['strata']
+    strata = ngroup(df, strata_cols)
+    if design == 'cluster':
+        psu = ngroup(df, strata_cols + ['psu'])
+    else:
+        # id=~1, every observation is its own psu
+        psu = np.arange(df.shape[0], dtype=np.int64)
+    psu_strata = np.zeros(psu.max() + 1 if len(psu) else 0, dtype=np.int64)
+    psu_strata[psu] = strata
+    n_psu = np.bincount(psu_strata)
+    f = np.ones(len(n_psu))
+    if fpc:
+        # fpc <= 1 is a sampling fraction, otherwise a population size
+        pop = (df.fpc.groupby(strata).first()
+               .reindex(range(len(n_psu))).values.astype(float))
+        if np.all(pop <= 1):
+            pop = n_psu / pop
+        f = np.where(np.isinf(pop), 1.0, (pop - n_psu) / pop)
+    return SurveyDesign(variables=df,
+                        weight=df.weight.values.astype(float),
+                        strata=strata, psu=psu, psu_strata=psu_strata,
+                        n_psu=n_psu, fpc=f,
+                        lonely_psu=('average' if fpc and design == 'cluster'
+                                    else 'fail'))
+
+
+def replicate_base(des, method):
+    # the multiplier of every psu a replicate does not reweight
+    if method == 'JK1':
+        npsu = len(des.psu_strata)
+        return npsu / (npsu - 1.0)
+    return 1.0 if method == 'JKn' else 0.0
+
+
+def replicate_factors(des, method, nrep=None, seed=0):
+    """
+    psu x replicate weight multipliers as built by as.svrepdesign(),
+    less replicate_base: JK1 drops one psu at a time ignoring strata,
+    JKn drops one psu of a stratum and reweights the rest of it, and
+    bootstrap is the Rao-Wu rescaled bootstrap drawing n_h - 1 psus per
+    stratum. Strata with a single psu get no jackknife replicates. The
+    jackknives only move multipliers within the dropped psu's stratum,
+    so theirs are sparse.
+    """
+    npsu = len(des.psu_strata)
+    if method == 'JK1':
+        f = sparse.diags(np.full(npsu, -replicate_base(des, method)), format='csc')
+    elif method == 'JKn':
+        drop = np.flatnonzero(des.n_psu[des.psu_strata] > 1)
+        h = des.psu_strata[drop]
+        order = np.argsort(h, kind='mergesort')
+        rows, cols, vals = [], [], []
+        for reps in np.split(order, np.flatnonzero(np.diff(h[order])) + 1):
+            # every psu of the stratum, against each replicate dropping one
+            nh = len(reps)
+            v = np.full((nh, nh), 1.0 / (nh - 1))
+            np.fill_diagonal(v, -1.0)
+            rows.append(np.repeat(drop[reps], nh))
+            cols.append(np.tile(reps, nh))
+            vals.append(v.ravel())
+        f = sparse.csc_matrix((np.concatenate(vals or [[]]),
+                               (np.concatenate(rows or [[]]).astype(int),
+                                np.concatenate(cols or [[]]).astype(int))),
+                              shape=(npsu, len(drop)))
+    elif method == 'bootstrap':
+        nrep = nrep or 50
+        rng = np.random.RandomState(seed)
+        f = np.ones((npsu, nrep))
+        for h, nh in enumerate(des.n_psu):
+            if nh < 2:
+                continue
+            psus = np.flatnonzero(des.psu_strata == h)
+            draws = rng.randint(0, nh, size=(nh - 1, nrep))
+            counts = np.zeros((nh, nrep))
+            np.add.at(counts, (draws, np.arange(nrep)), 1)
+            f[psus] = counts * nh / (nh - 1.0)
+    else:
+        raise NotImplementedError('Replicate method must be JK1, JKn or bootstrap!')
+    return f
+
+
+def replicate_weights(des, method, factors):
+    nrep = factors.shape[1]
+    base = replicate_base(des, method)
+    if method == 'JK1':
+        npsu = len(des.psu_strata)
+        scale = (npsu - 1.0) / npsu
+        if len(des.n_psu) == 1:
+            scale *= des.fpc[0]
+        return ReplicateWeights(method=method, factors=factors, scale=scale,
+                                rscales=np.ones(nrep), degf=nrep - 1, base=base)
+    if method == 'JKn':
+        # the stratum of each replicate is that of its dropped psu
+        h = des.psu_strata[np.asarray(factors.argmin(axis=0)).ravel()]
+        nh = des.n_psu[h].astype(float)
+        return ReplicateWeights(method=method, factors=factors, scale=1.0,
+                                rscales=des.fpc[h] * (nh - 1) / nh,
+                                degf=nrep - len(np.unique(h)), base=base)
+    return ReplicateWeights(method=method, factors=factors,
+                            scale=1.0 / (nrep - 1), rscales=np.ones(nrep),
+                            degf=nrep - 1, base=base)
+
+
+def replicate_params(method, nrep=None, seed=0):
+    # what the saved factors were generated with, kept in a sidecar
+    return {'method': method, 'replicates': nrep, 'seed': seed}
+
+
+def save_replicates(des, rep_file, method, nrep=None, seed=0):
+    """
+    save the factors as (psu, rep, factor) triples of their non-zero
+    entries, with the parameters and shape they were built with in a
+    json sidecar
+    """
+    factors = replicate_factors(des, method, nrep, seed)
+    logger.info('saving replicate weights', f=rep_file, method=method,
+                shape=factors.shape)
+    coo = sparse.coo_matrix(factors)
+    feather.write_dataframe(pd.DataFrame({'psu': coo.row, 'rep': coo.col,
+                                          'factor': coo.data}), rep_file)
+    with open(rep_file + '.json', 'w') as fh:
+        json.dump(dict(replicate_params(method, nrep, seed),
+                       shape=list(factors.shape)), fh)
+    return factors
+
+
+def saved_replicate_params(rep_file):
+    # parameters and shape of the saved factors, Nones when there are none
+    if not (os.path.isfile(rep_file) and os.path.isfile(rep_file + '.json')):
+        return None, None
+    with open(rep_file + '.json') as fh:
+        saved = json.load(fh)
+    return saved, tuple(saved.pop('shape'))
+
+
+def read_replicates(rep_file, npsu, method, nrep=None, seed=0):
+    # saved factors, when they were built for this design and these parameters
+    saved, shape = saved_replicate_params(rep_file)
+    if saved is None:
+        return None
+    if saved != replicate_params(method, nrep, seed) or shape[0] != npsu:
+        logger.warn('replicate weights do not match design, regenerating',
+                    f=rep_file, saved=saved, shape=shape)
+        return None
+    df = feather.read_dataframe(rep_file)
+    return sparse.csc_matrix((df.factor.values, (df.psu.values, df.rep.values)),
+                             shape=shape)
+
+
+def with_replicates(des, rep_file, method, nrep=None, seed=0):
+    """
+    attach replicate weights stored next to the surveys data, generating
+    them on first use or when they were built with other parameters;
+    estimates then take their variance from the replicates instead of
+    linearization
+    """
+    factors = read_replicates(rep_file, len(des.psu_strata), method, nrep, seed)
+    if factors is None:
+        factors = save_replicates(des, rep_file, method, nrep, seed)
+    return attr.evolve(des, replicates=replicate_weights(des, method, factors))
+
+
+def save_snapshot(des, snap):
+    # one .npy per design array, so a later boot can memory-map them
+    tmp = '%s.%d.tmp' % (snap, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for k in SNAPSHOT_ARRAYS:
+        np.save(os.path.join(tmp, k + '.npy'), getattr(des, k))
+    with open(os.path.join(tmp, 'lonely_psu'), 'w') as fh:
+        fh.write(des.lonely_psu)
+    try:
+        os.rename(tmp, snap)
+    except OSError:
+        # another worker saved the same snapshot first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_snapshot(df, snap):
+    arrays = {k: np.load(os.path.join(snap, k + '.npy'), mmap_mode='r')
+              for k in SNAPSHOT_ARRAYS}
+    if len(arrays['weight']) != df.shape[0]:
+        raise ValueError('Snapshot %s does not match the surveys data' % snap)
+    with open(os.path.join(snap, 'lonely_psu')) as fh:
+        lonely_psu = fh.read()
+    return SurveyDesign(variables=df, lonely_psu=lonely_psu, **arrays)
+
+
+def des_from_feather(fthr_file, denovo=False, fpc=False, design='cluster',
+                     replicates=None, rep_file=None, snapshot=True):
+    df = feather.read_dataframe(fthr_file)
+    snap = get_snapshot_path(fthr_file, 'npdes', denovo, fpc, design) if snapshot else None
+    des = None
+    if snap and os.path.isdir(snap):
+        logger.info('loading numpy survey design snapshot', f=snap)
+        try:
+            des = load_snapshot(df, snap)
+        except (OSError, ValueError) as e:
+            # a partial snapshot is replaced by the one built below
+            logger.warn('failed to load numpy survey design snapshot, rebuilding',
+                        f=snap, err=str(e))
+            shutil.rmtree(snap, ignore_errors=True)
+    if des is None:
+        logger.info('creating numpy survey design from data and annotations',
+                    cols=list(df.columns))
+        des = des_from_frame(df, denovo=denovo, fpc=fpc, design=design)
+        if snap:
+            logger.info('saving numpy survey design snapshot', f=snap)
+            save_snapshot(des, snap)
+    if replicates is not None:
+        des = with_replicates(des, rep_file, replicates.method,
+                              replicates.replicates, replicates.seed)
+    return des
+
+
+def dim_design(des):
+    return np.array([len(des.rows()), des.variables.shape[1]])
+
+
+def isin_col(col, vals):
+    vals = vals if type(vals) in (list, set, tuple) else [vals]
+    if col.dtype.name in ('category', 'object'):
+        return col.isin(vals).values
+    # compare like R's %in%, which coerces both sides to character
+    return col.astype(str).isin([str(v) for v in vals]).values
+
+
+def subset_survey(des, filt, qn=None):
+    # filt is a dict with vars as keys and list of acceptable values as levels
+    if not len(filt.keys()) > 0:
+        # empty filter, return original design object
+        return des
+    mask = np.ones(des.nrow, dtype=bool)
+    for k, v in filt.items():
+        mask &= isin_col(des.variables[k], v)
+    if qn:
+        mask &= pd.notnull(des.variables[qn]).values
+    if des.domain is not None:
+        mask &= des.domain
+    return attr.evolve(des, domain=mask)
+
+
+def domain_survey(des, mask, qn=None):
+    # restrict estimation to the rows in mask without copying the design
+    if qn:
+        mask = mask & pd.notnull(des.variables[qn]).values
+    if des.domain is not None:
+        mask = mask & des.domain
+    return attr.evolve(des, domain=mask)
+
+
+def facet_frame(des, fthr_file, cols):
+    # columns to index for domain masks, already in memory for this engine
+    return des.variables[[c for c in cols if c in des.variables.columns]]
+
+
+def response_codes(des, qn_f):
+    """
+    index of each row's response among the requested levels, with
+    len(resps) for any other valid response and -1 when missing;
+    a response of None requests every level observed for the question
+    """
+    col = des.variables[qn_f.qn]
+    valid = pd.notnull(col).values
+    if qn_f.r is None:
+        if col.dtype.name == 'category':
+            codes = col.cat.codes.values.astype(np.int64)
+            used = np.unique(codes[codes >= 0])
+            remap = np.full(len(col.cat.categories) + 1, -1, dtype=np.int64)
+            remap[used] = np.arange(len(used))
+            return remap[codes], [col.cat.categories[c] for c in used]
+        codes, resps = pd.factorize(col, sort=True)
+        return codes.astype(np.int64), list(resps)
+    if col.dtype.name == 'category':
+        y = np.asarray(col == qn_f.r) if qn_f.r in col.cat.categories \
+            else np.zeros(des.nrow, dtype=bool)
+    else:
+        y = (col.astype(str) == str(qn_f.r)).values
+    return np.where(valid, np.where(y, 0, 1), -1), [qn_f.r]
+
+
+def group_levels(des, idx, vs):
+    # integer codes (-1 for missing) and levels of each var over rows in idx
+    codes, levels = [], []
+    for v in vs:
+        col = des.variables[v].iloc[idx]
+        if col.dtype.name == 'category':
+            lvls = list(col.cat.categories)
+            c = col.cat.codes.values.astype(np.int64)
+        else:
+            c, lvls = pd.factorize(col, sort=True)
+            lvls = list(lvls)
+        codes.append(c.astype(np.int64))
+        levels.append(lvls)
+    return codes, levels
+
+
+def level_grid(vs, levels):
+    # every combination of levels, first var varying fastest like expand.grid()
+    ngroups = int(np.prod([len(l) for l in levels])) if len(vs) > 0 else 1
+    grid = {}
+    inner = 1
+    for v, lvls in zip(vs, levels):
+        outer = ngroups // (inner * len(lvls)) if len(lvls) else 0
+        grid[v] = np.tile(np.repeat(np.array(lvls, dtype=object), inner), outer)
+        inner *= len(lvls)
+    return pd.DataFrame(grid, columns=vs, index=range(ngroups))
+
+
+def sum_by(inv, x, n=0):
+    if x.ndim == 1:
+        return np.bincount(inv, x, minlength=n)
+    return np.stack([np.bincount(inv, x[:, j], minlength=n)
+                     for j in range(x.shape[1])], axis=1)
+
+
+def psu_totals(des, idx, codes, nresp, groups):
+    """
+    weighted and unweighted sums over every (group, psu) pair in the
+    domain, with a column of response totals for each requested level
+    """
+    npsu = len(des.psu_strata)
+    key = groups * npsu + des.psu[idx]
+    pairs, inv = np.unique(key, return_inverse=True)
+    w = des.weight[idx]
+    cell = inv * (nresp + 1) + codes[idx]
+    shape = (len(pairs), nresp + 1)
+    return PsuTotals(group=pairs // npsu, psu=pairs % npsu,
+                     wy=np.bincount(cell, w, minlength=shape[0] * shape[1])
+                       .reshape(shape)[:, :nresp],
+                     w=np.bincount(inv, w),
+                     ny=np.bincount(cell, minlength=shape[0] * shape[1])
+                       .reshape(shape)[:, :nresp],
+                     n=np.bincount(inv))
+
+
+def coarsen_totals(tot, group, keep):
+    # re-aggregate (group, psu) totals onto a coarser grouping
+    npsu = int(tot.psu.max()) + 1 if len(tot.psu) else 1
+    key = group[keep] * npsu + tot.psu[keep]
+    pairs, inv = np.unique(key, return_inverse=True)
+    return PsuTotals(group=pairs // npsu, psu=pairs % npsu,
+                     wy=sum_by(inv, tot.wy[keep]),
+                     w=sum_by(inv, tot.w[keep]),
+                     ny=sum_by(inv, tot.ny[keep]),
+                     n=sum_by(inv, tot.n[keep]))
+
+
+def linearized_variance(des, group, psu, z, ngroups):
+    """
+    variance of the psu totals z within strata, as in survey:::onestage,
+    with absent psus of a present stratum contributing zero totals and
+    lonely psus handled per the design's lonely_psu rule, averaged over
+    the strata the group's domain reaches as on a physical subset
+    """
+    nstrata = len(des.n_psu)
+    key = group * nstrata + des.psu_strata[psu]
+    cells, inv = np.unique(key, return_inverse=True)
+    cgroup = cells // nstrata
+    cstrat = cells % nstrata
+    nh = des.n_psu[cstrat].astype(float)
+    present = np.bincount(inv)
+    mean = np.bincount(inv, z) / nh
+    ss = np.bincount(inv, (z - mean[inv]) ** 2) + (nh - present) * mean ** 2
+    f = des.fpc[cstrat]
+    lonely = nh < 2
+    selfrep = f < SELF_REP_FPC
+    scale = np.where(lonely, f, f * nh / np.maximum(nh - 1, 1))
+    bad = lonely & ~selfrep
+    if bad.any() and des.lonely_psu != 'average':
+        raise ValueError('Stratum has only one PSU, set lonely_psu to average')
+    contrib = np.where(selfrep | bad, 0.0, scale * ss)
+    var = np.bincount(cgroup, contrib, minlength=ngroups)
+    nstrat = np.bincount(cgroup, minlength=ngroups).astype(float)
+    nok = np.bincount(cgroup, ~bad, minlength=ngroups)
+    degf = np.bincount(group, minlength=ngroups) - nstrat
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = var * nstrat / nok
+    return var, degf
+
+
+def replicate_totals(des, tot, x, ngroups):
+    # (group x psu) totals times the psu replicate multipliers
+    rep = des.replicates
+    m = sparse.csr_matrix((x, (tot.group, tot.psu)),
+                          shape=(ngroups, len(des.psu_strata)))
+    t = m @ rep.factors
+    t = t.toarray() if sparse.issparse(t) else np.asarray(t)
+    return t + rep.base * np.bincount(tot.group, x, minlength=ngroups)[:, None]
+
+
+def replicate_variance(des, tot, wy, w_rep, ngroups):
+    rep = des.replicates
+    with np.errstate(divide='ignore', invalid='ignore'):
+        theta = replicate_totals(des, tot, wy, ngroups) / w_rep
+    dev = theta - theta.mean(axis=1)[:, None]
+    var = rep.scale * (dev ** 2 @ rep.rscales)
+    return var, np.full(ngroups, rep.degf, dtype=float)
+
+
+def xlogit_ci(p, se, degf, level=0.95):
+    # svyciprop(method='xlogit'): symmetric interval on the logit scale
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eta = np.log(p / (1 - p))
+        se_eta = se / (p * (1 - p))
+        q = tdist.ppf(level / 2 + 0.5, np.where(degf > 0, degf, np.nan))
+        return expit(eta - q * se_eta), expit(eta + q * se_eta)
+
+
+def estimate(des, tot, ngroups, resps):
+    w = np.bincount(tot.group, tot.w, minlength=ngroups)
+    n = np.bincount(tot.group, tot.n, minlength=ngroups)
+    w_rep = None
+    if des.replicates is not None:
+        w_rep = replicate_totals(des, tot, tot.w, ngroups)
+    dfs = []
+    for j, r in enumerate(resps):
+        wy = np.bincount(tot.group, tot.wy[:, j], minlength=ngroups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = wy / w
+        if des.replicates is not None:
+            var, degf = replicate_variance(des, tot, tot.wy[:, j], w_rep, ngroups)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                z = (tot.wy[:, j] - p[tot.group] * tot.w) / w[tot.group]
+            var, degf = linearized_variance(des, tot.group, tot.psu, z, ngroups)
+        se = np.sqrt(var)
+        ci_l, ci_u = xlogit_ci(p, se, degf)
+        dfs.append(pd.DataFrame({
+            'mean': p, 'se': se, 'ci_l': ci_l, 'ci_u': ci_u,
+            'count': np.bincount(tot.group, tot.ny[:, j], minlength=ngroups),
+            'sample_size': n, 'response': r
+        }, columns=['mean', 'se', 'ci_l', 'ci_u', 'count', 'sample_size',
+                    'response']))
+    return pd.concat(dfs, ignore_index=True)
+
+
+def stats_for_levels(des, qn_f, vs, klevels):
+    """
+    stats for the interaction levels vs[:k], k in klevels, from one scan
+    of the design: psu totals are summed once for the finest grouping,
+    with missing values kept as an extra level of each var, and each
+    level is re-aggregated from those totals. The linearized values for
+    any grouping are (wy - p * w) / W over the same psu totals, so every
+    level (and every response level of qn_f) shares the scan.
+    """
+    codes, resps = response_codes(des, qn_f)
+    idx = des.rows(codes >= 0)
+    vcodes, vlevels = group_levels(des, idx, vs)
+    radix = [len(l) + 1 for l in vlevels]
+    finest = np.zeros(len(idx), dtype=np.int64)
+    stride = 1
+    for c, lvls, rdx in zip(vcodes, vlevels, radix):
+        finest += np.where(c < 0, len(lvls), c) * stride
+        stride *= rdx
+    tot = psu_totals(des, idx, codes, len(resps), finest)
+    dfs = []
+    for k in klevels:
+        rest = tot.group
+        group = np.zeros(len(rest), dtype=np.int64)
+        keep = np.ones(len(rest), dtype=bool)
+        stride = 1
+        for lvls, rdx in zip(vlevels[:k], radix[:k]):
+            digit = rest % rdx
+            rest = rest // rdx
+            keep &= digit < len(lvls)
+            group += np.where(digit < len(lvls), digit, 0) * stride
+            stride *= len(lvls)
+        grid = level_grid(vs[:k], vlevels[:k])
+        st = estimate(des, coarsen_totals(tot, group, keep), grid.shape[0], resps)
+        grid = pd.concat([grid] * len(resps), ignore_index=True)
+        dfs.append(pd.concat([grid, st], axis=1).assign(level=k))
+    dfz = pd.concat(dfs, ignore_index=True)
+    return u.fill_none(dfz.round(DECIMALS))
+
+
+def fetch_stats_by(des, qn_f, r, vs):
+    logger.info('gen numpy stats for interaction level', vs=vs, qn=qn_f.qn, r=r)
+    return stats_for_levels(des, qn_f, vs, [len(vs)])
+
+
+def fetch_stats_totals(des, qn_f, r):
+    logger.info('fetching numpy stats totals', r=r, q=qn_f.qn)
+    return stats_for_levels(des, qn_f, [], [0])
+
+
+def fetch_stats_rollup(des, qn_f, r, vs):
+    # totals and every interaction level vs[:1], ..., vs in one pass
+    logger.info('gen numpy stats rollup', vs=vs, qn=qn_f.qn, r=r)
+    return stats_for_levels(des, qn_f, vs, range(len(vs) + 1))
+
+
+def fetch_stats_responses(des, qn, vs, rollup=False):
+    # every response level of qn as one multinomial pass over the design
+    logger.info('gen numpy stats for all responses', vs=vs, qn=qn, rollup=rollup)
+    qn_f = response_formula(qn, None)
+    return stats_for_levels(des, qn_f, vs,
+                            range(len(vs) + 1) if rollup else [len(vs)])
+
+
+def fetch_stats(des, qn, r, vs=[], filt={}):
+    qn_f = response_formula(qn, r)
+    des = subset_survey(des, filt)
+    return fetch_stats_rollup(des, qn_f, r, vs)
@@ -0,0 +1,85 @@
+import os
+import json
+import attr
+from typing import Mapping, Sequence, FrozenSet
+from survey_stats import log
+
+logger = log.getLogger(__name__)
+
+
+def survey_levels(df, qids, site_col, national, digest):
+    """
+    response levels of each question and the sites pooled into national
+    estimates, gathered in one scan of the surveys data
+    """
+    responses = {q: sorted(set(str(x) for x in df[q].dropna().unique()))
+                 for q in qids if q in df.columns}
+    if national is None:
+        sites = []
+    elif national.incl:
+        sites = list(national.vals)
+    elif site_col in df.columns:
+        sites = sorted(set(str(x) for x in df[site_col].dropna().unique())
+                       .difference(national.vals))
+    else:
+        sites = []
+    return {'digest': digest, 'responses': responses, 'sites': sites}
+
+
+def read_levels(fp, digest):
+    # a sidecar written from older data is ignored
+    try:
+        with open(fp) as fh:
+            levels = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if levels.get('digest') != digest:
+        logger.info('ignoring stale planning levels', f=fp)
+        return None
+    return levels
+
+
+def write_levels(fp, levels):
+    tmp = '%s.%d.tmp' % (fp, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(levels, fh)
+    os.replace(tmp, fp)
+    logger.info('saved planning levels', f=fp, qids=len(levels['responses']))
+
+
+@attr.s(frozen=True)
+class PlanIndex(object):
+    """
+    What the API needs to validate a query and plan its slices: question
+    ids, the levels of each facet and their type, response levels of
+    each question and the national sitecodes, so no request scans the
+    data.
+    """
+
+    qids: FrozenSet[str] = attr.ib()
+    facets: Mapping[str, FrozenSet] = attr.ib()
+    facet_types: Mapping[str, type] = attr.ib()
+    responses: Mapping[str, Sequence[str]] = attr.ib()
+    national_sites: Sequence[str] = attr.ib()
+
+    @classmethod
+    def build(cls, qids, facet_map, levels=None):
+        levels = levels or {}
+        return cls(qids=frozenset(qids),
+                   facets={k: frozenset(vals) for k, vals in facet_map.items()},
+                   facet_types={k: type(vals[0]) for k, vals in facet_map.items()
+                                if len(vals)},
+                   responses=levels.get('responses', {}),
+                   national_sites=levels.get('sites', []))
+
+    def has_qid(self, qn):
+        return qn in self.qids
+
+    def has_level(self, facet, v):
+        # cast to the type of the facet's first level, as validation did
+        if facet not in self.facet_types:
+            return False
+        try:
+            return self.facet_types[facet](v) in self.facets[facet]
+        except (TypeError, ValueError):
+            return False
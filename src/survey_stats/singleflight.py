@@ -0,0 +1,66 @@
+import asyncio
+from collections import Counter
+from survey_stats import log
+
+logger = log.getLogger(__name__)
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls with the same key onto one in-flight
+    future: the first caller runs the work, later callers await its
+    result (or exception) until it completes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.inflight = {}
+        self.counts = Counter()
+
+    async def do(self, key, fn):
+        fut = self.inflight.get(key)
+        if fut is not None:
+            self.counts['joined'] += 1
+            logger.info('joining in-flight request', flight=self.name, key=key)
+            return await asyncio.shield(fut)
+        self.counts['led'] += 1
+        fut = asyncio.ensure_future(fn())
+        self.inflight[key] = fut
+        fut.add_done_callback(lambda f: self.inflight.pop(key, None))
+        return await asyncio.shield(fut)
+
+    def claim(self, keys):
+        """
+        split keys into futures already in flight and new futures the
+        caller must resolve with resolve(), for coalescing parts of a
+        request that overlap others
+        """
+        loop = asyncio.get_event_loop()
+        joined, owned = {}, {}
+        for k in keys:
+            if k in owned or k in joined:
+                continue
+            if k in self.inflight:
+                joined[k] = self.inflight[k]
+            else:
+                owned[k] = self.inflight[k] = loop.create_future()
+        self.counts['joined'] += len(joined)
+        self.counts['led'] += len(owned)
+        return joined, owned
+
+    def resolve(self, owned, results=None, error=None):
+        for k, fut in owned.items():
+            self.inflight.pop(k, None)
+            if fut.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                fut.cancel()
+            elif error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(results[k])
+
+    def info(self):
+        return {'inflight': len(self.inflight),
+                'led': self.counts['led'],
+                'joined': self.counts['joined']}
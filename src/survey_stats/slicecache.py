@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, Counter
+from survey_stats import log
+from survey_stats.const import MB, DEFAULT_SLICE_CACHE_MB, SLICE_CACHE_DB
+from survey_stats.const import DEFAULT_SLICE_DISK_MB, SLICE_DISK_PRUNE_TO
+
+logger = log.getLogger(__name__)
+
+
+def norm_filter(f):
+    # sorted facets with sorted, de-duplicated string levels
+    return sorted((k, sorted(set(map(str, v if type(v) in (list, set, tuple)
+                                          else [v]))))
+                  for k, v in (f or {}).items())
+
+
+def slice_key(dsid, version, q, r, vs, f, rollup=False):
+    """
+    canonical cache key for a slice: vars keep their order, since they
+    define the interaction levels, while the filter is normalized
+    """
+    canon = json.dumps([dsid, version, q, r, list(vs or []),
+                        norm_filter(f), bool(rollup)],
+                       separators=(',', ':'))
+    return hashlib.sha1(canon.encode('utf-8')).hexdigest()
+
+
+def to_json(o):
+    # numpy scalars from DataFrame.to_dict
+    return o.item() if hasattr(o, 'item') else str(o)
+
+
+class SliceCache(object):
+    """
+    Two-tier cache of worker slice results: an in-process LRU bounded by
+    the encoded size of its entries, backed by a SQLite table under the
+    cache dir that outlives worker respawns, and is pruned of its oldest
+    results past max_disk_mb. Entries carry the dataset stats version, so
+    results from rebuilt artifacts or other designs are never served.
+    """
+
+    def __init__(self, cdir, max_mb=DEFAULT_SLICE_CACHE_MB, persist=True,
+                 max_disk_mb=DEFAULT_SLICE_DISK_MB):
+        self.max_bytes = int(max_mb * MB)
+        self.max_disk_bytes = int(max_disk_mb * MB)
+        self.unpruned = 0
+        self.path = os.path.join(cdir, SLICE_CACHE_DB) if persist else None
+        self.lru = OrderedDict()
+        self.nbytes = 0
+        self.counts = Counter()
+        self.lock = threading.RLock()
+        self._db = None
+        self._pid = None
+
+    @property
+    def db(self):
+        # connect lazily, and again after gunicorn forks a worker
+        if self.path is None:
+            return None
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30,
+                                       check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS slices ('
+                             'key TEXT PRIMARY KEY, dsid TEXT, '
+                             'version TEXT, stored REAL, size INTEGER, '
+                             'result BLOB)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS slices_stored '
+                             'ON slices (stored)')
+            self._pid = os.getpid()
+            self.unpruned = self.max_disk_bytes
+        return self._db
+
+    def _prune(self):
+        # drop the oldest persisted results once the table outgrows its cap
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM slices').fetchone()[0]
+        self.unpruned = 0
+        if total <= self.max_disk_bytes:
+            return 0
+        excess = total - int(self.max_disk_bytes * SLICE_DISK_PRUNE_TO)
+        old = []
+        for key, size in self.db.execute('SELECT key, size FROM slices ORDER BY stored'):
+            if excess <= 0:
+                break
+            old.append((key,))
+            excess -= size
+        self.db.executemany('DELETE FROM slices WHERE key = ?', old)
+        logger.info('pruned persisted slice results', n=len(old), nbytes=total,
+                    max_bytes=self.max_disk_bytes)
+        self.counts['pruned'] += len(old)
+        return len(old)
+
+    def _remember(self, key, blob):
+        if len(blob) > self.max_bytes:
+            return
+        if key in self.lru:
+            self.nbytes -= len(self.lru.pop(key))
+        self.lru[key] = blob
+        self.nbytes += len(blob)
+        while self.nbytes > self.max_bytes:
+            _, old = self.lru.popitem(last=False)
+            self.nbytes -= len(old)
+            self.counts['evictions'] += 1
+
+    def get(self, key):
+        with self.lock:
+            blob = self.lru.get(key)
+            if blob is not None:
+                self.lru.move_to_end(key)
+                self.counts['hits'] += 1
+                return json.loads(blob.decode('utf-8'))
+            row = None
+            if self.db is not None:
+                row = self.db.execute('SELECT result FROM slices WHERE key = ?',
+                                      (key,)).fetchone()
+            if row is None:
+                self.counts['misses'] += 1
+                return None
+            self.counts['disk_hits'] += 1
+            blob = bytes(row[0])
+            self._remember(key, blob)
+            return json.loads(blob.decode('utf-8'))
+
+    def put(self, key, result, dsid, version):
+        blob = json.dumps(result, default=to_json).encode('utf-8')
+        with self.lock:
+            self._remember(key, blob)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO slices VALUES (?, ?, ?, ?, ?, ?)',
+                                (key, dsid, version, time.time(), len(blob),
+                                 sqlite3.Binary(blob)))
+                self.unpruned += len(blob)
+                if self.unpruned > self.max_disk_bytes * (1 - SLICE_DISK_PRUNE_TO):
+                    self._prune()
+            self.counts['puts'] += 1
+
+    def invalidate(self, dsid, version):
+        # drop persisted results computed from other artifact versions
+        with self.lock:
+            if self.db is None:
+                return 0
+            cur = self.db.execute('DELETE FROM slices WHERE dsid = ? AND version != ?',
+                                  (dsid, version))
+            logger.info('invalidated stale slice results', dsid=dsid,
+                        version=version, n=cur.rowcount)
+            self.counts['invalidated'] += cur.rowcount
+            return cur.rowcount
+
+    def info(self):
+        with self.lock:
+            return {'entries': len(self.lru),
+                    'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    'persistent': self.path,
+                    'max_disk_bytes': self.max_disk_bytes,
+                    'hits': self.counts['hits'],
+                    'disk_hits': self.counts['disk_hits'],
+                    'misses': self.counts['misses'],
+                    'evictions': self.counts['evictions'],
+                    'puts': self.counts['puts'],
+                    'invalidated': self.counts['invalidated'],
+                    'pruned': self.counts['pruned']}
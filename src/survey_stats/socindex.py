@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+from itertools import combinations
+from cytoolz.itertoolz import unique
+from survey_stats import log
+from survey_stats import pdutil as u
+from survey_stats.const import DECIMALS, ID_COLUMN, ANNO_COLUMNS, STATS_COLUMNS
+
+logger = log.getLogger(__name__)
+
+
+def parse_stats(df):
+    # -1 marks suppressed estimates in the published tables
+    for c in set(STATS_COLUMNS).intersection(df.columns):
+        df[c] = df[c].astype(float).replace(-1.0, np.nan)
+        if c in DECIMALS:
+            df[c] = df[c].round(DECIMALS[c])
+    return df
+
+
+# the columns of a worker's slice results, after the vars
+WORKER_COLUMNS = ['mean', 'se', 'ci_l', 'ci_u', 'count', 'sample_size', 'response', 'level']
+
+
+def slice_levels(vs, rollup=False):
+    # the breakdowns a slice computes: with rollup, every subset of its vars
+    if not rollup:
+        return [list(vs)]
+    return [list(c) for k in range(len(vs) + 1) for c in combinations(vs, k)]
+
+
+class SocrataIndex(object):
+    """
+    The socrata part as column arrays sorted on (qid, sitecode, year,
+    facets), with those columns dictionary encoded and the stats parsed
+    once, so a query is a hashed lookup of its (qid, sitecode) row ranges
+    followed by integer comparisons over the few rows inside them. The
+    coverage set records which breakdowns were published, to tell which
+    survey slices the table already answers.
+    """
+
+    def __init__(self, df, facets, site_col='sitecode', year_col='year'):
+        self.site_col = site_col
+        self.year_col = year_col
+        self.facets = [f for f in facets
+                       if f in df.columns and f not in [site_col, year_col]]
+        self.keys = [k for k in [ID_COLUMN, site_col, year_col] + self.facets
+                     if k in df.columns]
+        self.columns = list(df.columns)
+        self.nrows = len(df)
+        df = parse_stats(df.copy())
+        cats = {k: pd.Categorical(df[k]) for k in self.keys}
+        codes = [cats[k].codes for k in self.keys]
+        order = np.lexsort(codes[::-1])
+        self.codes = {k: c[order] for k, c in zip(self.keys, codes)}
+        # missing values have code -1, the None appended last
+        self.levels = {k: np.append(np.asarray(cats[k].categories, dtype=object), None)
+                       for k in self.keys}
+        self.lookup = {k: {v: i for i, v in enumerate(cats[k].categories)}
+                       for k in self.keys}
+        self.values = {c: (df[c].values[order] if c in STATS_COLUMNS else
+                           u.fill_none(df[[c]])[c].values[order])
+                       for c in self.columns if c not in self.keys}
+        self.qid_ranges = self.runs([ID_COLUMN])
+        self.site_ranges = self.runs([ID_COLUMN, site_col]) if site_col in self.keys else {}
+        self.coverage = self.published()
+
+    def published(self):
+        """
+        (qid, sitecode, year, facets broken out) of every published
+        breakdown, also with '*' for the sitecode and year of breakdowns
+        by them
+        """
+        if not set([self.site_col, self.year_col]).issubset(self.keys):
+            return set()
+        total = {k: self.lookup[k].get('Total') for k in self.facets}
+        keyf = pd.DataFrame({k: self.codes[k] for k in [ID_COLUMN, self.site_col, self.year_col]})
+        for k in self.facets:
+            keyf[k] = (self.codes[k] != -1) & (self.codes[k] != total[k])
+        res = set()
+        for row in keyf.drop_duplicates().itertuples(index=False):
+            q, s, y = [self.levels[k][c] for k, c in zip(
+                [ID_COLUMN, self.site_col, self.year_col], row[:3])]
+            fs = frozenset(k for k, b in zip(self.facets, row[3:]) if b)
+            # only state and single year rows make up breakdowns by them
+            sites = [s, '*'] if s not in [None, 'XX'] else [s]
+            years = [y, '*'] if y not in [None, 'Total'] else [y]
+            res.update((q, s2, y2, fs) for s2 in sites for y2 in years)
+        return res
+
+    def shape(self, vs, filt):
+        """
+        the published breakdown matching a slice: every filter must pick
+        a single level, as the table has no pooled estimates
+        """
+        def level(col, default):
+            if col in vs:
+                return '*'
+            vals = filt.get(col)
+            if vals is None:
+                return default
+            return vals[0] if len(vals) == 1 else None
+        site = level(self.site_col, 'XX')
+        year = level(self.year_col, 'Total')
+        others = [k for k in filt if k not in [self.site_col, self.year_col]]
+        if site is None or year is None or \
+                any(k not in self.facets or len(filt[k]) != 1 for k in others) or \
+                any(v not in self.facets + [self.site_col, self.year_col] for v in vs):
+            return None
+        return (site, year, frozenset([v for v in vs if v in self.facets] + others))
+
+    def covers(self, qn, vs, filt, rollup=False):
+        for lv in slice_levels(vs, rollup):
+            sh = self.shape(lv, filt)
+            if sh is None or (qn,) + sh not in self.coverage:
+                return False
+        return True
+
+    def runs(self, keys):
+        # (codes of keys) -> (start, stop) of the run of sorted rows
+        n = self.nrows
+        if n == 0:
+            return {}
+        cols = [self.codes[k] for k in keys]
+        change = np.zeros(n, dtype=bool)
+        change[0] = True
+        for c in cols:
+            change[1:] |= c[1:] != c[:-1]
+        starts = np.flatnonzero(change)
+        stops = np.append(starts[1:], n)
+        return {tuple(int(c[s]) for c in cols): (int(s), int(e))
+                for s, e in zip(starts, stops)}
+
+    def codes_for(self, k, vals):
+        lk = self.lookup.get(k, {})
+        return [lk[v] for v in vals if v in lk]
+
+    def ranges(self, qn, vars, filt):
+        q = self.codes_for(ID_COLUMN, [qn])
+        if not q:
+            return []
+        if self.site_col not in self.keys:
+            return [self.qid_ranges[(q[0],)]]
+        if self.site_col in filt:
+            sites = self.codes_for(self.site_col, filt[self.site_col])
+        elif self.site_col not in vars:
+            sites = self.codes_for(self.site_col, ['XX'])
+        else:
+            return [self.qid_ranges[(q[0],)]]
+        return [self.site_ranges[(q[0], s)] for s in sites
+                if (q[0], s) in self.site_ranges]
+
+    def span(self, qn, vars, filt):
+        # rows a query has to look at
+        return sum(e - s for s, e in self.ranges(qn, vars, filt))
+
+    def query(self, qn, vars, filt):
+        rngs = self.ranges(qn, vars, filt)
+        pos = (np.concatenate([np.arange(s, e) for s, e in rngs])
+               if rngs else np.array([], dtype=int))
+        sel = np.ones(len(pos), dtype=bool)
+        conds = []
+        if self.year_col in self.keys:
+            if self.year_col in filt:
+                conds.append((self.year_col, self.codes_for(self.year_col, filt[self.year_col])))
+            elif self.year_col not in vars:
+                conds.append((self.year_col, self.codes_for(self.year_col, ['Total'])))
+        for v in self.facets:
+            if v in filt:
+                conds.append((v, self.codes_for(v, filt[v])))
+            elif v not in vars:
+                # missing codes as -1, for facets left blank
+                conds.append((v, self.codes_for(v, ['Total']) + [-1]))
+        for k, cs in conds:
+            sel &= np.isin(self.codes[k][pos], cs)
+        cols = list(unique(c for c in ANNO_COLUMNS + list(vars) + STATS_COLUMNS
+                           if c in self.columns))
+        return pd.DataFrame({c: self.column(c, pos[sel]) for c in cols},
+                            columns=cols)
+
+    def query_level(self, qn, vs, filt):
+        # rows breaking out exactly vs, without the totals over any of them
+        res = self.query(qn, vs, filt)
+        for v in vs:
+            res = res[res[v].notnull() & (res[v] != 'Total')]
+        return res.reset_index(drop=True)
+
+    def responses(self, qn):
+        # response levels published for a question, as the surveys name them
+        q = self.codes_for(ID_COLUMN, [qn])
+        if not q or 'response' not in self.values:
+            return set()
+        (s, e) = self.qid_ranges[(q[0],)]
+        return set(str(r) for r in self.values['response'][s:e] if r is not None)
+
+    def level_stats(self, qn, vs, filt):
+        """
+        a published breakdown shaped like a worker's result for it: the
+        vars, then the stats with string responses and the level, with
+        stats the table does not publish left empty
+        """
+        res = self.query_level(qn, vs, filt)
+        cols = list(vs) + WORKER_COLUMNS
+        out = pd.DataFrame({c: res[c] if c in res.columns else None for c in cols},
+                           columns=cols, index=res.index)
+        out['response'] = [None if r is None else str(r) for r in res['response']] \
+            if 'response' in res.columns else None
+        out['level'] = len(vs)
+        return out
+
+    def column(self, c, rows):
+        if c in self.codes:
+            return self.levels[c][self.codes[c][rows]]
+        vals = self.values[c][rows]
+        if c in STATS_COLUMNS:
+            # as u.fill_none leaves them
+            return np.where(np.isnan(vals), None, vals)
+        return vals
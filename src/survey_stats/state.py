@@ -1,15 +1,160 @@
+import os
+import gc
+import glob
+import sys
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
 from survey_stats.datasets import SurveyDataset
+from survey_stats.const import MB, DEFAULT_DATASET_CONFIG_DIR
 from survey_stats import log
 
 lgr = log.getLogger(__name__)
 
-dset = {}
 
+class DatasetRegistry(Mapping):
+    """
+    Datasets discovered from the yaml configs in cfg_dir, each created on
+    first use with its parts loaded lazily. When the estimated memory of
+    the loaded datasets exceeds budget_mb, the least recently used ones
+    are dropped and reloaded on their next use.
+    """
 
-def initialize(dbc, cache, init_des, use_feather, init_svy, init_soc):
+    def __init__(self, cfg_dir=DEFAULT_DATASET_CONFIG_DIR):
+        self.cfg_dir = cfg_dir
+        self.configure(None, None)
+        self.lock = threading.RLock()
+        self.dlocks = {}
+        self.loaded_dsets = OrderedDict()
+        self.warmed = set()
+        self.on_load = []
+
+    def configure(self, dbc, cache, parts=(), budget_mb=0):
+        self.dbc = dbc
+        self.cache = cache
+        self.parts = parts
+        self.budget = int(budget_mb * MB)
+        self._configs = None
+
+    @property
+    def configs(self):
+        # globbed once, and again after the registry is reconfigured
+        if self._configs is None:
+            self._configs = {
+                os.path.splitext(os.path.basename(f))[0]: f
+                for f in sorted(glob.glob(os.path.join(self.cfg_dir, '*.yaml')))}
+        return self._configs
+
+    def __iter__(self):
+        return iter(self.configs)
+
+    def __len__(self):
+        return len(self.configs)
+
+    def __contains__(self, k):
+        return k in self.configs
+
+    def __getitem__(self, k):
+        with self.lock:
+            if k in self.loaded_dsets:
+                self.loaded_dsets.move_to_end(k)
+                self.evict(keep=k)
+                return self.loaded_dsets[k]
+            cfg_f = self.configs[k]
+            dlock = self.dlocks.setdefault(k, threading.Lock())
+        with dlock:
+            # another thread may have loaded it while we waited
+            if k in self.loaded_dsets:
+                return self[k]
+            d = self.load(k, cfg_f)
+        with self.lock:
+            self.loaded_dsets[k] = d
+            self.evict(keep=k)
+        return d
+
+    def load(self, k, cfg_f):
+        d = SurveyDataset.from_config(cfg_f, self.dbc, self.cache)
+        lgr.info('created dataset', d=k, timings=d.timings)
+        for fn in self.on_load:
+            fn(k, d)
+        return d
+
+    def warm(self, k):
+        # load the parts this process serves from
+        start = timer()
+        d = self[k]
+        for p in self.parts:
+            getattr(d, p)
+        with self.lock:
+            # unless evicted while its parts loaded
+            if k in self.loaded_dsets:
+                self.warmed.add(k)
+        lgr.info('loaded dataset', d=k, parts=self.parts, timings=d.timings,
+                 elapsed=timer() - start)
+        return d
+
+    def loaded(self):
+        with self.lock:
+            return OrderedDict(self.loaded_dsets)
+
+    @property
+    def nbytes(self):
+        return sum(d.nbytes for d in self.loaded().values())
+
+    def evict(self, keep=None):
+        if self.budget <= 0:
+            return []
+        evicted = []
+        with self.lock:
+            for k in list(self.loaded_dsets.keys()):
+                if self.nbytes <= self.budget:
+                    break
+                if k == keep:
+                    continue
+                del self.loaded_dsets[k]
+                self.warmed.discard(k)
+                evicted.append(k)
+        if evicted:
+            rsvy = sys.modules.get('survey_stats.survey')
+            if rsvy is not None:
+                rsvy.collect_garbage()
+            else:
+                gc.collect()
+            lgr.info('evicted datasets over memory budget', evicted=evicted,
+                     nbytes=self.nbytes, budget=self.budget)
+        return evicted
+
+    def engine(self, k):
+        svy = self[k].cfg.surveys
+        return svy.engine if svy else None
+
+    def preload(self, dsids, jobs=None):
+        """
+        datasets needed at startup load side by side, except those of the
+        R engine: embedded R is not thread safe, so they load one by one
+        in the calling thread
+        """
+        dsids = [k for k in dsids if k in self]
+        rdsids = [k for k in dsids if self.engine(k) == 'r']
+        start = timer()
+        with ThreadPool(jobs or max(len(dsids), 1)) as pool:
+            res = pool.map_async(self.warm, [k for k in dsids if k not in rdsids])
+            for k in rdsids:
+                self.warm(k)
+            res.get()
+        lgr.info('preloaded datasets', dsets=dsids, elapsed=timer() - start)
+
+
+dset = DatasetRegistry()
+
+
+def initialize(dbc, cache, init_des, use_feather, init_svy, init_soc,
+               init_plan=False, preload=None, budget_mb=0):
     lgr.info('was summoned into being, loading up some data', dbc=dbc, cache=cache, use_feather=use_feather)
-    dset['brfss'] = SurveyDataset.load_dataset('config/data/brfss.yaml', dbc, cache, init_des, use_feather, init_svy, init_soc)
-    dset['brfss_pre2011'] = SurveyDataset.load_dataset('config/data/brfss_pre2011.yaml', dbc, cache, init_des, use_feather, init_svy, init_soc)
-    dset['yrbss'] = SurveyDataset.load_dataset('config/data/yrbss.yaml', dbc, cache, init_des, use_feather, init_svy, init_soc)
-    dset['prams'] = SurveyDataset.load_dataset('config/data/prams.yaml', dbc, cache, init_des, use_feather, init_svy, init_soc)
-    dset['prams_p2011'] = SurveyDataset.load_dataset('config/data/prams_p2011.yaml', dbc, cache, init_des, use_feather, init_svy, init_soc)
+    parts = ([p for p, init in [('svy', init_svy), ('socindex', init_soc)] if init] +
+             (['des', 'dindex'] if init_des else []) +
+             (['plan'] if init_plan else []))
+    dset.configure(dbc, cache, parts=parts, budget_mb=budget_mb)
+    dset.preload(list(dset.keys()) if preload is None else preload)
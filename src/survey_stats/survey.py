@@ -1,13 +1,17 @@
+import os
 import pandas as pd
-from rpy2.robjects import pandas2ri
+import feather
+from rpy2.robjects import pandas2ri, numpy2ri
 from rpy2.robjects.packages import importr
 from rpy2.robjects import Formula
 from rpy2 import robjects as ro
 from survey_stats.helpr import svyciprop_xlogit, svybyci_xlogit, factor_summary
 from survey_stats.helpr import filter_survey_var, rm_nan_survey_var, svyby_nodrop
-from survey_stats.helpr import fix_lonely_psus
+from survey_stats.helpr import fix_lonely_psus, response_levels
+from survey_stats.helpr import domain_survey_var, design_dim
 from survey_stats import pdutil as u
 from survey_stats.const import DECIMALS
+from survey_stats.dbi import get_snapshot_path
 from survey_stats import log
 import gc
 
@@ -19,9 +23,35 @@ rfeather = importr('feather', on_conflict='warn')
 
 logger = log.getLogger()
 
+# forced collections mark every object and so dirty the pages a
+# preloading master shares copy-on-write with its forked workers
+FORCE_GC = True
+
+
+def collect_garbage():
+    if FORCE_GC:
+        rbase.gc()
+        gc.collect()
+
+
+def response_formula(qn, r):
+    return '~I(%s=="%s")' % (qn, r)
+
 
 def dim_design(d):
-    return pandas2ri.ri2py(rbase.dim(d[d.names.index('variables')]))
+    # rows with non-zero weight, so domain designs report their size
+    return pandas2ri.ri2py(design_dim(d))
+
+
+def domain_survey(des, mask, qn=None):
+    # zero the sampling weights outside the domain instead of copying the
+    # design's variables, as survey does itself for calibrated designs
+    return domain_survey_var(des, numpy2ri.py2ri(mask), qn if qn else ro.NULL)
+
+
+def facet_frame(des, fthr_file, cols):
+    # read just the columns to index for domain masks, R holds the rest
+    return feather.read_dataframe(fthr_file, columns=cols)
 
 def subset_survey(des, filt, qn=None):
     # filt is a dict with vars as keys and list of acceptable values as levels
@@ -95,33 +125,63 @@ def fetch_stats_totals(des, qn_f, r):
     return u.fill_none(res)
 
 
-def fetch_stats(des, qn, r, vs=[], filt={}):
-    # ex: ~qn8
-    rbase.gc()
-    gc.collect()
-    qn_f = '~I(%s=="%s")' % (qn, r)
-    logger.info('subsetting des with filter', filt=filt)
-    des = subset_survey(des, filt)
-    logger.info('done subsetting')
+def fetch_stats_rollup(des, qn_f, r, vs):
+    # get stats_by_fnats for each level of interactions in vars
+    # using svyby to compute across combinations of loadings,
+    # R needs one svyby pass per level over the shared design
     dfs = [fetch_stats_totals(des, qn_f, r)]
     levels = [vs[:k+1] for k in range(len(vs))]
-    sts = map(lambda lvl: fetch_stats_by(des, qn_f, r, lvl), levels)
+    sts = [fetch_stats_by(des, qn_f, r, lvl) for lvl in levels]
     dfz = pd.concat(dfs + sts, ignore_index=True)
-    # get stats_by_fnats for each level of interactions in vars
-    # using svyby to compute across combinations of loadings
     logger.info('finished computations, appending dfs', dfs=dfz)
     return u.fill_none(dfz)  # .round(DECIMALS)
 
 
+def fetch_stats_responses(des, qn, vs, rollup=False):
+    # every response level shares the subset design, but svyciprop
+    # still needs its own ~I(qn=="r") pass for each level
+    resps = list(response_levels(des, qn))
+    logger.info('gen stats for all responses', qn=qn, resps=resps, vs=vs)
+    dfs = []
+    for r in resps:
+        qn_f = response_formula(qn, r)
+        if rollup:
+            dfs.append(fetch_stats_rollup(des, qn_f, r, vs))
+        elif len(vs) > 0:
+            dfs.append(fetch_stats_by(des, qn_f, r, vs))
+        else:
+            dfs.append(fetch_stats_totals(des, qn_f, r))
+    return u.fill_none(pd.concat(dfs, ignore_index=True))
+
+
+def fetch_stats(des, qn, r, vs=[], filt={}):
+    # ex: ~qn8
+    collect_garbage()
+    qn_f = response_formula(qn, r)
+    logger.info('subsetting des with filter', filt=filt)
+    des = subset_survey(des, filt)
+    logger.info('done subsetting')
+    return fetch_stats_rollup(des, qn_f, r, vs)
+
+
 def subset(d, filter):
     return d._replace(des=subset_survey(d, filter))
 
 
-def des_from_feather(fthr_file, denovo=False, fpc=False, design='cluster'):
-    rbase.gc()
-    gc.collect()
+def des_from_feather(fthr_file, denovo=False, fpc=False, design='cluster',
+                     snapshot=True):
+    collect_garbage()
     if fpc and design=='cluster':
         fix_lonely_psus()
+    snap = get_snapshot_path(fthr_file, 'rds', denovo, fpc, design) if snapshot else None
+    if snap and os.path.isfile(snap):
+        logger.info('loading survey design snapshot', f=snap)
+        try:
+            return rbase.readRDS(snap)
+        except Exception as e:
+            # a truncated or unreadable snapshot is rebuilt below
+            logger.warn('failed to load survey design snapshot, rebuilding',
+                        f=snap, err=str(e))
     rdf = rfeather.read_feather(fthr_file)
     logger.info('creating survey design from data and annotations',
                 cols=list(rbase.colnames(rdf)))
@@ -133,8 +193,13 @@ def des_from_feather(fthr_file, denovo=False, fpc=False, design='cluster'):
         weight=Formula('~weight'),
         strata=Formula(strata), data=rdf, nest=True,
         fpc=(Formula('~fpc') if fpc else ro.NULL))
-    rbase.gc()
-    gc.collect()
+    if snap:
+        # uncompressed, so later boots read it back at disk speed
+        logger.info('saving survey design snapshot', f=snap)
+        tmp = '%s.%d.tmp' % (snap, os.getpid())
+        rbase.saveRDS(res, file=tmp, compress=False)
+        os.replace(tmp, snap)
+    collect_garbage()
     return res
 
 
@@ -0,0 +1,98 @@
+import aiohttp
+import ujson
+from survey_stats import log
+
+logger = log.getLogger(__name__)
+
+UNIX_PREFIX = 'unix:'
+
+
+def split_worker_url(url):
+    """
+    the unix socket path (or None) and http base url of a worker, given
+    as an http url or as unix:/path/to.sock the way gunicorn binds it
+    """
+    if url.startswith(UNIX_PREFIX):
+        return url[len(UNIX_PREFIX):], 'http://localhost'
+    return None, url
+
+
+class CountingMixin(object):
+    # counts new connections, the rest of the requests reused one
+
+    created = 0
+
+    async def _create_connection(self, req, *args, **kwargs):
+        self.created += 1
+        return await super()._create_connection(req, *args, **kwargs)
+
+
+class CountingTCPConnector(CountingMixin, aiohttp.TCPConnector):
+    pass
+
+
+class CountingUnixConnector(CountingMixin, aiohttp.UnixConnector):
+    pass
+
+
+class WorkerTransport(object):
+    """
+    Connection pools to the stats workers kept for the life of the
+    server: one for http workers and one per unix socket, created on
+    first use inside the event loop.
+    """
+
+    def __init__(self, limit, limit_per_host=0, keepalive_timeout=30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.sessions = {}
+        self.requests = 0
+
+    def connector(self, path):
+        opts = {'limit': self.limit}
+        if self.keepalive_timeout > 0:
+            opts['keepalive_timeout'] = self.keepalive_timeout
+        else:
+            opts['force_close'] = True
+        if path is not None:
+            return CountingUnixConnector(path, **opts)
+        return CountingTCPConnector(limit_per_host=self.limit_per_host, **opts)
+
+    def session(self, url):
+        path, base = split_worker_url(url)
+        s = self.sessions.get(path)
+        if s is None or s.closed:
+            logger.info('opening worker connection pool', sock=path, limit=self.limit,
+                        keepalive=self.keepalive_timeout)
+            s = self.sessions[path] = aiohttp.ClientSession(
+                connector=self.connector(path), json_serialize=ujson.dumps)
+        return s, base
+
+    def request(self, method, url, route, **kwargs):
+        s, base = self.session(url)
+        self.requests += 1
+        return s.request(method, base + route, **kwargs)
+
+    def get(self, url, route, **kwargs):
+        return self.request('GET', url, route, **kwargs)
+
+    def post(self, url, route, **kwargs):
+        return self.request('POST', url, route, **kwargs)
+
+    async def close(self):
+        for s in self.sessions.values():
+            res = s.close()
+            # a coroutine on newer aiohttp
+            if res is not None:
+                await res
+        self.sessions = {}
+
+    def info(self):
+        created = sum(s.connector.created for s in self.sessions.values())
+        return {'requests': self.requests,
+                'connections': created,
+                'reused': max(self.requests - created, 0),
+                'idle': {(UNIX_PREFIX + p if p else 'tcp'):
+                         sum(len(c) for c in s.connector._conns.values())
+                         for p, s in self.sessions.items()}}
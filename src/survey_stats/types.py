@@ -26,6 +26,13 @@ class ColumnFilter(object):
     vals: Sequence[str] = attr.ib()
 
 
+@attr.s(slots=True, frozen=True)
+class ReplicateConfig(object):
+    method: str = attr.ib()
+    replicates: Optional[int] = attr.ib(default=None)
+    seed: int = attr.ib(default=0)
+
+
 @attr.s(slots=True, frozen=True)
 class SurveyConfig(object):
     parse_mode: str = attr.ib()
@@ -40,6 +47,8 @@ class SurveyConfig(object):
     na_synonyms: Sequence[str] = attr.ib()
     replace_labels: Mapping[T, T] = attr.ib()
     rename_cols: Optional[Callable[[T], T]] = attr.ib()
+    engine: str = attr.ib(default='r')
+    replicates: Optional[ReplicateConfig] = attr.ib(default=None)
 
 
 @attr.s(slots=True, frozen=True)
@@ -75,6 +84,9 @@ class DatasetConfig(object):
                     y['surveys']['meta']['rows'],
                     columns=y['surveys']['meta']['cols']
                 )
+                if y['surveys'].get('replicates'):
+                    y['surveys']['replicates'] = ReplicateConfig(
+                        **y['surveys']['replicates'])
         logger.info('loading cfg')
         cfg = thread_first(
             y,
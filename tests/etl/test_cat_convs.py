@@ -8,6 +8,7 @@ import hypothesis.strategies as hs
 import hypothesis.extra.numpy as hnp
 
 from survey_stats.etl.survey_df import convert_cat_codes, convert_cat_force, eager_convert
+from survey_stats.etl.survey_df import label_codes, munge_df
 
 
 FORMATS = {
@@ -114,3 +115,41 @@ def test_convert_invalid_codes_w_dup_labels(x):
     pt.assert_series_equal(xs, xc)
 
 
+
+
+@given(x=gen_codes_for_fmt(FORMATS['VAR2'], include_nas=True))
+def test_label_codes_like_eager_convert(x):
+    xs = pd.Series(x, name='VAR2')
+    pt.assert_series_equal(label_codes(xs, FORMATS['VAR2']),
+                           eager_convert(xs, FORMATS['VAR2']))
+
+
+@given(x=gen_codes_for_fmt(FORMATS['VAR1'], valid_only=False))
+def test_label_codes_invalid_codes(x):
+    xs = pd.Series(x, name='VAR1')
+    assume(len(set(xs.dropna()).difference(FORMATS['VAR1'].keys())) > 0)
+    assert label_codes(xs, FORMATS['VAR1']) is None
+
+
+def test_munge_df():
+    df = pd.DataFrame({'VAR1': [1.0, 2.0, 5.0, np.nan],
+                       'VAR2': [1.0, 7.0, 9.0, 2.0],
+                       'Q3': ['a', 'Missing', None, 'b'],
+                       'STATE': [1.0, 6.0, 66.0, 99.0],
+                       'WT': [1.5, 2.0, 1.0, 3.0],
+                       'STR': [1.0, 1.0, 2.0, 2.0],
+                       'PSU': [3.0, 4.0, 5.0, 6.0]})
+    r = {'year': 2015, 'sitecode': 'STATE', 'sitecode_type': 'fips',
+         'weight': 'WT', 'strata': 'STR', 'psu': 'PSU', 'var1': 'var1'}
+    lbls = {'var1': FORMATS['VAR1'], 'var2': FORMATS['VAR2']}
+    res = munge_df(df, r, lbls, facets=[], qids=['var1', 'var2', 'q3'],
+                   na_syns=['dk/ns', 'missing'], col_fn=None, fmts={})
+    assert res['var1'].tolist()[:3] == ['9th Grade', '10th Grade', 'Ungraded or other grade']
+    assert pd.isnull(res['var1'][3])
+    assert res['var2'].tolist()[0::3] == ['Yes', 'No']
+    assert res['var2'][1:3].isnull().all()
+    assert res['q3'].tolist()[0::3] == ['a', 'b']
+    assert res['q3'][1:3].isnull().all()
+    assert res['sitecode'].tolist() == ['AL', 'CA', 'GU', 'NA']
+    assert res['year'].tolist() == [2015] * 4
+    assert res['strata'].tolist() == [1, 1, 2, 2]
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+from survey_stats.etl.survey_df import merge_years
+
+
+def year(y, n, sites, extra=None):
+    df = pd.DataFrame({'q1': np.resize(np.array(['Yes', 'No', np.nan], dtype=object), n),
+                       'q2': np.resize([1.0, 2.0], n),
+                       'year': y,
+                       'sitecode': pd.Series(np.resize(sites, n)).astype('category'),
+                       'weight': np.linspace(1, 2, n),
+                       'strata': np.arange(n),
+                       'psu': np.arange(n)})
+    if extra:
+        df[extra] = 'x'
+    return df
+
+
+def test_merge_like_concat(tmpdir):
+    years = [year(2015, 5, ['AL', 'XX']), year(2017, 4, ['CA'], extra='q3')]
+    fps = []
+    for i, df in enumerate(years):
+        fps.append(str(tmpdir.join('%d.pkl' % i)))
+        df.to_pickle(fps[-1])
+    res = merge_years(fps)
+    dfs = pd.concat(years, ignore_index=True)
+    old = (dfs.apply(lambda x: x.astype('category'))
+              .assign(year=dfs['year'].astype(int),
+                      sitecode=dfs['sitecode'].astype('category'),
+                      weight=dfs['weight'].astype(float),
+                      strata=dfs['strata'].astype(int, errors='ignore'),
+                      psu=dfs['psu'].astype(int, errors='ignore')))
+    assert list(res.columns) == list(old.columns)
+    for c in old.columns:
+        assert res[c].dtype == old[c].dtype, c
+        if res[c].dtype.name == 'category':
+            assert list(res[c].cat.categories) == list(old[c].cat.categories), c
+        assert res[c].astype(object).isnull().tolist() == old[c].astype(object).isnull().tolist()
+        assert res[c].dropna().tolist() == old[c].dropna().tolist(), c
@@ -0,0 +1,42 @@
+import attr
+from survey_stats import api
+
+
+@attr.s
+class FakeRequest(object):
+    path = attr.ib(default='/questions')
+    args = attr.ib(default=attr.Factory(lambda: {'d': ['yrbss']}))
+    headers = attr.ib(default=attr.Factory(dict))
+
+
+@attr.s
+class FakeDataset(object):
+    content_version = attr.ib(default='abc')
+
+
+def test_etag_follows_content_query_and_representation():
+    etag = api.response_etag(FakeRequest(), FakeDataset())
+    assert etag.startswith('"') and etag.endswith('"')
+    assert api.response_etag(FakeRequest(), FakeDataset()) == etag
+    assert api.response_etag(FakeRequest(), FakeDataset('def')) != etag
+    assert api.response_etag(FakeRequest(args={'d': ['brfss']}), FakeDataset()) != etag
+    msgpack = FakeRequest(headers={'accept': 'application/x-msgpack'})
+    assert api.response_etag(msgpack, FakeDataset()) != etag
+
+
+def test_etag_follows_socrata_routing(monkeypatch):
+    monkeypatch.setitem(api.app.config, 'socrata_first', False)
+    etag = api.response_etag(FakeRequest(), FakeDataset())
+    monkeypatch.setitem(api.app.config, 'socrata_first', True)
+    assert api.response_etag(FakeRequest(), FakeDataset()) != etag
+
+
+def test_not_modified():
+    etag = api.response_etag(FakeRequest(), FakeDataset())
+    assert api.not_modified(FakeRequest(), etag) is None
+    stale = FakeRequest(headers={'if-none-match': '"0123"'})
+    assert api.not_modified(stale, etag) is None
+    fresh = FakeRequest(headers={'if-none-match': '"0123", ' + etag})
+    res = api.not_modified(fresh, etag)
+    assert res.status == 304
+    assert res.headers['ETag'] == etag
@@ -0,0 +1,83 @@
+import asyncio
+from survey_stats.balancer import WorkerBalancer, parse_workers, slice_cost
+
+
+def test_slice_cost_grows_with_vars_and_filter():
+    base = {'vs': [], 'f': {}}
+    assert slice_cost(base) == 1
+    assert slice_cost({'vs': ['sex'], 'f': {}}) > slice_cost(base)
+    assert slice_cost({'vs': ['sex', 'race'], 'f': {}, 'rollup': True}) > \
+        slice_cost({'vs': ['sex', 'race'], 'f': {}})
+    assert slice_cost({'vs': [], 'f': {'year': ['2015', '2017']}}) > slice_cost(base)
+
+
+def test_parse_workers_list_and_file(tmpdir):
+    assert parse_workers('http://a:7788, http://b:7788/') == ['http://a:7788', 'http://b:7788']
+    fp = tmpdir.join('workers.txt')
+    fp.write('# stats workers\nhttp://a:7788\n\nhttp://c:7788\n')
+    assert parse_workers(str(fp)) == ['http://a:7788', 'http://c:7788']
+
+
+def test_acquire_least_outstanding_and_eject():
+    b = WorkerBalancer('http://a,http://b')
+    wa = b.acquire(5)
+    wb = b.acquire(1)
+    assert {wa.url, wb.url} == {'http://a', 'http://b'}
+    assert b.acquire(1) is wb
+    b.release(wa, 5, ok=False)
+    assert wa.outstanding == 0 and wa.failures == 1
+    # ejected, so the busier worker still gets the next batch
+    assert b.acquire(1) is wb
+    b.release(wb, 3, 1.0)
+    assert wb.outstanding == 0 and wb.latency == 1.0 / 3
+
+
+def test_slow_worker_ejected_and_refreshed_from_file(tmpdir):
+    fp = tmpdir.join('workers.txt')
+    fp.write('http://a\nhttp://b\nhttp://c\n')
+    b = WorkerBalancer(str(fp))
+    wa, wb, wc = [b.workers[u] for u in ['http://a', 'http://b', 'http://c']]
+    for w in [wa, wb]:
+        b.release(w, 1, 1.0)
+    b.release(wc, 1, 100.0)
+    assert wc.failures == 1 and wc.latency is None
+    assert b.acquire(1) is not wc
+    fp.write('http://a\nhttp://d\n')
+    fp.setmtime(fp.mtime() + 10)
+    b.refresh()
+    assert sorted(b.workers) == ['http://a', 'http://d']
+    assert b.workers['http://a'] is wa
+
+
+class FakeResponse(object):
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self):
+        return {'datasets': {}}
+
+
+class FakeTransport(object):
+
+    def get(self, url, path, timeout=None):
+        return FakeResponse()
+
+
+def test_healthy_check_resets_failures():
+    b = WorkerBalancer('http://a')
+    w = b.workers['http://a']
+    b.release(b.acquire(1), 1, ok=False)
+    b.eject(w, 'health check')
+    assert w.failures == 2
+    res = asyncio.get_event_loop().run_until_complete(b.check_health(FakeTransport()))
+    assert res['http://a']['status'] == {'datasets': {}}
+    assert w.failures == 0
+    # it still waits out its ejection
+    assert w.ejected_until > 0
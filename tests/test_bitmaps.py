@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from survey_stats.bitmaps import FacetIndex
+
+
+def facet_frame(n=1001, seed=7):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'sitecode': pd.Categorical(rng.choice(['CA', 'NY', 'TX', None], n)),
+        'year': rng.choice([2013, 2015, 2017], n),
+        'sex': rng.choice(['Female', 'Male'], n)
+    })
+
+
+def test_mask_matches_isin():
+    df = facet_frame()
+    idx = FacetIndex.from_frame(df, ['sitecode', 'year', 'sex'])
+    filt = {'sitecode': ['CA', 'TX'], 'year': ['2015', '2017']}
+    expected = (df.sitecode.isin(['CA', 'TX']) &
+                df.year.isin([2015, 2017])).values
+    assert idx.mask(filt).dtype == bool
+    assert (idx.mask(filt) == expected).all()
+
+
+def test_unknown_level_matches_nothing():
+    df = facet_frame()
+    idx = FacetIndex.from_frame(df, ['sitecode', 'year'])
+    assert not idx.mask({'sitecode': ['ZZ']}).any()
+    assert idx.mask({'year': ['2013']}).sum() == (df.year == 2013).sum()
+
+
+def test_unindexed_filter_is_not_covered():
+    df = facet_frame()
+    idx = FacetIndex.from_frame(df, ['sitecode'])
+    assert not idx.covers({'sex': ['Male']})
+    assert idx.mask({'sex': ['Male']}) is None
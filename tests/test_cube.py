@@ -0,0 +1,63 @@
+import os
+import feather
+import pandas as pd
+from survey_stats import cube
+from survey_stats.const import CUBE_DIR_FMT, CUBE_MANIFEST
+
+
+def test_query_key_normalizes_filter():
+    assert cube.query_key(['sex'], {'year': ['2015', '2013'], 'sitecode': 'CA'}) == \
+        cube.query_key(['sex'], {'sitecode': ['CA'], 'year': ['2013', '2015']})
+    assert cube.query_key(['sex', 'race'], {}) != cube.query_key(['race', 'sex'], {})
+
+
+def test_lookup_hits_only_current_version(tmpdir):
+    cdir = str(tmpdir)
+    os.makedirs(os.path.join(cdir, CUBE_DIR_FMT.format(dsid='yrbss')))
+    (vnat, fnat) = cube.query_key(['sex'], {})
+    (vtot, fsite) = cube.query_key([], {'sitecode': ['CA']})
+    df = pd.DataFrame({'response': ['1', '1', '1'],
+                       'sex': ['Female', 'Male', None],
+                       'mean': [0.2, 0.3, 0.25],
+                       'vars': [vnat, vnat, vtot],
+                       'filter': [fnat, fnat, fsite]})
+    feather.write_dataframe(df, cube.partition_path('yrbss', cdir, 'qn8'))
+    cube.write_manifest(cube.cube_dir('yrbss', cdir),
+                        {'version': 'v1', 'params': {}, 'done': {'qn8': 3}})
+    c = cube.StatsCube('yrbss', cdir, 'v1', ['year', 'sitecode', 'sex'])
+    assert [r['sex'] for r in c.lookup('qn8', ['sex'], {})] == ['Female', 'Male']
+    assert c.lookup('qn8', [], {'sitecode': ['CA']}) == [{'response': '1', 'mean': 0.25}]
+    assert c.lookup('qn8', ['year'], {}) is None
+    assert c.lookup('qn9', ['sex'], {}) is None
+    assert cube.StatsCube('yrbss', cdir, 'v2', ['sex']).lookup('qn8', ['sex'], {}) is None
+
+
+def test_manifest_read_once_per_version(tmpdir):
+    cdir = str(tmpdir)
+    ddir = cube.cube_dir('yrbss', cdir)
+    os.makedirs(ddir)
+    (vnat, fnat) = cube.query_key([], {})
+    df = pd.DataFrame({'response': ['1'], 'mean': [0.2],
+                       'vars': [vnat], 'filter': [fnat]})
+    feather.write_dataframe(df, cube.partition_path('yrbss', cdir, 'qn8'))
+    cube.write_manifest(ddir, {'version': 'v1', 'params': {}, 'done': {'qn8': 1}})
+    c = cube.stats_cube('yrbss', cdir, 'v1', ('sex',))
+    assert c.lookup('qn8', [], {}) == [{'response': '1', 'mean': 0.2}]
+    os.remove(os.path.join(ddir, CUBE_MANIFEST))
+    assert cube.stats_cube('yrbss', cdir, 'v1', ('sex',)) is c
+    assert c.lookup('qn8', [], {}) == [{'response': '1', 'mean': 0.2}]
+
+
+def test_partition_keeps_dtypes(tmpdir, monkeypatch):
+    def compute_query(d, qn, vs, f):
+        (vkey, fkey) = cube.query_key(vs, f)
+        return pd.DataFrame({'response': [True, False], 'year': [2015, 2017],
+                             'mean': [0.2, 0.8], 'count': [3, 9],
+                             'vars': vkey, 'filter': fkey})
+    monkeypatch.setattr(cube, 'compute_query', compute_query)
+    fp = str(tmpdir.join('qn8.feather'))
+    assert cube.compute_partition(('qn8', [(['year'], {})], fp)) == ('qn8', 2)
+    df = feather.read_dataframe(fp)
+    assert df.response.dtype == bool
+    assert df.year.dtype.kind == 'i'
+    assert df['count'].dtype.kind == 'i'
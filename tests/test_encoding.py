@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from survey_stats import encoding
+from survey_stats.const import ARROW_MIMETYPE, MSGPACK_MIMETYPE
+from survey_stats.encoding import negotiate, parse_accept, encode_frame, decode_frame
+
+needs_msgpack = pytest.mark.skipif(not encoding.has_msgpack(), reason='msgpack is not installed')
+
+
+def stats_frame():
+    return pd.DataFrame({'q': ['qn8', 'qn8'], 'response': [True, False],
+                         'sex': ['Female', None], 'mean': [0.25, np.nan],
+                         'count': np.array([120, 80])})
+
+
+def test_negotiate():
+    assert parse_accept('text/html;q=0.2, application/x-msgpack') == \
+        ['application/x-msgpack', 'text/html']
+    assert negotiate(None) == (None, None)
+    assert negotiate('application/json, */*') == (None, None)
+    assert negotiate(ARROW_MIMETYPE, 'br, deflate') == (ARROW_MIMETYPE, None)
+
+
+@needs_msgpack
+def test_negotiate_msgpack():
+    assert negotiate('application/json;q=0.5, ' + MSGPACK_MIMETYPE, 'gzip') == \
+        (MSGPACK_MIMETYPE, 'gzip')
+
+
+def test_negotiate_without_msgpack(monkeypatch):
+    monkeypatch.setattr(encoding, 'has_msgpack', lambda: False)
+    assert negotiate(MSGPACK_MIMETYPE + ', application/json;q=0.5') == (None, None)
+    assert negotiate(MSGPACK_MIMETYPE + ', ' + ARROW_MIMETYPE + ';q=0.5') == \
+        (ARROW_MIMETYPE, None)
+
+
+def check_round_trip(mimetype):
+    df = stats_frame()
+    meta = {'q': 'qn8', 'vars': ['sex'], 'filter': {'year': ['2015']}}
+    for coding in [None, 'gzip']:
+        body = encode_frame(df, mimetype, coding, meta)
+        res, rmeta = decode_frame(body, mimetype, coding)
+        assert rmeta == meta
+        assert list(res.columns) == list(df.columns)
+        assert res['count'].tolist() == [120, 80]
+        assert res['sex'][0] == 'Female' and pd.isnull(res['sex'][1])
+        assert pd.isnull(res['mean'][1])
+
+
+def test_round_trip_with_meta():
+    check_round_trip(ARROW_MIMETYPE)
+
+
+@needs_msgpack
+def test_round_trip_msgpack():
+    check_round_trip(MSGPACK_MIMETYPE)
+
+
+def mixed_frame():
+    return pd.DataFrame({'year': [2015, 'Total'], 'sitecode': [{'AL', 'AK'}, {'XX'}]})
+
+
+def test_mixed_and_set_columns():
+    res, _ = decode_frame(encode_frame(mixed_frame(), ARROW_MIMETYPE), ARROW_MIMETYPE)
+    assert res['year'].tolist() == ['2015', 'Total']
+    assert list(res['sitecode'][0]) == ['AK', 'AL']
+
+
+@needs_msgpack
+def test_mixed_columns_msgpack():
+    res, _ = decode_frame(encode_frame(mixed_frame(), MSGPACK_MIMETYPE), MSGPACK_MIMETYPE)
+    assert res['year'].tolist() == [2015, 'Total']
@@ -0,0 +1,82 @@
+import pytest
+from survey_stats.jobs import JobQueue, consume
+
+
+def slice_for(q, vs=()):
+    return {'d': 'yrbss', 'q': q, 'r': None, 'vs': list(vs), 'f': {}, 'rollup': False}
+
+
+def test_high_priority_slices_first():
+    jobs = JobQueue('memory://', ['high', 'normal', 'low'])
+    low = jobs.enqueue({'q': 'qn9'}, [slice_for('qn9')], 'low')
+    high = jobs.enqueue({'q': 'qn8'}, [slice_for('qn8'), slice_for('qn8', ['sex'])], 'high')
+    order = [jobs.pop(0.1)['job'] for _ in range(3)]
+    assert order == [high, high, low]
+    assert jobs.pop(0.01) is None
+    with pytest.raises(ValueError):
+        jobs.enqueue({}, [], 'urgent')
+
+
+def test_progress_and_partial_results():
+    jobs = JobQueue('memory://')
+    ready = [[{'mean': 0.5, 'method': 'socrata'}]]
+    job_id = jobs.enqueue({'q': 'qn8'}, [slice_for('qn8'), slice_for('qn8', ['sex'])],
+                          results=ready)
+    st = jobs.status(job_id)
+    assert (st['status'], st['priority'], st['finished'], st['total']) == ('queued', 'normal', 1, 3)
+    assert st['results'] == ready
+
+    def compute(s):
+        if s['vs']:
+            raise ValueError('no design')
+        return [{'mean': 0.1}]
+    assert consume(jobs, compute, timeout=0.1, max_tasks=1) == 1
+    st = jobs.status(job_id)
+    assert st['status'] == 'running'
+    assert st['results'] == ready + [[{'mean': 0.1}]]
+    consume(jobs, compute, timeout=0.1, max_tasks=1)
+    st = jobs.status(job_id)
+    assert (st['status'], st['failed'], st['progress']) == ('failed', 1, 1.0)
+    assert st['errors'] == ['worker failure!no design']
+    assert jobs.status('nope') is None
+
+
+def test_ready_job_is_finished():
+    jobs = JobQueue('memory://')
+    job_id = jobs.enqueue({'q': 'qn8'}, [], results=[[{'mean': 0.5}]])
+    assert jobs.status(job_id)['status'] == 'finished'
+
+
+def test_unrecorded_slices_are_requeued():
+    jobs = JobQueue('memory://', visibility=0)
+    job_id = jobs.enqueue({'q': 'qn8'}, [slice_for('qn8'), slice_for('qn8', ['sex'])])
+    lost = jobs.pop(0.1)
+    assert jobs.recover() == 1
+    again = jobs.pop(0.1)
+    assert again['slice'] == lost['slice']
+    jobs.record(again, result=[{'mean': 0.1}])
+    jobs.record(jobs.pop(0.1), result=[{'mean': 0.2}])
+    assert jobs.recover() == 0
+    st = jobs.status(job_id)
+    assert (st['status'], st['finished']) == ('finished', 2)
+
+
+def test_slices_are_recorded_once():
+    jobs = JobQueue('memory://', visibility=0, ttl=60)
+    job_id = jobs.enqueue({'q': 'qn8'}, [slice_for('qn8')])
+    slow = jobs.pop(0.1)
+    jobs.recover()
+    again = jobs.pop(0.1)
+    assert jobs.record(again, result=[{'mean': 0.1}])
+    assert not jobs.record(slow, result=[{'mean': 0.1}])
+    st = jobs.status(job_id)
+    assert (st['finished'], st['total'], len(st['results'])) == (1, 1, 1)
+
+
+def test_expired_jobs_are_not_recreated():
+    jobs = JobQueue('memory://')
+    job_id = jobs.enqueue({'q': 'qn8'}, [slice_for('qn8')])
+    task = jobs.pop(0.1)
+    jobs.redis.hashes.pop(jobs.key('job', job_id))
+    assert not jobs.record(task, result=[{'mean': 0.1}])
+    assert jobs.status(job_id) is None
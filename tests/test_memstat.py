@@ -0,0 +1,20 @@
+import os
+import subprocess
+from survey_stats.memstat import smaps_memory, child_pids, worker_memory
+
+
+def test_smaps_splits_rss():
+    mem = smaps_memory()
+    assert mem['rss'] > 0
+    assert abs(mem['shared'] + mem['private'] - mem['rss']) <= mem['rss'] * 0.01
+
+
+def test_worker_memory_lists_children():
+    p = subprocess.Popen(['sleep', '5'])
+    try:
+        assert p.pid in child_pids(os.getpid())
+        mem = worker_memory(os.getpid())
+        assert mem['workers'][p.pid]['rss'] > 0
+    finally:
+        p.kill()
+        p.wait()
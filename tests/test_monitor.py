@@ -0,0 +1,59 @@
+import asyncio
+from survey_stats.monitor import StatusMonitor
+
+
+class FakeBalancer(object):
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.polls = 0
+
+    async def check_health(self, session):
+        self.polls += 1
+        return self.statuses
+
+    def info(self):
+        return [{'url': u} for u in self.statuses]
+
+
+def poll(mon):
+    asyncio.get_event_loop().run_until_complete(mon.poll(None))
+
+
+def test_status_cached_between_polls():
+    bal = FakeBalancer({'http://a': {'status': {}, 'latency': 0.01}})
+    mon = StatusMonitor(None, bal)
+    assert mon.info()['checked_at'] is None
+    poll(mon)
+    info = mon.info()
+    assert info['db'] is None
+    assert info['worker_status'] == bal.statuses
+    assert info['workers'] == [{'url': 'http://a'}]
+    mon.info()
+    assert bal.polls == 1
+
+
+def test_readiness_reasons():
+    bal = FakeBalancer({'http://a': {'error': 'refused'}})
+    mon = StatusMonitor(None, bal)
+    assert mon.readiness() == ['status not checked yet']
+    poll(mon)
+    assert mon.readiness(['yrbss'], {}) == ['no stats worker reachable',
+                                           'datasets not loaded: yrbss']
+    bal.statuses = {'http://a': {'error': 'refused'}, 'http://b': {'status': {}}}
+    poll(mon)
+    assert mon.readiness(['yrbss'], {'yrbss': object()}) == []
+
+
+def test_run_stops_when_cancelled():
+    mon = StatusMonitor(None, FakeBalancer({}), interval=0.01)
+
+    async def cancel():
+        task = asyncio.ensure_future(mon.run(None))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.wait([task], timeout=1)
+        return task
+
+    task = asyncio.get_event_loop().run_until_complete(cancel())
+    assert task.cancelled()
@@ -0,0 +1,290 @@
+import attr
+import numpy as np
+import pandas as pd
+import feather
+import pytest
+import rpy2.robjects as robjects
+from rpy2.robjects import pandas2ri
+from survey_stats import survey as rsvy
+from survey_stats import npsvy as nsvy
+from survey_stats.bitmaps import FacetIndex
+from survey_stats.types import DatasetConfig
+from survey_stats.datasets import check_design_source
+
+STATS = ['mean', 'se', 'ci_l', 'ci_u', 'count', 'sample_size']
+
+load_api = robjects.r('''
+    function(name){
+        library(survey)
+        data(api)
+        return(get(name))
+    }
+''')
+
+
+def api_frame(name, strata, psu, weight):
+    df = pandas2ri.ri2py(load_api(name))
+    df.columns = [c.replace('.', '_') for c in df.columns]
+    df = df.assign(strata=df[strata] if strata else 1,
+                   psu=df[psu] if psu else np.arange(df.shape[0]),
+                   weight=df[weight].astype(float),
+                   fpc=df.fpc.astype(float))
+    for c in ['stype', 'sch_wide', 'comp_imp', 'awards']:
+        df[c] = df[c].astype(str).astype('category')
+    return df.reset_index(drop=True)
+
+
+@pytest.fixture(scope='module', params=[
+    ('apiclus1', None, 'dnum', 'pw', 'cluster'),
+    ('apistrat', 'stype', None, 'pw', 'stratified'),
+])
+def designs(request, tmpdir_factory):
+    name, strata, psu, weight, design = request.param
+    df = api_frame(name, strata, psu, weight)
+    fthr = str(tmpdir_factory.mktemp('npsvy').join(name + '.feather'))
+    feather.write_dataframe(df, fthr)
+    return (rsvy.des_from_feather(fthr, fpc=True, design=design),
+            nsvy.des_from_feather(fthr, fpc=True, design=design))
+
+
+def assert_stats_equal(rdf, ndf):
+    assert rdf.shape[0] == ndf.shape[0]
+    for c in STATS:
+        r = rdf[c].astype(float).values
+        n = ndf[c].astype(float).values
+        assert np.allclose(r, n, atol=1e-4, equal_nan=True), c
+
+
+@pytest.mark.parametrize('qn,r', [('sch_wide', 'Yes'), ('awards', 'No')])
+def test_totals_match_r(designs, qn, r):
+    rdes, ndes = designs
+    rdf = rsvy.fetch_stats_totals(rdes, rsvy.response_formula(qn, r), r)
+    ndf = nsvy.fetch_stats_totals(ndes, nsvy.response_formula(qn, r), r)
+    assert_stats_equal(rdf, ndf)
+
+
+@pytest.mark.parametrize('vs', [['stype'], ['stype', 'comp_imp']])
+def test_stats_by_match_r(designs, vs):
+    rdes, ndes = designs
+    qn, r = 'sch_wide', 'Yes'
+    rdf = rsvy.fetch_stats_by(rdes, rsvy.response_formula(qn, r), r, vs)
+    ndf = nsvy.fetch_stats_by(ndes, nsvy.response_formula(qn, r), r, vs)
+    assert_stats_equal(rdf, ndf)
+
+
+def test_rollup_matches_r_levels(designs):
+    rdes, ndes = designs
+    qn, r, vs = 'sch_wide', 'Yes', ['stype', 'comp_imp']
+    rdf = rsvy.fetch_stats_rollup(rdes, rsvy.response_formula(qn, r), r, vs)
+    ndf = nsvy.fetch_stats_rollup(ndes, nsvy.response_formula(qn, r), r, vs)
+    for k in range(len(vs) + 1):
+        assert_stats_equal(rdf[rdf.level == k], ndf[ndf.level == k])
+
+
+def test_rollup_matches_single_levels(designs):
+    _, ndes = designs
+    qn, r, vs = 'awards', 'Yes', ['comp_imp', 'stype']
+    qn_f = nsvy.response_formula(qn, r)
+    ndf = nsvy.fetch_stats_rollup(ndes, qn_f, r, vs)
+    assert_stats_equal(ndf[ndf.level == 0],
+                       nsvy.fetch_stats_totals(ndes, qn_f, r))
+    for k in range(len(vs)):
+        assert_stats_equal(ndf[ndf.level == k + 1],
+                           nsvy.fetch_stats_by(ndes, qn_f, r, vs[:k+1]))
+
+
+def test_responses_match_r(designs):
+    rdes, ndes = designs
+    qn, vs = 'stype', ['comp_imp']
+    rdf = rsvy.fetch_stats_responses(rdes, qn, vs, rollup=True)
+    ndf = nsvy.fetch_stats_responses(ndes, qn, vs, rollup=True)
+    assert set(rdf.response) == set(ndf.response)
+    for r in set(rdf.response):
+        for k in range(len(vs) + 1):
+            assert_stats_equal(rdf[(rdf.response == r) & (rdf.level == k)],
+                               ndf[(ndf.response == r) & (ndf.level == k)])
+
+
+def test_subset_matches_r(designs):
+    rdes, ndes = designs
+    qn, r, filt = 'sch_wide', 'Yes', {'comp_imp': ['Yes']}
+    rsub = rsvy.subset_survey(rdes, filt, qn)
+    nsub = nsvy.subset_survey(ndes, filt, qn)
+    assert rsvy.dim_design(rsub)[0] == nsvy.dim_design(nsub)[0]
+    assert_stats_equal(
+        rsvy.fetch_stats_totals(rsub, rsvy.response_formula(qn, r), r),
+        nsvy.fetch_stats_totals(nsub, nsvy.response_formula(qn, r), r))
+    assert_stats_equal(
+        rsvy.fetch_stats_by(rsub, rsvy.response_formula(qn, r), r, ['stype']),
+        nsvy.fetch_stats_by(nsub, nsvy.response_formula(qn, r), r, ['stype']))
+
+
+def test_domain_leaves_design_intact(designs):
+    _, ndes = designs
+    nsub = nsvy.subset_survey(ndes, {'stype': ['E']})
+    assert nsub.variables is ndes.variables
+    assert nsvy.dim_design(nsub)[0] == (ndes.variables.stype == 'E').sum()
+
+
+def test_bitmap_domain_matches_subset(designs):
+    rdes, ndes = designs
+    qn, r, filt = 'sch_wide', 'Yes', {'comp_imp': ['Yes']}
+    mask = FacetIndex.from_frame(ndes.variables, ['comp_imp']).mask(filt)
+    for eng, des in [(rsvy, rdes), (nsvy, ndes)]:
+        sub = eng.subset_survey(des, filt, qn)
+        dom = eng.domain_survey(des, mask, qn)
+        assert eng.dim_design(sub)[0] == eng.dim_design(dom)[0]
+        qn_f = eng.response_formula(qn, r)
+        assert_stats_equal(eng.fetch_stats_totals(sub, qn_f, r),
+                           eng.fetch_stats_totals(dom, qn_f, r))
+        assert_stats_equal(eng.fetch_stats_by(sub, qn_f, r, ['stype']),
+                           eng.fetch_stats_by(dom, qn_f, r, ['stype']))
+
+
+rep_ciprop = robjects.r('''
+    function(des, qn, r, type){
+        library(survey)
+        rdes <- as.svrepdesign(des, type=type)
+        res <- svyciprop(as.formula(sprintf('~I(%s=="%s")', qn, r)), rdes,
+                         method='xlogit', na.rm=TRUE)
+        c(coef(res), SE(res))
+    }
+''')
+
+
+@pytest.mark.parametrize('method', ['JKn', 'JK1'])
+def test_replicates_match_r(designs, method):
+    rdes, ndes = designs
+    if method == 'JK1' and len(ndes.n_psu) > 1:
+        pytest.skip('JK1 ignores strata')
+    qn, r = 'sch_wide', 'Yes'
+    rep = nsvy.replicate_factors(ndes, method)
+    ndes = attr.evolve(ndes, replicates=nsvy.replicate_weights(ndes, method, rep))
+    mean, se = rep_ciprop(rdes, qn, r, method)
+    ndf = nsvy.fetch_stats_totals(ndes, nsvy.response_formula(qn, r), r)
+    assert np.allclose([mean, se], ndf[['mean', 'se']].values[0], atol=1e-4)
+
+
+def test_replicates_saved_next_to_surveys(designs, tmpdir):
+    _, ndes = designs
+    repf = str(tmpdir.join('api_repweights.feather'))
+    first = nsvy.with_replicates(ndes, repf, 'bootstrap', 20, seed=1)
+    again = nsvy.with_replicates(ndes, repf, 'bootstrap', 20, seed=1)
+    assert np.array_equal(first.replicates.factors, again.replicates.factors.toarray())
+    qn_f = nsvy.response_formula('sch_wide', 'Yes')
+    assert_stats_equal(nsvy.fetch_stats_by(first, qn_f, 'Yes', ['stype']),
+                       nsvy.fetch_stats_by(again, qn_f, 'Yes', ['stype']))
+    # other parameters regenerate the saved factors
+    reseeded = nsvy.with_replicates(ndes, repf, 'bootstrap', 20, seed=2)
+    assert not np.array_equal(first.replicates.factors, reseeded.replicates.factors)
+    jk = nsvy.with_replicates(ndes, repf, 'JKn')
+    assert jk.replicates.method == 'JKn'
+    assert nsvy.saved_replicate_params(repf)[0] == nsvy.replicate_params('JKn')
+
+
+def test_design_snapshots(tmpdir):
+    df = api_frame('apiclus1', None, 'dnum', 'pw')
+    fthr = str(tmpdir.join('apiclus1.feather'))
+    feather.write_dataframe(df, fthr)
+    qn_f = nsvy.response_formula('sch_wide', 'Yes')
+    built = nsvy.des_from_feather(fthr, fpc=True)
+    loaded = nsvy.des_from_feather(fthr, fpc=True)
+    assert isinstance(loaded.weight, np.memmap)
+    assert_stats_equal(nsvy.fetch_stats_by(built, qn_f, 'Yes', ['stype']),
+                       nsvy.fetch_stats_by(loaded, qn_f, 'Yes', ['stype']))
+    nsvy.des_from_feather(fthr, fpc=False)
+    assert len(tmpdir.listdir(lambda p: p.ext == '.npdes')) == 1
+    rqn_f = rsvy.response_formula('sch_wide', 'Yes')
+    rbuilt = rsvy.des_from_feather(fthr, fpc=True)
+    rloaded = rsvy.des_from_feather(fthr, fpc=True)
+    assert len(tmpdir.listdir(lambda p: p.ext == '.rds')) == 1
+    assert_stats_equal(rsvy.fetch_stats_by(rbuilt, rqn_f, 'Yes', ['stype']),
+                       rsvy.fetch_stats_by(rloaded, rqn_f, 'Yes', ['stype']))
+
+
+def test_broken_snapshots_are_rebuilt(tmpdir):
+    df = api_frame('apiclus1', None, 'dnum', 'pw')
+    fthr = str(tmpdir.join('apiclus1.feather'))
+    feather.write_dataframe(df, fthr)
+    built = nsvy.des_from_feather(fthr, fpc=True)
+    rbuilt = rsvy.des_from_feather(fthr, fpc=True)
+    [snap] = tmpdir.listdir(lambda p: p.ext == '.npdes')
+    snap.join('weight.npy').remove()
+    [rds] = tmpdir.listdir(lambda p: p.ext == '.rds')
+    rds.write_binary(rds.read_binary()[:100])
+    qn_f = nsvy.response_formula('sch_wide', 'Yes')
+    assert_stats_equal(nsvy.fetch_stats_by(built, qn_f, 'Yes', ['stype']),
+                       nsvy.fetch_stats_by(nsvy.des_from_feather(fthr, fpc=True),
+                                           qn_f, 'Yes', ['stype']))
+    assert snap.join('weight.npy').check()
+    rqn_f = rsvy.response_formula('sch_wide', 'Yes')
+    assert_stats_equal(rsvy.fetch_stats_by(rbuilt, rqn_f, 'Yes', ['stype']),
+                       rsvy.fetch_stats_by(rsvy.des_from_feather(fthr, fpc=True),
+                                           rqn_f, 'Yes', ['stype']))
+
+
+def test_lonely_psu_average_matches_r(tmpdir):
+    df = api_frame('apiclus1', None, 'dnum', 'pw')
+    # pair up the districts, the last one alone in its stratum
+    dnums = sorted(df.dnum.unique())
+    df['strata'] = df.dnum.map({d: i // 2 for i, d in enumerate(dnums)})
+    assert len(dnums) % 2 == 1
+    fthr = str(tmpdir.join('lonely.feather'))
+    feather.write_dataframe(df, fthr)
+    rdes = rsvy.des_from_feather(fthr, fpc=True)
+    ndes = nsvy.des_from_feather(fthr, fpc=True)
+    assert ndes.lonely_psu == 'average'
+    qn, r = 'sch_wide', 'Yes'
+    assert_stats_equal(rsvy.fetch_stats_totals(rdes, rsvy.response_formula(qn, r), r),
+                       nsvy.fetch_stats_totals(ndes, nsvy.response_formula(qn, r), r))
+    assert_stats_equal(rsvy.fetch_stats_by(rdes, rsvy.response_formula(qn, r), r, ['stype']),
+                       nsvy.fetch_stats_by(ndes, nsvy.response_formula(qn, r), r, ['stype']))
+
+
+def test_lonely_psu_domain_matches_subset(tmpdir):
+    df = api_frame('apiclus1', None, 'dnum', 'pw')
+    dnums = sorted(df.dnum.unique())
+    df['strata'] = df.dnum.map({d: i // 2 for i, d in enumerate(dnums)})
+    # a domain of whole strata, the lonely one among them
+    df['upper'] = (df.strata >= df.strata.max() - 2).astype(str).astype('category')
+    fthr = str(tmpdir.join('lonely.feather'))
+    feather.write_dataframe(df, fthr)
+    rdes = rsvy.des_from_feather(fthr, fpc=True)
+    ndes = nsvy.des_from_feather(fthr, fpc=True)
+    qn, r, filt = 'sch_wide', 'Yes', {'upper': ['True']}
+    mask = FacetIndex.from_frame(ndes.variables, ['upper']).mask(filt)
+    for eng, des in [(rsvy, rdes), (nsvy, ndes)]:
+        sub = eng.subset_survey(des, filt, qn)
+        dom = eng.domain_survey(des, mask, qn)
+        qn_f = eng.response_formula(qn, r)
+        assert_stats_equal(eng.fetch_stats_totals(sub, qn_f, r),
+                           eng.fetch_stats_totals(dom, qn_f, r))
+        assert_stats_equal(eng.fetch_stats_by(sub, qn_f, r, ['stype']),
+                           eng.fetch_stats_by(dom, qn_f, r, ['stype']))
+    assert_stats_equal(
+        rsvy.fetch_stats_totals(rsvy.domain_survey(rdes, mask, qn), rsvy.response_formula(qn, r), r),
+        nsvy.fetch_stats_totals(nsvy.domain_survey(ndes, mask, qn), nsvy.response_formula(qn, r), r))
+
+
+def test_denovo_strata_match_r(tmpdir):
+    df = api_frame('apistrat', 'stype', None, 'pw')
+    df['year'] = np.where(np.arange(df.shape[0]) % 2, 2015, 2017)
+    fthr = str(tmpdir.join('denovo.feather'))
+    feather.write_dataframe(df, fthr)
+    rdes = rsvy.des_from_feather(fthr, denovo=True, fpc=True, design='stratified')
+    ndes = nsvy.des_from_feather(fthr, denovo=True, fpc=True, design='stratified')
+    assert len(ndes.n_psu) == 2 * df.stype.nunique()
+    qn, r = 'awards', 'Yes'
+    assert_stats_equal(rsvy.fetch_stats_totals(rdes, rsvy.response_formula(qn, r), r),
+                       nsvy.fetch_stats_totals(ndes, nsvy.response_formula(qn, r), r))
+    assert_stats_equal(rsvy.fetch_stats_by(rdes, rsvy.response_formula(qn, r), r, ['comp_imp']),
+                       nsvy.fetch_stats_by(ndes, nsvy.response_formula(qn, r), r, ['comp_imp']))
+
+
+def test_no_database_designs():
+    cfg = DatasetConfig.from_yaml('config/data/yrbss.yaml')
+    numpy_cfg = attr.evolve(cfg, surveys=attr.evolve(cfg.surveys, engine='numpy'))
+    check_design_source(cfg, use_db=True)
+    check_design_source(numpy_cfg, use_db=False)
+    with pytest.raises(NotImplementedError):
+        check_design_source(numpy_cfg, use_db=True)
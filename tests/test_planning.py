@@ -0,0 +1,50 @@
+import pandas as pd
+from survey_stats.types import ColumnFilter
+from survey_stats.planning import PlanIndex, survey_levels, read_levels, write_levels
+
+
+def svydf():
+    return pd.DataFrame({'sitecode': ['XX', 'AL', 'AK', 'AL', None],
+                         'qn8': ['1', '2', None, '1', '2'],
+                         'qn9': pd.Categorical(['1', '1', '1', None, '1']),
+                         'weight': [1.0, 2.0, 1.5, 1.0, 3.0]})
+
+
+def test_survey_levels_excludes_national():
+    nat = ColumnFilter(incl=False, vals=['XX'])
+    lv = survey_levels(svydf(), ['qn8', 'qn9', 'qn10'], 'sitecode', nat, 'abc')
+    assert lv['responses'] == {'qn8': ['1', '2'], 'qn9': ['1']}
+    assert lv['sites'] == ['AK', 'AL']
+    nat = ColumnFilter(incl=True, vals=['XX'])
+    assert survey_levels(svydf(), [], 'sitecode', nat, 'abc')['sites'] == ['XX']
+
+
+def test_levels_sidecar_checks_digest(tmpdir):
+    fp = str(tmpdir.join('yrbss_plan.json'))
+    assert read_levels(fp, 'abc') is None
+    lv = survey_levels(svydf(), ['qn8'], 'sitecode', None, 'abc')
+    write_levels(fp, lv)
+    assert read_levels(fp, 'abc') == lv
+    assert read_levels(fp, 'def') is None
+
+
+def test_plan_index_lookups():
+    lv = survey_levels(svydf(), ['qn8'], 'sitecode',
+                       ColumnFilter(incl=False, vals=['XX']), 'abc')
+    plan = PlanIndex.build(['qn8', 'qn9', 'qn8'], {'year': [2015, 2017],
+                                                  'sex': ['Female', 'Male']}, lv)
+    assert plan.has_qid('qn8') and not plan.has_qid('qn99')
+    assert plan.has_level('year', '2015') and plan.has_level('year', 2017)
+    assert not plan.has_level('year', '2016')
+    assert not plan.has_level('grade', '9')
+    assert not plan.has_level('year', 'all')
+    assert plan.responses['qn8'] == ['1', '2']
+    assert plan.national_sites == ['AK', 'AL']
+
+
+def test_plan_index_casts_levels():
+    plan = PlanIndex.build([], {'grade': [9.0, 10.0], 'sex': ['Female', 'Male']})
+    assert plan.has_level('grade', '9') and plan.has_level('grade', 10)
+    assert plan.has_level('grade', '10.0')
+    assert not plan.has_level('grade', '11')
+    assert plan.has_level('sex', 'Male') and not plan.has_level('sex', 1)
@@ -0,0 +1,78 @@
+import asyncio
+import pytest
+from survey_stats.singleflight import SingleFlight
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight('test')
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return [1, 2]
+
+    async def herd():
+        return await asyncio.gather(*[flights.do('k', work) for _ in range(10)])
+
+    assert run(herd()) == [[1, 2]] * 10
+    assert len(calls) == 1
+    assert flights.info() == {'inflight': 0, 'led': 1, 'joined': 9}
+    run(flights.do('k', work))
+    assert len(calls) == 2
+
+
+def test_errors_reach_every_caller():
+    flights = SingleFlight('test')
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError('boom')
+
+    async def herd():
+        return await asyncio.gather(*[flights.do('k', fail) for _ in range(3)],
+                                    return_exceptions=True)
+
+    assert all(isinstance(e, ValueError) for e in run(herd()))
+
+
+def test_claim_splits_overlapping_keys():
+    flights = SingleFlight('test')
+
+    async def overlap():
+        _, first = flights.claim(['a', 'b'])
+        joined, owned = flights.claim(['b', 'c', 'c'])
+        assert set(joined) == {'b'} and set(owned) == {'c'}
+        flights.resolve(first, {'a': 1, 'b': 2})
+        flights.resolve(owned, {'c': 3})
+        return [await joined['b'], await owned['c']]
+
+    assert run(overlap()) == [2, 3]
+    assert flights.info()['inflight'] == 0
+
+
+def test_cancelled_owner_releases_its_keys():
+    flights = SingleFlight('test')
+
+    async def owner():
+        _, owned = flights.claim(['a'])
+        try:
+            await asyncio.sleep(10)
+        except BaseException as e:
+            flights.resolve(owned, error=e)
+            raise
+
+    async def cancel():
+        task = asyncio.ensure_future(owner())
+        await asyncio.sleep(0)
+        joined, _ = flights.claim(['a'])
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await joined['a']
+
+    run(cancel())
+    assert flights.info()['inflight'] == 0
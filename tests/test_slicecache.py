@@ -0,0 +1,59 @@
+import numpy as np
+from survey_stats.slicecache import SliceCache, slice_key
+
+ROWS = [{'mean': np.float64(0.25), 'count': np.int64(12), 'sex': 'Female'}]
+
+
+def test_key_normalizes_filter():
+    a = slice_key('yrbss', 'v1', 'qn8', '1', ['sex', 'race'],
+                  {'year': ['2015', 2013], 'sitecode': 'CA'})
+    b = slice_key('yrbss', 'v1', 'qn8', '1', ['sex', 'race'],
+                  {'sitecode': ['CA'], 'year': ['2013', '2015', '2013']})
+    assert a == b
+    assert a != slice_key('yrbss', 'v1', 'qn8', '1', ['race', 'sex'],
+                          {'sitecode': ['CA'], 'year': ['2013', '2015']})
+    assert a != slice_key('yrbss', 'v2', 'qn8', '1', ['sex', 'race'],
+                          {'sitecode': ['CA'], 'year': ['2013', '2015']})
+
+
+def test_lru_evicts_by_bytes(tmpdir):
+    c = SliceCache(str(tmpdir), max_mb=300.0 / 1024 / 1024, persist=False)
+    for k in 'abc':
+        c.put(k, [{'x': 'y' * 100}], 'd', 'v')
+    assert c.get('a') is None
+    assert c.get('c') == [{'x': 'y' * 100}]
+    assert c.info()['evictions'] == 1
+    assert c.info()['bytes'] <= c.max_bytes
+
+
+def test_results_survive_restart(tmpdir):
+    SliceCache(str(tmpdir)).put('k', ROWS, 'yrbss', 'v1')
+    c = SliceCache(str(tmpdir))
+    assert c.get('k') == [{'mean': 0.25, 'count': 12, 'sex': 'Female'}]
+    assert c.info()['disk_hits'] == 1
+    assert c.get('k') is not None
+    assert c.info()['hits'] == 1
+
+
+def test_invalidate_stale_versions(tmpdir):
+    c = SliceCache(str(tmpdir))
+    c.put('old', ROWS, 'yrbss', 'v1')
+    c.put('new', ROWS, 'yrbss', 'v2')
+    c.put('other', ROWS, 'brfss', 'v1')
+    assert c.invalidate('yrbss', 'v2') == 1
+    c = SliceCache(str(tmpdir))
+    assert c.get('old') is None
+    assert c.get('new') is not None
+    assert c.get('other') is not None
+
+
+def test_disk_tier_is_capped(tmpdir):
+    c = SliceCache(str(tmpdir), max_disk_mb=500.0 / 1024 / 1024)
+    for k in 'abcdefgh':
+        c.put(k, [{'x': 'y' * 100}], 'd', 'v')
+    total = c.db.execute('SELECT SUM(size) FROM slices').fetchone()[0]
+    assert total <= c.max_disk_bytes
+    assert c.info()['pruned'] > 0
+    c = SliceCache(str(tmpdir))
+    assert c.get('a') is None
+    assert c.get('h') == [{'x': 'y' * 100}]
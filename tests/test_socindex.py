@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+from survey_stats.socindex import SocrataIndex
+
+
+def socrata_frame():
+    return pd.DataFrame({
+        'qid': ['qn8'] * 6 + ['qn9'] * 2,
+        'sitecode': ['XX', 'XX', 'XX', 'AL', 'AL', 'XX', 'XX', 'AL'],
+        'year': ['Total', 'Total', '2015', 'Total', '2015', 'Total', 'Total', 'Total'],
+        'sex': ['Total', 'Female', None, None, 'Male', 'Male', None, 'Total'],
+        'response': [True] * 8,
+        'mean': ['0.1234567', '0.2', '-1', '0.3', '0.4', '0.5', '0.6', '0.7'],
+        'count': ['10', '20', '30', '40', '50', '60', '70', '80']})
+
+
+def test_defaults_to_national_totals():
+    idx = SocrataIndex(socrata_frame(), ['sex', 'year'])
+    res = idx.query('qn8', [], {})
+    assert list(res.columns) == ['qid', 'response', 'sitecode', 'year', 'mean', 'count']
+    assert res['mean'].tolist() == [0.123457]
+    assert idx.span('qn8', [], {}) == 4
+    assert idx.query('qn99', [], {}).empty
+
+
+def test_vars_and_filters():
+    idx = SocrataIndex(socrata_frame(), ['sex', 'year'])
+    res = idx.query('qn8', ['sex'], {})
+    assert sorted(res['sex'].tolist()) == ['Female', 'Male', 'Total']
+    res = idx.query('qn8', ['year'], {'sitecode': ['AL']})
+    assert res['count'].tolist() == [40.0]
+    res = idx.query('qn8', [], {'year': ['2015']})
+    assert res['mean'].tolist() == [None]
+    res = idx.query('qn8', ['sitecode'], {'sex': ['Male'], 'year': ['2015', 'Total']})
+    assert sorted(zip(res['sitecode'], res['count'])) == [('AL', 50.0), ('XX', 60.0)]
+
+
+def test_coverage_of_published_breakdowns():
+    idx = SocrataIndex(socrata_frame(), ['sex', 'year'])
+    assert idx.covers('qn8', [], {})
+    assert idx.covers('qn8', ['sex'], {})
+    assert idx.covers('qn8', ['sex'], {}, rollup=True)
+    assert idx.covers('qn8', [], {'year': ['2015']})
+    assert idx.covers('qn8', ['sitecode'], {'sex': ['Male'], 'year': ['2015']})
+    assert idx.covers('qn8', ['year'], {}, rollup=True)
+    # pooled years and unpublished breakdowns go to the workers
+    assert not idx.covers('qn8', [], {'year': ['2015', 'Total']})
+    assert not idx.covers('qn9', ['sex'], {})
+    assert not idx.covers('qn8', ['race'], {})
+    assert not idx.covers('qn8', ['sex', 'year'], {}, rollup=True)
+
+
+def test_query_level_drops_totals():
+    idx = SocrataIndex(socrata_frame(), ['sex', 'year'])
+    res = idx.query_level('qn8', ['sex'], {})
+    assert sorted(res['sex'].tolist()) == ['Female', 'Male']
+    assert idx.query_level('qn8', [], {})['count'].tolist() == [10.0]
+
+
+def test_level_stats_shaped_like_worker_results():
+    idx = SocrataIndex(socrata_frame(), ['sex', 'year'])
+    assert idx.responses('qn8') == {'True'}
+    assert idx.responses('qn99') == set()
+    res = idx.level_stats('qn8', ['sex'], {})
+    assert list(res.columns) == ['sex', 'mean', 'se', 'ci_l', 'ci_u', 'count',
+                                 'sample_size', 'response', 'level']
+    assert res['response'].tolist() == ['True', 'True']
+    assert res['level'].tolist() == [1, 1]
+    assert res['se'].isnull().all()
+    top = idx.level_stats('qn8', [], {})
+    assert top.to_dict(orient='records')[0]['level'] == 0
+    assert 'qid' not in top.columns and 'sitecode' not in top.columns
@@ -0,0 +1,96 @@
+import threading
+import attr
+import pytest
+from survey_stats import state
+from survey_stats.const import MB
+
+
+@attr.s
+class FakeSurveys(object):
+    engine = attr.ib(default='numpy')
+
+
+@attr.s
+class FakeConfig(object):
+    surveys = attr.ib(default=attr.Factory(FakeSurveys))
+
+
+@attr.s
+class FakeDataset(object):
+    dsid = attr.ib()
+    nbytes = attr.ib(default=MB)
+    timings = attr.ib(default=attr.Factory(dict))
+    des = attr.ib(default=None)
+    cfg = attr.ib(default=attr.Factory(FakeConfig))
+
+
+@pytest.fixture
+def registry(tmpdir, monkeypatch):
+    for k in ['brfss', 'prams_p2011', 'yrbss']:
+        tmpdir.join(k + '.yaml').write('id: %s\n' % k)
+    created = []
+
+    def from_config(cfg_f, dbc, cache):
+        d = FakeDataset(dsid=cfg_f.split('/')[-1][:-5])
+        created.append(d.dsid)
+        return d
+    monkeypatch.setattr(state.SurveyDataset, 'from_config', from_config)
+    reg = state.DatasetRegistry(str(tmpdir))
+    reg.created = created
+    return reg
+
+
+def test_discovers_and_loads_on_first_use(registry):
+    assert sorted(registry.keys()) == ['brfss', 'prams_p2011', 'yrbss']
+    assert len(registry.loaded()) == 0
+    assert registry['yrbss'].dsid == 'yrbss'
+    assert registry['yrbss'] is registry['yrbss']
+    assert registry.created == ['yrbss']
+    with pytest.raises(KeyError):
+        registry['nope']
+
+
+def test_evicts_least_recently_used(registry):
+    registry.configure(None, None, budget_mb=2)
+    registry['brfss']
+    registry['prams_p2011']
+    registry['brfss']
+    registry['yrbss']
+    assert list(registry.loaded().keys()) == ['brfss', 'yrbss']
+    registry['prams_p2011']
+    assert registry.created == ['brfss', 'prams_p2011', 'yrbss', 'prams_p2011']
+
+
+def test_preload_warms_parts(registry):
+    registry.configure(None, None, parts=['des'])
+    registry.preload(['yrbss', 'brfss', 'missing'])
+    assert sorted(registry.loaded().keys()) == ['brfss', 'yrbss']
+
+
+def test_preload_builds_r_designs_in_calling_thread(registry, monkeypatch):
+    registry['yrbss'].cfg.surveys.engine = 'r'
+    threads = {}
+    warm = registry.warm
+
+    def record(k):
+        threads[k] = threading.current_thread()
+        return warm(k)
+    monkeypatch.setattr(registry, 'warm', record)
+    registry.preload(['yrbss', 'brfss', 'prams_p2011'])
+    assert threads['yrbss'] is threading.current_thread()
+    assert threads['brfss'] is not threading.current_thread()
+
+
+def test_configs_globbed_once(registry, tmpdir):
+    assert 'yrbss' in registry
+    tmpdir.join('nsch.yaml').write('id: nsch\n')
+    assert 'nsch' not in registry
+    registry.configure(None, None)
+    assert 'nsch' in registry
+
+
+def test_evicted_datasets_are_not_warmed(registry):
+    registry.configure(None, None, parts=['des'], budget_mb=1)
+    registry.preload(['yrbss', 'brfss'])
+    assert len(registry.loaded()) == 1
+    assert registry.warmed == set(registry.loaded().keys())
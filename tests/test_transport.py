@@ -0,0 +1,24 @@
+import asyncio
+from survey_stats.transport import WorkerTransport, split_worker_url
+
+
+def test_split_worker_url():
+    assert split_worker_url('http://w1:7788') == (None, 'http://w1:7788')
+    assert split_worker_url('unix:/tmp/statsworker.sock') == \
+        ('/tmp/statsworker.sock', 'http://localhost')
+
+
+def test_one_pool_per_socket():
+    async def sessions():
+        t = WorkerTransport(4, keepalive_timeout=10)
+        s1, _ = t.session('http://w1:7788')
+        s2, _ = t.session('http://w2:7788')
+        s3, base = t.session('unix:/tmp/statsworker.sock')
+        assert s1 is s2 and s3 is not s1
+        assert base == 'http://localhost'
+        info = t.info()
+        assert info['connections'] == 0
+        assert sorted(info['idle']) == ['tcp', 'unix:/tmp/statsworker.sock']
+        await t.close()
+        assert t.sessions == {}
+    asyncio.get_event_loop().run_until_complete(sessions())